@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Compares the run time of the primer3 engines (primer3_core in a subprocess,
+# and primer3-py in-process) on a random genome, and checks that they report
+# the same primer pairs. Usage:
+#   python3 benchmarks/primer3_engines.py primer3.config
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import primer3tools
+
+
+def write_random_genome(outfile, number_of_contigs, contig_length, seed):
+    random.seed(seed)
+    with open(outfile, 'w') as f:
+        for i in range(number_of_contigs):
+            print('>contig' + str(i + 1), file=f)
+            print(''.join(random.choice('ACGT') for _ in range(contig_length)), file=f)
+
+
+def primer_pairs_to_set(primer_pairs):
+    return {(name, x.left_start, x.right_start, x.left_fasta.seq, x.right_fasta.seq) for name in primer_pairs for x in primer_pairs[name]}
+
+
+parser = argparse.ArgumentParser(
+    description = 'Compare run time of the subprocess and bindings primer3 engines',
+    usage = 'primer3_engines.py [options] <primer3_config>'
+)
+parser.add_argument('--contigs', type=int, help='Number of contigs in random genome [%(default)s]', default=20, metavar='INT')
+parser.add_argument('--contig_length', type=int, help='Length of each contig [%(default)s]', default=50000, metavar='INT')
+parser.add_argument('--threads', type=int, help='Threads used by each engine [%(default)s]', default=1, metavar='INT')
+parser.add_argument('--repeats', type=int, help='Number of times to run each engine. The fastest time is reported [%(default)s]', default=3, metavar='INT')
+parser.add_argument('--seed', type=int, help='Seed for random genome [%(default)s]', default=42, metavar='INT')
+parser.add_argument('primer3_config', help='Primer3 config file')
+options = parser.parse_args()
+
+engines = []
+if shutil.which('primer3_core') is not None:
+    engines.append('subprocess')
+if primer3tools.primer3.primer3_bindings is not None:
+    engines.append('bindings')
+
+tmpdir = tempfile.mkdtemp(prefix='tmp.benchmark_primer3_engines.', dir=os.getcwd())
+genome_fasta = os.path.join(tmpdir, 'genome.fa')
+write_random_genome(genome_fasta, options.contigs, options.contig_length, options.seed)
+results = {}
+
+for engine in engines:
+    times = []
+    for i in range(options.repeats):
+        p3 = primer3tools.primer3.Primer3(genome_fasta, options.primer3_config, 'genome', threads=options.threads, engine=engine)
+        start = time.perf_counter()
+        p3.run(os.path.join(tmpdir, engine))
+        times.append(time.perf_counter() - start)
+    results[engine] = primer_pairs_to_set(p3.primer_pairs)
+    print(engine, 'seconds:', round(min(times), 3), 'primer pairs:', len(results[engine]), sep='\t')
+
+if len(results) == 2:
+    print('Same primer pairs from both engines:', results['subprocess'] == results['bindings'], sep='\t')
+elif len(engines) < 2:
+    print('Only found engine(s):', ', '.join(engines), '(need primer3_core in path and primer3-py installed to compare)')
+
+shutil.rmtree(tmpdir)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# Compares the run time and peak memory of parsing primer3_core output and
+# writing the primers FASTA file, using the readline parser (all primer
+# pairs kept in memory, then written) and the block-buffered streaming
+# parser used by primer3tools batch. Usage:
+#   python3 benchmarks/primer3_parser.py
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+import pyfastaq
+import primer3tools
+
+
+def write_fake_primer3_output(outfile, number_of_records, pairs_per_record, seed):
+    random.seed(seed)
+    f = pyfastaq.utils.open_file_write(outfile)
+    for i in range(number_of_records):
+        print('SEQUENCE_ID=contig' + str(i + 1) + ' description', file=f)
+        print('SEQUENCE_TEMPLATE=' + ''.join(random.choice('ACGT') for _ in range(100)), file=f)
+        for kind in ['LEFT', 'RIGHT', 'PAIR']:
+            print('PRIMER_' + kind + '_NUM_RETURNED=' + str(pairs_per_record), file=f)
+        for j in range(pairs_per_record):
+            left_start = random.randint(0, 10000)
+            print('PRIMER_PAIR_' + str(j) + '_PENALTY=' + str(random.random()), file=f)
+            print('PRIMER_LEFT_' + str(j) + '_SEQUENCE=' + ''.join(random.choice('ACGT') for _ in range(20)), file=f)
+            print('PRIMER_RIGHT_' + str(j) + '_SEQUENCE=' + ''.join(random.choice('ACGT') for _ in range(20)), file=f)
+            print('PRIMER_LEFT_' + str(j) + '=' + str(left_start) + ',20', file=f)
+            print('PRIMER_RIGHT_' + str(j) + '=' + str(left_start + 200) + ',20', file=f)
+            print('PRIMER_LEFT_' + str(j) + '_TM=60.0', file=f)
+            print('PRIMER_RIGHT_' + str(j) + '_TM=60.0', file=f)
+        print('=', file=f)
+    pyfastaq.utils.close(f)
+
+
+def readline_parser(p3, primer3_core_out, primers_fasta):
+    primer_pairs = {}
+    f = pyfastaq.utils.open_file_read(primer3_core_out)
+    while 1:
+        results = p3._get_next_primer3_sequence_results(f)
+        if results is None:
+            break
+        p3._add_primer_pairs_from_results(primer_pairs, results)
+    pyfastaq.utils.close(f)
+    p3._check_primer_pairs(primer_pairs)
+    return p3._write_primers_fasta(primers_fasta, primer_pairs.items())
+
+
+def streaming_parser(p3, primer3_core_out, primers_fasta):
+    return p3._write_primers_fasta(primers_fasta, p3._primer_pairs_from_file(primer3_core_out))
+
+
+parser = argparse.ArgumentParser(
+    description = 'Compare run time and peak memory of primer3_core output parsers',
+    usage = 'primer3_parser.py [options]'
+)
+parser.add_argument('--records', type=int, help='Number of sequence records in fake primer3_core output [%(default)s]', default=20000, metavar='INT')
+parser.add_argument('--pairs', type=int, help='Number of primer pairs per record [%(default)s]', default=5, metavar='INT')
+parser.add_argument('--repeats', type=int, help='Number of times to run each parser. The fastest time is reported [%(default)s]', default=3, metavar='INT')
+parser.add_argument('--seed', type=int, help='Seed for random primers [%(default)s]', default=42, metavar='INT')
+options = parser.parse_args()
+
+tmpdir = tempfile.mkdtemp(prefix='tmp.benchmark_primer3_parser.', dir=os.getcwd())
+primer3_core_out = os.path.join(tmpdir, 'primer3_core.out.gz')
+write_fake_primer3_output(primer3_core_out, options.records, options.pairs, options.seed)
+fasta_file = os.path.join(tmpdir, 'genome.fa')
+config_file = os.path.join(tmpdir, 'primer3.config')
+for filename in [fasta_file, config_file]:
+    open(filename, 'w').close()
+# primer3 is not run, so any command that is in the path will do
+p3 = primer3tools.primer3.Primer3(fasta_file, config_file, 'genome', primer3_command='true', compression_level=1)
+outputs = {}
+
+for name, function in [('readline', readline_parser), ('streaming', streaming_parser)]:
+    primers_fasta = os.path.join(tmpdir, name + '.primers.fasta.gz')
+    times = []
+    for i in range(options.repeats):
+        start = time.perf_counter()
+        pairs = function(p3, primer3_core_out, primers_fasta)
+        times.append(time.perf_counter() - start)
+
+    # tracing memory slows python down, so is done separately from timing
+    tracemalloc.start()
+    function(p3, primer3_core_out, primers_fasta)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    with pyfastaq.utils.open_file_read(primers_fasta) as f:
+        outputs[name] = f.read()
+    print(name, 'seconds:', round(min(times), 3), 'records/second:', round(options.records / min(times)), 'peak MB:', round(peak_memory / 1024**2, 1), 'primer pairs:', pairs, sep='\t')
+
+print('Same primers from both parsers:', outputs['readline'] == outputs['streaming'], sep='\t')
+shutil.rmtree(tmpdir)
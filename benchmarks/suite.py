@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+# Measures how the stages of primer3tools batch and get_unique scale with the
+# number of genomes and primers, using reproducible synthetic genome sets.
+# For each number of genomes, a set of related strains is made (from one random
+# ancestor, with a given similarity between strains and fraction of repeats),
+# and then each stage is run in its own child process, which reports the wall
+# time, CPU time and peak memory (maximum resident set size, including any
+# programs it runs, such as bowtie2) of the stage. The stages are:
+#   primer3            Primer3.run on each genome that primers are designed for
+#   bowtie2_index      mapping.bowtie2_index on each genome
+#   bowtie2            mapping.run_bowtie2 of all primers against each genome
+#   parse_sam          PrimerUniqueness._parse_sam of each SAM file
+#   update_primer_hits PrimerUniqueness._update_primer_hits for each genome
+#   write_output       PrimerUniqueness._write_all_output_files
+# Programs that are not installed (primer3_core, bowtie2, bowtie2-build) are replaced by
+# the stand-ins in benchmarks/stand_ins/. They are much faster than the real programs,
+# so the times of the primer3, bowtie2_index and bowtie2 stages are then not meaningful,
+# but the other stages still are. Results are written as tab-separated columns, where
+# items is the number of primer pairs (primer3), bases (bowtie2_index), primers mapped
+# (bowtie2), hits (parse_sam, update_primer_hits) or primer pairs written (write_output). Usage:
+#   python3 benchmarks/suite.py --genomes 2,4,8 --primers_per_contig 5,20
+
+import argparse
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+import primer3tools
+
+stand_ins_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stand_ins')
+tools = ['primer3_core', 'bowtie2', 'bowtie2-build']
+complement = str.maketrans('ACGT', 'TGCA')
+
+
+# Returns a random sequence of the given length, where about repeat_fraction of
+# the sequence is made of copies (on either strand) of a few repeat elements
+def random_sequence(length, repeat_fraction, repeats):
+    pieces = []
+    total = 0
+    while total < length:
+        if len(repeats) and random.random() < repeat_fraction:
+            piece = random.choice(repeats)
+            if random.random() < 0.5:
+                piece = piece.translate(complement)[::-1]
+        else:
+            piece = ''.join(random.choices('ACGT', k=random.randint(500, 5000)))
+        pieces.append(piece)
+        total += len(piece)
+    return ''.join(pieces)[:length]
+
+
+# Returns a copy of seq where each base is changed with probability 1 - similarity
+def mutate(seq, similarity):
+    seq = list(seq)
+    number_of_changes = int(round(len(seq) * (1 - similarity)))
+    for i in random.sample(range(len(seq)), number_of_changes):
+        seq[i] = random.choice([x for x in 'ACGT' if x != seq[i]])
+    return ''.join(seq)
+
+
+# Writes number_of_genomes strains of a random ancestor genome, and a genomes file
+# for primer3tools. Primers are designed for the first number_with_primers genomes
+def write_genome_set(outdir, number_of_genomes, number_with_primers, genome_size, contigs, repeat_fraction, similarity, seed):
+    random.seed(seed)
+    repeats = [''.join(random.choices('ACGT', k=random.randint(300, 3000))) for i in range(5)]
+    contig_lengths = [genome_size // contigs] * contigs
+    contig_lengths[-1] += genome_size - sum(contig_lengths)
+    ancestor = [random_sequence(x, repeat_fraction, repeats) for x in contig_lengths]
+    genomes_file = os.path.join(outdir, 'genomes.tsv')
+
+    with open(genomes_file, 'w') as f_genomes:
+        for i in range(number_of_genomes):
+            name = 'genome' + str(i + 1)
+            fasta_file = os.path.join(outdir, name + '.fa')
+            with open(fasta_file, 'w') as f:
+                for j, contig in enumerate(ancestor):
+                    print('>contig' + str(j + 1), file=f)
+                    print(mutate(contig, similarity), file=f)
+            print(name, fasta_file, 1 if i < number_with_primers else 0, sep='\t', file=f_genomes)
+
+    return genomes_file
+
+
+# Runs function(*args) in a child process. Returns what it returns, and the wall time,
+# CPU time (user + system) and peak memory (MB) of the child and any programs it ran
+def run_measured(function, *args):
+    read_end, write_end = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        # the child must not return to the rest of the script, even if the stage fails
+        try:
+            os.close(read_end)
+            with os.fdopen(write_end, 'wb') as f:
+                pickle.dump(function(*args), f)
+        except:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+
+    os.close(write_end)
+    with os.fdopen(read_end, 'rb') as f:
+        data = f.read()
+    pid, status, rusage = os.wait4(pid, 0)
+    wall_time = time.perf_counter() - start
+    if status != 0:
+        raise Exception('Error running benchmark stage ' + function.__name__)
+    # ru_maxrss is in KB on Linux
+    return pickle.loads(data), wall_time, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss / 1024
+
+
+def stage_primer3(genomes, primer3_config, outdir):
+    primer_pairs = 0
+    for name in genomes:
+        if genomes[name].make_primers:
+            p3 = primer3tools.primer3.Primer3(genomes[name].fasta_file, primer3_config, name)
+            p3.run(os.path.join(outdir, name))
+            primer_pairs += sum([len(x) for x in p3.primer_pairs.values()])
+    return primer_pairs
+
+
+def stage_bowtie2_index(genomes, outdir):
+    for name in genomes:
+        primer3tools.mapping.bowtie2_index(genomes[name].fasta_file, outprefix=os.path.join(outdir, name + '.bowtie2_index'))
+    return sum([os.path.getsize(genomes[x].fasta_file) for x in genomes])
+
+
+def stage_bowtie2(genomes, primers_fasta, index_dir, outdir):
+    for name in genomes:
+        primer3tools.mapping.run_bowtie2(primers_fasta, os.path.join(index_dir, name + '.bowtie2_index'), os.path.join(outdir, name + '.sam'))
+    return len(list(genomes))
+
+
+def stage_parse_sam(genomes, catalog, outdir):
+    return {name: primer3tools.uniqueness.PrimerUniqueness._parse_sam(os.path.join(outdir, name + '.sam'), catalog) for name in genomes}
+
+
+def stage_update_primer_hits(uniqueness, hits, catalog):
+    primer_hits = {}
+    for genome_name in sorted(hits):
+        uniqueness._update_primer_hits(primer_hits, hits[genome_name], catalog, genome_name)
+    return primer_hits
+
+
+def stage_write_output(uniqueness, primer_hits, genomes):
+    uniqueness._write_all_output_files(primer_hits, genomes)
+    return len(primer_hits)
+
+
+parser = argparse.ArgumentParser(
+    description = 'Measure run time and memory of each stage of primer3tools on synthetic genomes',
+    usage = 'suite.py [options]'
+)
+parser.add_argument('--genomes', help='Comma-separated list of numbers of genomes. The benchmark is run once for each number [%(default)s]', default='1,2,4,8', metavar='INT,INT,...')
+parser.add_argument('--primers_per_contig', help='Comma-separated list of the number of primer pairs primer3 returns per contig (PRIMER_NUM_RETURN). The stages that use primers are run once for each number [%(default)s]', default='5,20', metavar='INT,INT,...')
+parser.add_argument('--primer_genomes', type=float, help='Fraction of genomes that primers are designed for (at least one genome always has primers designed) [%(default)s]', default=0.5, metavar='FLOAT')
+parser.add_argument('--genome_size', type=int, help='Length of each genome [%(default)s]', default=200000, metavar='INT')
+parser.add_argument('--contigs', type=int, help='Number of contigs in each genome [%(default)s]', default=5, metavar='INT')
+parser.add_argument('--repeat_fraction', type=float, help='Fraction of each genome made of copies of repeat elements [%(default)s]', default=0.05, metavar='FLOAT')
+parser.add_argument('--similarity', type=float, help='Fraction of bases of each genome that are the same as in the common ancestor of all the genomes [%(default)s]', default=0.99, metavar='FLOAT')
+parser.add_argument('--primer3_config', help='Primer3 config file. Needed to use a real primer3_core. If not given, the primer3_core stand-in is always used')
+parser.add_argument('--stand_ins', choices=['missing', 'all', 'none'], help='Which programs are replaced by stand-ins. missing: programs not found in the path. all: all of them. none: use real programs only [%(default)s]', default='missing')
+parser.add_argument('--seed', type=int, help='Seed for random genomes [%(default)s]', default=42, metavar='INT')
+parser.add_argument('--outfile', help='Also write results to this file', metavar='FILENAME')
+parser.add_argument('--keep', action='store_true', help='Keep the temporary directory of genomes and output files')
+options = parser.parse_args()
+
+tmpdir = tempfile.mkdtemp(prefix='tmp.benchmark_suite.', dir=os.getcwd())
+stand_ins = []
+for tool in tools:
+    use_stand_in = options.stand_ins == 'all' or (options.stand_ins == 'missing' and shutil.which(tool) is None)
+    if tool == 'primer3_core' and options.primer3_config is None:
+        use_stand_in = True
+    if use_stand_in:
+        stand_ins.append(tool)
+    elif shutil.which(tool) is None:
+        print('Error:', tool, 'not found in path. Use --stand_ins missing to use a stand-in instead', file=sys.stderr)
+        sys.exit(1)
+
+# the stand-ins are put first in the path, so that they are used instead of installed programs
+if len(stand_ins):
+    bin_dir = os.path.join(tmpdir, 'bin')
+    os.mkdir(bin_dir)
+    for tool in stand_ins:
+        os.symlink(os.path.join(stand_ins_dir, tool), os.path.join(bin_dir, tool))
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    # the bowtie2 stand-in uses primer3tools
+    os.environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(primer3tools.__file__))) + os.pathsep + os.environ.get('PYTHONPATH', '')
+    print('Using stand-ins for:', ', '.join(stand_ins), file=sys.stderr)
+
+# primer3 is run with each number of primers per contig, using a copy of the config
+# file with PRIMER_NUM_RETURN changed. It goes before the "=" line that ends the settings
+if options.primer3_config is None:
+    config_lines = []
+else:
+    with open(options.primer3_config) as f:
+        config_lines = [x.rstrip('\n') for x in f if not x.startswith('PRIMER_NUM_RETURN=')]
+config_end = config_lines.index('=') if '=' in config_lines else len(config_lines)
+
+columns = ['genomes', 'genome_size', 'primers_per_contig', 'primer_pairs', 'stage', 'wall_seconds', 'cpu_seconds', 'peak_rss_MB', 'items', 'items_per_second']
+lines = ['\t'.join(columns)]
+print(lines[0], flush=True)
+
+for number_of_genomes in [int(x) for x in options.genomes.split(',')]:
+    outdir = os.path.join(tmpdir, 'genomes_' + str(number_of_genomes))
+    os.mkdir(outdir)
+    number_with_primers = max(1, int(round(options.primer_genomes * number_of_genomes)))
+    genomes_file = write_genome_set(outdir, number_of_genomes, number_with_primers, options.genome_size, options.contigs, options.repeat_fraction, options.similarity, options.seed)
+    genomes = primer3tools.genome_set.GenomeSet(genomes_file)
+    results = {}
+
+    def report(stage, function, args, count_items, primers_per_contig=None):
+        result, wall_time, cpu_time, peak_memory = run_measured(function, *args)
+        results[stage] = result
+        items = count_items(result)
+        if primers_per_contig is None:
+            primers_per_contig, primer_pairs = '.', '.'
+        else:
+            primer_pairs = results['primer3']
+        line = '\t'.join([str(x) for x in [number_of_genomes, options.genome_size, primers_per_contig, primer_pairs, stage, round(wall_time, 3), round(cpu_time, 3), round(peak_memory, 1), items, round(items / max(wall_time, 1e-9), 1)]])
+        lines.append(line)
+        print(line, flush=True)
+
+    # the indexes do not depend on the primers, so are only made once
+    report('bowtie2_index', stage_bowtie2_index, (genomes, outdir), lambda x: x)
+
+    for primers_per_contig in [int(x) for x in options.primers_per_contig.split(',')]:
+        run_dir = os.path.join(outdir, 'primers_' + str(primers_per_contig))
+        os.mkdir(run_dir)
+        primer3_config = os.path.join(run_dir, 'primer3.config')
+        with open(primer3_config, 'w') as f:
+            print(*config_lines[:config_end], 'PRIMER_NUM_RETURN=' + str(primers_per_contig), *config_lines[config_end:], sep='\n', file=f)
+
+        uniqueness = primer3tools.uniqueness.PrimerUniqueness(genomes_file, run_dir, os.path.join(run_dir, 'out'))
+        report('primer3', stage_primer3, (genomes, primer3_config, run_dir), lambda x: x, primers_per_contig)
+        primers_fasta = os.path.join(run_dir, 'out.all_primers.fa')
+        catalog = uniqueness._load_primer_catalog(genomes, primers_fasta)
+        report('bowtie2', stage_bowtie2, (genomes, primers_fasta, outdir, run_dir), lambda x: len(catalog.sequences) * x, primers_per_contig)
+        report('parse_sam', stage_parse_sam, (genomes, catalog, run_dir), lambda x: sum([len(y) for y in x.values()]), primers_per_contig)
+        report('update_primer_hits', stage_update_primer_hits, (uniqueness, results['parse_sam'], catalog), lambda x: sum([len(y) for y in results['parse_sam'].values()]), primers_per_contig)
+        report('write_output', stage_write_output, (uniqueness, results['update_primer_hits'], genomes), lambda x: x, primers_per_contig)
+
+if options.outfile is not None:
+    with open(options.outfile, 'w') as f:
+        print(*lines, sep='\n', file=f)
+
+if options.keep:
+    print('Kept temporary directory', tmpdir, file=sys.stderr)
+else:
+    shutil.rmtree(tmpdir)
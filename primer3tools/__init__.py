@@ -1,10 +1,24 @@
 __all__ = [
+    'aho_corasick',
+    'artifacts',
+    'binary_catalog',
+    'checkpoint',
     'common',
+    'compression',
+    'exact_index',
     'genome_set',
+    'hit_store',
+    'hit_table',
+    'kmer_filter',
     'mapping',
+    'match_runs',
+    'metrics',
+    'pairing',
+    'primer_catalog',
     'primer_pair',
     'primer3',
     'primer3_batch',
+    'scheduler',
     'uniqueness',
 ]
 
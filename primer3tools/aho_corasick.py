@@ -0,0 +1,202 @@
+import numpy
+import pyfastaq
+import primer3tools.exact_index
+from primer3tools import hit_table
+
+
+class Error (Exception): pass
+
+
+# code of each byte: A, C, G, T (either case) are 0, 1, 2, 3, and anything else is 4,
+# which never matches a primer
+_codes = bytearray([4] * 256)
+for _code, _bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+    for _base in _bases:
+        _codes[_base] = _code
+_codes = bytes(_codes)
+_complement = bytes.maketrans(b'ACGT', b'TGCA')
+
+
+# Aho-Corasick automaton for finding all occurrences of a set of DNA sequences
+# in a text in one pass. The automaton is stored as a complete transition
+# table, so that scanning only needs one table lookup per base
+class Automaton:
+    def __init__(self, patterns):
+        self.pattern_lengths = [len(x) for x in patterns]
+        self.transitions = [-1] * 5
+        ends = [[]]
+
+        for pattern_index, pattern in enumerate(patterns):
+            if len(pattern) == 0 or len(pattern.translate(None, b'ACGT')) > 0:
+                raise Error('Patterns must be non-empty and only contain A, C, G, T. Got: ' + pattern.decode())
+
+            state = 0
+            for code in pattern.translate(_codes):
+                if self.transitions[5 * state + code] == -1:
+                    self.transitions[5 * state + code] = len(ends)
+                    self.transitions.extend([-1] * 5)
+                    ends.append([])
+                state = self.transitions[5 * state + code]
+            ends[state].append(pattern_index)
+
+        # Breadth first through the trie, filling in missing transitions from the
+        # failure link of each state, and collecting the patterns that end at
+        # each state, including those found by following failure links
+        failure = [0] * len(ends)
+        self.reports = [tuple(x) if len(x) else None for x in ends]
+        queue = [0]
+        for state in queue:
+            for code in range(5):
+                child = self.transitions[5 * state + code]
+                if code == 4:
+                    self.transitions[5 * state + code] = 0
+                elif child == -1:
+                    self.transitions[5 * state + code] = 0 if state == 0 else self.transitions[5 * failure[state] + code]
+                else:
+                    failure[child] = 0 if state == 0 else self.transitions[5 * failure[state] + code]
+                    if self.reports[failure[child]] is not None:
+                        self.reports[child] = (self.reports[child] or ()) + self.reports[failure[child]]
+                    queue.append(child)
+
+
+    # Yields (start position, pattern index) of every occurrence of every pattern in seq,
+    # a string or bytes, which is treated as upper case
+    def scan(self, seq):
+        if isinstance(seq, str):
+            seq = seq.encode()
+        transitions = self.transitions
+        reports = self.reports
+        lengths = self.pattern_lengths
+        state = 0
+
+        for position, code in enumerate(seq.translate(_codes)):
+            state = transitions[5 * state + code]
+            if reports[state] is not None:
+                for pattern_index in reports[state]:
+                    yield position - lengths[pattern_index] + 1, pattern_index
+
+
+# Finds every exact match of primers (forwards and reverse complement) in
+# a FASTA file, by reading it once, without needing an index. Each contig is
+# read in chunks. The k-mers of a chunk are made with numpy (as for an
+# exact_index.ExactIndex), and looked up in a sorted array of the first k bases
+# of each primer. The rest of each candidate primer is then compared with the
+# contig. Primers shorter than k are searched for in the whole contig instead
+class PrimerScanner:
+    def __init__(self, catalog, primer_ids, kmer_length=primer3tools.exact_index.default_kmer_length, chunk_size=1000000):
+        self.kmer_length = kmer_length
+        self.chunk_size = chunk_size
+        pattern_indexes = {}
+        patterns = []
+        pattern_primers = []
+
+        for primer_id in primer_ids:
+            seq = catalog.sequences[primer_id].encode()
+            if len(seq) == 0 or len(seq.translate(None, b'ACGT')) > 0:
+                continue
+            reverse = seq.translate(_complement)[::-1]
+            # a palindromic primer only gets one hit at each position, as from bowtie2
+            for is_reverse, pattern in [(False, seq), (True, reverse)][:1 if reverse == seq else 2]:
+                if pattern not in pattern_indexes:
+                    pattern_indexes[pattern] = len(patterns)
+                    patterns.append(pattern)
+                    pattern_primers.append([])
+                pattern_primers[pattern_indexes[pattern]].append((primer_id, is_reverse))
+
+        # the primers (and strand) of pattern i are rows first_primer[i] to first_primer[i + 1] - 1
+        self.first_primer = numpy.cumsum([0] + [len(x) for x in pattern_primers], dtype=numpy.int64)
+        self.primer_ids = numpy.array([x[0] for y in pattern_primers for x in y], dtype=numpy.int64)
+        self.is_reverse = numpy.array([x[1] for y in pattern_primers for x in y], dtype=bool)
+
+        self.short_patterns = [(i, x) for i, x in enumerate(patterns) if len(x) < kmer_length]
+        # patterns of each length at least k long: (pattern indexes, 2d array of the patterns,
+        # value of the first k-mer of each pattern), sorted by k-mer value
+        self.patterns_by_length = {}
+        for length in sorted({len(x) for x in patterns if len(x) >= kmer_length}):
+            indexes = numpy.array([i for i, x in enumerate(patterns) if len(x) == length], dtype=numpy.int64)
+            pattern_array = numpy.frombuffer(b''.join([patterns[i] for i in indexes.tolist()]), dtype=numpy.uint8).reshape(len(indexes), length)
+            values = primer3tools.exact_index._kmer_values(pattern_array[:, :kmer_length].ravel(), kmer_length)[0][::kmer_length]
+            order = numpy.argsort(values, kind='stable')
+            self.patterns_by_length[length] = (indexes[order], pattern_array[order], values[order])
+
+
+    # Returns the start positions and pattern indexes of matches of the patterns at
+    # least k long that start from position start to end - 1 of sequence
+    def _kmer_matches(self, sequence, start, end):
+        found_positions = []
+        found_patterns = []
+        values, valid = primer3tools.exact_index._kmer_values(sequence[start:end + self.kmer_length - 1], self.kmer_length)
+        positions = numpy.flatnonzero(valid)
+        values = values[positions]
+        positions += start
+
+        for length, (indexes, pattern_array, pattern_values) in self.patterns_by_length.items():
+            first = numpy.searchsorted(pattern_values, values, side='left')
+            counts = numpy.searchsorted(pattern_values, values, side='right') - first
+            candidate_positions = numpy.repeat(positions, counts)
+            candidate_rows = hit_table.ranges(first, counts)
+            in_sequence = candidate_positions + length <= len(sequence)
+            candidate_positions = candidate_positions[in_sequence]
+            candidate_rows = candidate_rows[in_sequence]
+
+            # the first k bases match already, so only check the rest
+            offsets = numpy.arange(self.kmer_length, length, dtype=numpy.int64)
+            if len(offsets) and len(candidate_positions):
+                matches = (sequence[candidate_positions[:, None] + offsets] == pattern_array[candidate_rows][:, offsets]).all(axis=1)
+                candidate_positions = candidate_positions[matches]
+                candidate_rows = candidate_rows[matches]
+
+            found_positions.append(candidate_positions)
+            found_patterns.append(indexes[candidate_rows])
+
+        return found_positions, found_patterns
+
+
+    # Returns a HitTable of all matches to the sequences in fasta_file. Hits
+    # are sorted by primer ID, then contig, then position
+    def hit_table(self, fasta_file):
+        contig_names = []
+        found_contigs = [numpy.zeros(0, dtype=numpy.int64)]
+        found_positions = [numpy.zeros(0, dtype=numpy.int64)]
+        found_patterns = [numpy.zeros(0, dtype=numpy.int64)]
+
+        for seq in pyfastaq.sequences.file_reader(fasta_file):
+            # bowtie2 uses the name up to the first whitespace, so do the same
+            contig_names.append(seq.id.split()[0])
+            contig_bytes = seq.seq.upper().encode()
+            sequence = numpy.frombuffer(contig_bytes, dtype=numpy.uint8)
+            positions = []
+            patterns = []
+
+            for start in range(0, max(len(sequence) - self.kmer_length + 1, 0), self.chunk_size):
+                chunk_positions, chunk_patterns = self._kmer_matches(sequence, start, min(start + self.chunk_size, len(sequence) - self.kmer_length + 1))
+                positions.extend(chunk_positions)
+                patterns.extend(chunk_patterns)
+
+            # these are rare, so are found without numpy
+            for pattern_index, pattern in self.short_patterns:
+                pattern_positions = []
+                position = contig_bytes.find(pattern)
+                while position != -1:
+                    pattern_positions.append(position)
+                    position = contig_bytes.find(pattern, position + 1)
+                positions.append(numpy.array(pattern_positions, dtype=numpy.int64))
+                patterns.append(numpy.full(len(pattern_positions), pattern_index, dtype=numpy.int64))
+
+            positions = numpy.concatenate(positions + [numpy.zeros(0, dtype=numpy.int64)])
+            found_positions.append(positions)
+            found_patterns.append(numpy.concatenate(patterns + [numpy.zeros(0, dtype=numpy.int64)]))
+            found_contigs.append(numpy.full(len(positions), len(contig_names) - 1, dtype=numpy.int64))
+
+        # one hit for each primer (and strand) of each matching pattern
+        patterns = numpy.concatenate(found_patterns)
+        counts = self.first_primer[patterns + 1] - self.first_primer[patterns]
+        rows = hit_table.ranges(self.first_primer[patterns], counts)
+        primer_ids = self.primer_ids[rows]
+        is_reverse = self.is_reverse[rows]
+        contig_ids = numpy.repeat(numpy.concatenate(found_contigs), counts)
+        starts = numpy.repeat(numpy.concatenate(found_positions), counts)
+        order = numpy.lexsort((is_reverse, starts, contig_ids, primer_ids))
+        hits = hit_table.HitTable()
+        hits.add_columns(primer_ids[order], contig_ids[order], starts[order], is_reverse[order], contig_names)
+        return hits
@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import subprocess
+import multiprocessing.pool
+from primer3tools import common
+
+
+class Error (Exception): pass
+
+
+manifest_name = 'artifacts.json'
+
+
+# Returns a dictionary of filename -> sha256 of the file. Files are read in
+# chunks, and several files are hashed at once using threads (hashlib does
+# not hold the GIL while hashing large chunks)
+def hash_files(filenames, threads=1):
+    filenames = sorted(set(filenames))
+    to_hash = [[x] for x in filenames]
+
+    if threads > 1 and len(filenames) > 1:
+        pool = multiprocessing.pool.ThreadPool(min(threads, len(filenames)))
+        hashes = pool.map(common.sha256_of_files, to_hash)
+        pool.close()
+        pool.join()
+    else:
+        hashes = [common.sha256_of_files(x) for x in to_hash]
+
+    return dict(zip(filenames, hashes))
+
+
+# Returns the output of running a command with its version option, to
+# identify which version of a tool made an artifact. The output is used
+# whatever the exit code, because some tools exit nonzero after reporting
+# their version
+def tool_version(command, version_option='--version'):
+    completed = subprocess.run(
+        command + ' ' + version_option,
+        shell=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    return completed.stdout.decode(errors='replace').strip()
+
+
+# Returns a key made from all the inputs of an artifact. parts must be
+# JSON serializable, for example strings and hashes of input files
+def artifact_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+# Records the key of each artifact in an output directory. An artifact only
+# needs to be made again if its key has changed, or it has no key
+class ArtifactManifest:
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.keys = {}
+
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    self.keys = json.load(f)
+            except:
+                raise Error('Error reading artifact manifest file ' + self.filename)
+
+
+    def is_current(self, name, key):
+        return self.keys.get(name, None) == key
+
+
+    def set(self, name, key):
+        self.keys[name] = key
+
+
+    def remove(self, name):
+        self.keys.pop(name, None)
+
+
+    def save(self):
+        tmp_file = self.filename + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.keys, f, indent=2, sort_keys=True)
+        # rename at the end, so that a crash never leaves a partly written manifest
+        os.replace(tmp_file, self.filename)
@@ -0,0 +1,248 @@
+import os
+import json
+import math
+import array
+import shutil
+import struct
+import numpy
+import numpy.lib.format
+
+
+class Error (Exception): pass
+
+
+# Increase this when the files written by Writer change, so that old catalogs are not used
+format_version = 1
+catalog_files = ['contig_names.txt', 'pairs.npy', 'offsets.npy', 'sequences.npy', 'lower_case.npy', 'exceptions.json', 'info.json']
+
+# 2-bit code of each base. Anything that is not A, C, G or T (either case) gets code 0,
+# and the whole primer is stored as text in exceptions.json instead
+_base_codes = numpy.zeros(256, dtype=numpy.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    _base_codes[_base] = _code
+    _base_codes[_base + 32] = _code
+_bases = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)
+_shifts = numpy.array([0, 2, 4, 6], dtype=numpy.uint8)
+# the four bases packed into each possible byte
+_byte_bases = [''.join(['ACGT'[(x >> y) & 3] for y in [0, 2, 4, 6]]) for x in range(256)]
+
+# Number of primer pairs decoded at once when reading all of a catalog
+chunk_size = 100000
+
+
+def is_binary_catalog(catalog_dir):
+    # info.json is written last by Writer.close(), so a crash part way
+    # through writing cannot leave a catalog that looks finished
+    return all(os.path.exists(os.path.join(catalog_dir, x)) for x in catalog_files)
+
+
+# Length of the header of each .npy file written by Writer, which is the same
+# whatever the shape of the array (and a multiple of 64 bytes, like numpy's own headers)
+_npy_header_length = 128
+
+
+# Writes the header of a .npy file of an array of the given dtype and shape,
+# padded to _npy_header_length bytes
+def _write_npy_header(f, dtype, shape):
+    header = repr({'descr': numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)), 'fortran_order': False, 'shape': tuple(shape)}).encode('latin1')
+    prefix = numpy.lib.format.magic(1, 0) + struct.pack('<H', _npy_header_length - 10)
+    f.write(prefix + header.ljust(_npy_header_length - len(prefix) - 1) + b'\n')
+
+
+# Writes the primer pairs of one genome to the directory catalog_dir, as the same
+# primers as in the FASTA file written by primer3.Primer3, but in a form that can be
+# loaded without parsing text:
+#   pairs.npy: one row per pair: contig ID, primer3 index, left start, right start
+#   contig_names.txt: name of each contig ID, one per line
+#   sequences.npy: all primer sequences (left then right primer of each pair)
+#     joined together, 2 bits per base, 4 bases per byte, first base in the lowest bits
+#   offsets.npy: start of each primer in sequences.npy (in bases), plus the total length
+#   lower_case.npy: one bit per base (numpy.packbits), set if the base is lower case
+#   exceptions.json: primer ID -> sequence of primers with bases other than A, C, G, T
+# Primer IDs are the same as in primer_catalog.PrimerCatalog: 2i and 2i + 1 for pair i.
+# The arrays are appended to their files when there are batch_size primer pairs
+# waiting, and the .npy headers are written by close(), when the shapes are known
+class Writer:
+    def __init__(self, catalog_dir, genome_name, batch_size=100000):
+        self.catalog_dir = os.path.abspath(catalog_dir)
+        self.genome_name = genome_name
+        self.batch_size = batch_size
+        self.contig_ids = {}
+        self.exceptions = {}
+        self.number_of_pairs = 0
+        self.number_of_primers = 0
+        self.number_of_bases = 0
+        self.pairs = array.array('q')
+        self.offsets = array.array('q', [0])
+        self.sequences = bytearray()
+
+        if os.path.exists(self.catalog_dir):
+            shutil.rmtree(self.catalog_dir)
+        os.mkdir(self.catalog_dir)
+        self.contig_names_file = open(os.path.join(self.catalog_dir, 'contig_names.txt'), 'w')
+        self.npy_files = {x: open(os.path.join(self.catalog_dir, x + '.npy'), 'wb') for x in ['pairs', 'offsets', 'sequences', 'lower_case']}
+        for f in self.npy_files.values():
+            f.write(b'\0' * _npy_header_length)
+
+
+    def add(self, primer_pair):
+        if primer_pair.sequence_id not in self.contig_ids:
+            self.contig_ids[primer_pair.sequence_id] = len(self.contig_ids)
+            print(primer_pair.sequence_id, file=self.contig_names_file)
+        self.pairs.extend([self.contig_ids[primer_pair.sequence_id], primer_pair.index, primer_pair.left_start, primer_pair.right_start])
+        self.number_of_pairs += 1
+
+        for seq in [primer_pair.left_seq, primer_pair.right_seq]:
+            data = seq.encode()
+            if len(data.translate(None, b'ACGTacgt')):
+                self.exceptions[str(self.number_of_primers)] = seq
+            self.number_of_primers += 1
+            self.number_of_bases += len(data)
+            self.offsets.append(self.number_of_bases)
+            self.sequences.extend(data)
+
+        if len(self.pairs) >= 4 * self.batch_size:
+            self._write_batch()
+
+
+    # Appends the waiting pairs, offsets and sequences to their files. Bases are
+    # packed 4 per byte into sequences.npy and 8 per byte into lower_case.npy, so a
+    # multiple of 8 bases is written, and the rest are kept for next time,
+    # unless this is the last batch
+    def _write_batch(self, last=False):
+        self.npy_files['pairs'].write(self.pairs.tobytes())
+        self.npy_files['offsets'].write(self.offsets.tobytes())
+        self.pairs = array.array('q')
+        self.offsets = array.array('q')
+
+        end = len(self.sequences) if last else 8 * (len(self.sequences) // 8)
+        sequence = numpy.frombuffer(bytes(self.sequences[:end]), dtype=numpy.uint8)
+        codes = numpy.zeros(4 * math.ceil(len(sequence) / 4), dtype=numpy.uint8)
+        codes[:len(sequence)] = _base_codes[sequence]
+        packed = codes[0::4] | (codes[1::4] << 2) | (codes[2::4] << 4) | (codes[3::4] << 6)
+        self.npy_files['sequences'].write(packed.tobytes())
+        self.npy_files['lower_case'].write(numpy.packbits(sequence >= ord('a')).tobytes())
+        del self.sequences[:end]
+
+
+    def close(self):
+        self._write_batch(last=True)
+        shapes = {
+            'pairs': (numpy.int64, (self.number_of_pairs, 4)),
+            'offsets': (numpy.int64, (self.number_of_primers + 1,)),
+            'sequences': (numpy.uint8, (math.ceil(self.number_of_bases / 4),)),
+            'lower_case': (numpy.uint8, (math.ceil(self.number_of_bases / 8),)),
+        }
+        for name, f in self.npy_files.items():
+            f.seek(0)
+            _write_npy_header(f, *shapes[name])
+            f.close()
+        self.contig_names_file.close()
+
+        with open(os.path.join(self.catalog_dir, 'exceptions.json'), 'w') as f:
+            json.dump(self.exceptions, f)
+        with open(os.path.join(self.catalog_dir, 'info.json'), 'w') as f:
+            json.dump({'format_version': format_version, 'genome_name': self.genome_name, 'number_of_pairs': self.number_of_pairs}, f)
+
+
+# A catalog written by Writer. The arrays are memory mapped, so opening
+# it takes the same time however many primers it has
+class BinaryCatalog:
+    def __init__(self, catalog_dir):
+        self.catalog_dir = os.path.abspath(catalog_dir)
+        if not is_binary_catalog(self.catalog_dir):
+            raise Error('Binary primer catalog not found: ' + self.catalog_dir)
+
+        with open(os.path.join(self.catalog_dir, 'info.json')) as f:
+            info = json.load(f)
+        if info.get('format_version', None) != format_version:
+            raise Error('Binary primer catalog ' + self.catalog_dir + ' was made by a different version of primer3tools. Please remake it')
+
+        self.genome_name = info['genome_name']
+        self.pairs = numpy.load(os.path.join(self.catalog_dir, 'pairs.npy'), mmap_mode='r')
+        self.offsets = numpy.load(os.path.join(self.catalog_dir, 'offsets.npy'), mmap_mode='r')
+        self.packed_sequences = numpy.load(os.path.join(self.catalog_dir, 'sequences.npy'), mmap_mode='r')
+        self.lower_case = numpy.load(os.path.join(self.catalog_dir, 'lower_case.npy'), mmap_mode='r')
+        self.packed_bytes = memoryview(self.packed_sequences)
+        with open(os.path.join(self.catalog_dir, 'contig_names.txt')) as f:
+            self.contig_names = [x.rstrip('\n') for x in f]
+        with open(os.path.join(self.catalog_dir, 'exceptions.json')) as f:
+            self.exceptions = {int(k): v for k, v in json.load(f).items()}
+
+        if len(self.pairs) != info['number_of_pairs'] or len(self.offsets) != 2 * len(self.pairs) + 1:
+            raise Error('Error loading binary primer catalog ' + self.catalog_dir + '. Number of primers does not match info.json')
+
+
+    # Opened again from its files when pickled (for example, to give to another
+    # process), instead of copying the arrays
+    def __reduce__(self):
+        return BinaryCatalog, (self.catalog_dir,)
+
+
+    def __len__(self):
+        return len(self.pairs)
+
+
+    # Returns the bases from start to end (positions in the joined sequence of all primers),
+    # in upper case, or with the case that primer3 reported if upper is False
+    def _decode(self, start, end, upper=False):
+        if end <= start:
+            return ''
+        # for a single primer, looking up each byte in Python is faster than making numpy arrays
+        if upper and end - start <= 64:
+            first = start // 4
+            return ''.join([_byte_bases[x] for x in self.packed_bytes[first:(end + 3) // 4]])[start - 4 * first:end - 4 * first]
+
+        codes = (self.packed_sequences[start // 4:(end + 3) // 4, None] >> _shifts) & 3
+        letters = _bases[codes.ravel()[start % 4:start % 4 + end - start]]
+        if not upper:
+            lower_case = numpy.unpackbits(self.lower_case[start // 8:(end + 7) // 8])[start % 8:start % 8 + end - start]
+            letters[lower_case.astype(bool)] += 32
+        return letters.tobytes().decode()
+
+
+    def _name(self, genome_name, contig_id, index, left_start, right_start):
+        return '__'.join([genome_name, self.contig_names[contig_id], str(index), str(left_start), str(right_start)])
+
+
+    # Name of a primer pair, without the trailing /1 or /2 (see primer_pair.PrimerPair.name)
+    def name(self, pair_id):
+        return self._name(self.genome_name, *self.pairs[pair_id].tolist())
+
+
+    # Returns a list of the names of primer pairs start to end - 1 (all of them by default)
+    def names(self, start=0, end=None):
+        return [self._name(self.genome_name, *x) for x in self.pairs[start:end].tolist()]
+
+
+    # Sequence of a primer, with the same case as primer3 reported it, or upper case
+    def sequence(self, primer_id, upper=False):
+        if primer_id in self.exceptions:
+            seq = self.exceptions[primer_id]
+            return seq.upper() if upper else seq
+        return self._decode(int(self.offsets[primer_id]), int(self.offsets[primer_id + 1]), upper=upper)
+
+
+    # Returns a list of the sequences of primers start to end - 1 (all of them by default),
+    # in the same way as sequence()
+    def sequences(self, start=0, end=None, upper=False):
+        end = len(self.offsets) - 1 if end is None else end
+        offsets = self.offsets[start:end + 1].tolist()
+        if len(offsets) < 2:
+            return []
+        joined = self._decode(offsets[0], offsets[-1], upper=upper)
+        sequences = [joined[offsets[i] - offsets[0]:offsets[i + 1] - offsets[0]] for i in range(len(offsets) - 1)]
+        for primer_id, seq in self.exceptions.items():
+            if start <= primer_id < end:
+                sequences[primer_id - start] = seq.upper() if upper else seq
+        return sequences
+
+
+    # Yields lines of a fasta file of all the primer pairs, the same as
+    # primer_catalog.PrimerCatalog.fasta_lines(). They are decoded a chunk at a time
+    def fasta_lines(self):
+        for start in range(0, len(self), chunk_size):
+            sequences = self.sequences(2 * start, 2 * (start + chunk_size))
+            for i, name in enumerate(self.names(start, start + chunk_size)):
+                yield '>' + name + '/1\n' + sequences[2 * i] + '\n'
+                yield '>' + name + '/2\n' + sequences[2 * i + 1] + '\n'
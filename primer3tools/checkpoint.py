@@ -0,0 +1,147 @@
+import os
+import hashlib
+import zipfile
+import numpy
+import numpy.lib.format
+from primer3tools import hit_table
+
+
+class Error (Exception): pass
+
+
+# Columns of each part of the hits in a checkpoint file
+_part_columns = ['primer_ids', 'contig_ids', 'starts', 'is_reverse', 'contig_names']
+
+
+# The perfect hits of a set of primer pairs to one bowtie2 index, saved after
+# mapping so that later runs only need to map primer pairs that are new.
+# index_hash and primers_hash are content hashes of the index and of the primer
+# set that was mapped. pair_keys are the keys (see PrimerCatalog.pair_keys) of
+# every primer pair that was mapped, whether or not it had any hits. Primer IDs
+# in hits are 2i and 2i + 1 for the left and right primer with key pair_keys[i].
+# Checkpoint files are written by Writer, with the hits split into parts. A
+# checkpoint made by load() only reads each part from the file when it is
+# needed (see hit_tables), so its hits are None
+class MappingCheckpoint:
+    def __init__(self, index_hash, primers_hash, pair_keys, hits):
+        self.index_hash = index_hash
+        self.primers_hash = primers_hash
+        self.pair_keys = numpy.asarray(pair_keys, dtype=numpy.uint64)
+        self.hits = hits
+        self.filename = None
+        # suffix of the names of the arrays of each part in the file
+        self.part_suffixes = []
+
+
+    # Yields the hits one part at a time, as HitTables
+    def hit_tables(self):
+        if self.filename is None:
+            yield self.hits
+            return
+
+        with numpy.load(self.filename) as data:
+            for suffix in self.part_suffixes:
+                try:
+                    primer_ids, contig_ids, starts, is_reverse, contig_names = [data[x + suffix] for x in _part_columns]
+                except:
+                    raise Error('Error loading checkpoint file ' + self.filename)
+                hits = hit_table.HitTable()
+                hits.add_columns(primer_ids, contig_ids, starts, is_reverse, contig_names.tolist())
+                yield hits
+
+
+    # Returns the new pair ID of each primer pair in this checkpoint, which is its index
+    # in pair_keys or -1 if it is not there, and a boolean array of which of pair_keys
+    # are in this checkpoint
+    def _new_pair_ids(self, pair_keys):
+        pair_keys = numpy.asarray(pair_keys, dtype=numpy.uint64)
+        order = numpy.argsort(self.pair_keys, kind='stable')
+        sorted_keys = self.pair_keys[order]
+        positions = numpy.minimum(numpy.searchsorted(sorted_keys, pair_keys), max(len(sorted_keys) - 1, 0))
+        found = numpy.zeros(len(pair_keys), dtype=bool) if len(sorted_keys) == 0 else sorted_keys[positions] == pair_keys
+        new_pair_ids = numpy.full(len(self.pair_keys), -1, dtype=numpy.int64)
+        new_pair_ids[order[positions[found]]] = numpy.flatnonzero(found)
+        return new_pair_ids, found
+
+
+    # Returns a boolean array of which of the keys (usually those of the current
+    # primer catalog) are in this checkpoint
+    def found_pair_keys(self, pair_keys):
+        return self._new_pair_ids(pair_keys)[1]
+
+
+    # Yields the hits of the primer pairs with the given keys, one part at a time, with
+    # primer IDs changed to be indexes of those keys. Parts with none of the hits are skipped
+    def hit_tables_for_pair_keys(self, pair_keys):
+        new_pair_ids = self._new_pair_ids(pair_keys)[0]
+        for part_hits in self.hit_tables():
+            primer_ids, contig_ids, starts, is_reverse = part_hits.columns()
+            hit_pair_ids = new_pair_ids[primer_ids // 2]
+            rows = hit_pair_ids >= 0
+            if rows.any():
+                hits = hit_table.HitTable()
+                hits.add_columns(2 * hit_pair_ids[rows] + primer_ids[rows] % 2, contig_ids[rows], starts[rows], is_reverse[rows], part_hits.contig_names)
+                yield hits
+
+
+# Writes a checkpoint file (see MappingCheckpoint) a HitTable at a time, so that all
+# the hits do not need to be in memory. Each HitTable is saved as one part of the
+# file, and must have all the hits of its primer pairs. Primer IDs of the hits are of
+# pair_keys. mapped is a boolean array with one element per key, of the primer pairs
+# that were mapped (all of them if it is None), which must be the only primer pairs
+# with hits. Only the mapped pairs are kept, and the primers hash is made from their
+# keys, in the same way as PrimerCatalog.content_hash(). The file is written to a
+# temporary file, which is renamed by close(), so that a crash never leaves a partly
+# written checkpoint
+class Writer:
+    def __init__(self, filename, index_hash, pair_keys, mapped=None):
+        self.filename = filename
+        self.tmp_file = filename + '.tmp.npz'
+        self.index_hash = index_hash
+        pair_keys = numpy.asarray(pair_keys, dtype=numpy.uint64)
+        mapped = numpy.ones(len(pair_keys), dtype=bool) if mapped is None else numpy.asarray(mapped, dtype=bool)
+        self.pair_keys = pair_keys[mapped]
+        self.new_pair_ids = numpy.cumsum(mapped) - 1
+        self.primers_hash = hashlib.sha256(self.pair_keys.tobytes()).hexdigest()
+        self.number_of_parts = 0
+        self.zip_file = zipfile.ZipFile(self.tmp_file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+
+    # Writes an array to the file, in the same way as numpy.savez_compressed
+    def _write_array(self, name, array):
+        with self.zip_file.open(name + '.npy', 'w', force_zip64=True) as f:
+            numpy.lib.format.write_array(f, numpy.asanyarray(array), allow_pickle=False)
+
+
+    def add(self, hits):
+        primer_ids, contig_ids, starts, is_reverse = hits.columns()
+        primer_ids = 2 * self.new_pair_ids[primer_ids // 2] + primer_ids % 2
+        for name, column in zip(_part_columns, [primer_ids, contig_ids, starts, is_reverse, numpy.array(hits.contig_names, dtype=str)]):
+            self._write_array(name + '.' + str(self.number_of_parts), column)
+        self.number_of_parts += 1
+
+
+    def close(self):
+        self._write_array('index_hash', numpy.array(self.index_hash))
+        self._write_array('primers_hash', numpy.array(self.primers_hash))
+        self._write_array('pair_keys', self.pair_keys)
+        self._write_array('number_of_parts', numpy.array(self.number_of_parts))
+        self.zip_file.close()
+        os.replace(self.tmp_file, self.filename)
+
+
+# Returns the MappingCheckpoint in a file. Only the primer pair keys and hashes are
+# read now, and the hits are read a part at a time by its hit_tables(). Files
+# written before the hits were split into parts are read as one part
+def load(filename):
+    try:
+        with numpy.load(filename) as data:
+            checkpoint = MappingCheckpoint(str(data['index_hash']), str(data['primers_hash']), data['pair_keys'], None)
+            if 'number_of_parts' in data.files:
+                checkpoint.part_suffixes = ['.' + str(i) for i in range(int(data['number_of_parts']))]
+            else:
+                checkpoint.part_suffixes = ['']
+    except:
+        raise Error('Error loading checkpoint file ' + filename)
+    checkpoint.filename = filename
+    return checkpoint
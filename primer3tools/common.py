@@ -1,28 +1,159 @@
+import os
 import sys
+import contextlib
+import hashlib
+import json
 import subprocess
+import threading
+import time
+from primer3tools import metrics
 
 class Error (Exception): pass
 
 version = '0.0.2'
 
+# How long syscall_stream() waits for a command to exit on its own, when reading its output fails
+stream_exit_wait_seconds = 1
+
+
+def _report_failed_command_and_exit(cmd, returncode, errors):
+    print('The following command failed with exit code', returncode, file=sys.stderr)
+    print(cmd, file=sys.stderr)
+    print('\nThe output was:\n', file=sys.stderr)
+    print(errors, file=sys.stderr, flush=True)
+    sys.exit(1)
+
+
+# Waits for process to finish, and records its resource usage (including any
+# processes it ran, such as the commands of a pipe) in metrics.child_processes
+def _wait_and_record_metrics(process, cmd, start_time):
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    metrics.record_child_process(cmd, time.perf_counter() - start_time, rusage)
 
 
 def syscall(cmd, allow_fail=False, verbose=False):
     if verbose:
         print('syscall:', cmd, flush=True)
-    try:
-        subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as error:
-        errors = error.output.decode()
+
+    start_time = time.perf_counter()
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    process.stdout.close()
+    _wait_and_record_metrics(process, cmd, start_time)
+
+    if process.returncode != 0:
+        errors = output.decode()
         if allow_fail:
             return False, errors
         else:
-            print('The following command failed with exit code', error.returncode, file=sys.stderr)
-            print(cmd, file=sys.stderr)
-            print('\nThe output was:\n', file=sys.stderr)
-            print(errors, file=sys.stderr, flush=True)
-            sys.exit(1)
+            _report_failed_command_and_exit(cmd, process.returncode, errors)
 
     return True, None
 
 
+def _write_lines_to_filehandle(lines, filehandle):
+    try:
+        for line in lines:
+            filehandle.write(line.encode())
+        filehandle.close()
+    except BrokenPipeError:
+        # the command exited early. Its exit code and stderr are reported instead
+        pass
+
+
+def _read_filehandle_into_list(filehandle, output):
+    output.append(filehandle.read())
+
+
+# Returns True if process exits within seconds. The process is not reaped,
+# so that _wait_and_record_metrics() can still get its resource usage
+def _exits_within(process, seconds):
+    end_time = time.perf_counter() + seconds
+    while True:
+        if os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+            return True
+        if time.perf_counter() > end_time:
+            return False
+        time.sleep(0.01)
+
+
+# Runs cmd, writing stdin_lines (an iterable of strings) to its stdin, and
+# yields its stdout as a binary filehandle. The whole command fails if any
+# command in a pipe fails, and failure is reported the same way as syscall()
+@contextlib.contextmanager
+def syscall_stream(cmd, stdin_lines=None, verbose=False):
+    if verbose:
+        print('syscall:', cmd, flush=True)
+
+    start_time = time.perf_counter()
+    process = subprocess.Popen(
+        'set -o pipefail; ' + cmd,
+        shell=True,
+        executable='/bin/bash',
+        stdin=subprocess.DEVNULL if stdin_lines is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    stderr = []
+    threads = [threading.Thread(target=_read_filehandle_into_list, args=(process.stderr, stderr))]
+    if stdin_lines is not None:
+        threads.append(threading.Thread(target=_write_lines_to_filehandle, args=(stdin_lines, process.stdin)))
+    for thread in threads:
+        thread.start()
+
+    def finish():
+        process.stdout.close()
+        _wait_and_record_metrics(process, cmd, start_time)
+        for thread in threads:
+            thread.join()
+
+    try:
+        yield process.stdout
+    except BaseException:
+        # reading the output can fail because the command failed, for example
+        # pysam cannot read a SAM header if bowtie2 exits without writing one.
+        # Then the command's own exit code and stderr are reported, which say why.
+        # Otherwise the command is still running, so it is killed
+        exited = _exits_within(process, stream_exit_wait_seconds)
+        if not exited:
+            process.kill()
+        finish()
+        if exited and process.returncode != 0:
+            _report_failed_command_and_exit(cmd, process.returncode, stderr[0].decode())
+        raise
+
+    finish()
+    if process.returncode != 0:
+        _report_failed_command_and_exit(cmd, process.returncode, stderr[0].decode())
+
+
+def sha256_of_files(filenames, chunk_size=1048576):
+    sha = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Returns the same as sha256_of_files(filenames), but without reading the files if
+# none of them have changed size or modification time since the checksum was saved
+# in cache_file. The checksum is saved in cache_file when it is calculated
+def cached_sha256_of_files(filenames, cache_file):
+    stats = [[os.path.abspath(x), os.stat(x).st_size, os.stat(x).st_mtime_ns] for x in filenames]
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached['files'] == stats:
+            return cached['sha256']
+    except:
+        pass
+
+    sha256 = sha256_of_files(filenames)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'files': stats, 'sha256': sha256}, f)
+    os.replace(tmp_file, cache_file)
+    return sha256
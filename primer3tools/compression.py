@@ -0,0 +1,101 @@
+import gzip
+import shutil
+import subprocess
+
+
+class Error (Exception): pass
+
+
+codecs = ['gzip', 'pigz', 'none']
+gzip_magic = b'\x1f\x8b'
+
+
+def check_codec(codec, level):
+    if codec not in codecs:
+        raise Error('Compression codec must be one of ' + ', '.join(codecs) + '. Got: ' + str(codec))
+    if codec != 'none' and not 1 <= level <= 9:
+        raise Error('Compression level must be from 1 to 9. Got: ' + str(level))
+    if codec == 'pigz' and shutil.which('pigz') is None:
+        raise Error('pigz not found in path. It is needed for pigz compression')
+
+
+# Returns a command that compresses stdin to stdout, for use in a pipe
+def compress_command(codec='gzip', level=9, threads=1):
+    check_codec(codec, level)
+    if codec == 'gzip':
+        return 'gzip -' + str(level) + ' -c'
+    elif codec == 'pigz':
+        return 'pigz -p ' + str(threads) + ' -' + str(level) + ' -c'
+    else:
+        return 'cat'
+
+
+# A file being written through a command that compresses it. close() waits for
+# the command to finish, and raises Error if it failed, so that a truncated
+# file is never mistaken for a complete one
+class _CompressedWriter:
+    def __init__(self, filename, cmd):
+        self.filename = filename
+        self.cmd = cmd
+        with open(filename, 'wb') as f:
+            self.process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=f, universal_newlines=True)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def write(self, text):
+        return self.process.stdin.write(text)
+
+
+    def writelines(self, lines):
+        self.process.stdin.writelines(lines)
+
+
+    def close(self):
+        if self.process.returncode is not None:
+            return
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # the command exited early. Its exit code is reported instead
+            pass
+        if self.process.wait() != 0:
+            raise Error('Error writing compressed file ' + self.filename + '. The following command failed with exit code ' + str(self.process.returncode) + ':\n' + self.cmd)
+
+
+# Opens a file for writing text. As for pyfastaq.utils.open_file_write(), files
+# ending in .gz are compressed, but here with the given codec. The name of the
+# file does not change with the codec, so that other code can always find it.
+# Use open_read() to read it back
+def open_write(filename, codec='gzip', level=9, threads=1):
+    check_codec(codec, level)
+    if codec == 'none' or not filename.endswith('.gz'):
+        return open(filename, 'w')
+
+    try:
+        return _CompressedWriter(filename, compress_command(codec, level, threads))
+    except:
+        raise Error('Error opening for writing compressed file ' + filename)
+
+
+def is_gzipped(filename):
+    with open(filename, 'rb') as f:
+        return f.read(2) == gzip_magic
+
+
+# Opens a file for reading text, whatever codec it was written with (pigz writes gzip format).
+# The codec is found from the start of the file, not from the filename
+def open_read(filename):
+    try:
+        if is_gzipped(filename):
+            return gzip.open(filename, 'rt')
+        else:
+            return open(filename)
+    except:
+        raise Error('Error opening for reading file ' + filename)
@@ -0,0 +1,247 @@
+import os
+import json
+import numpy
+import pyfastaq
+from primer3tools import hit_table
+
+
+class Error (Exception): pass
+
+
+# Increase this when the files written by build() change, so that old indexes are rebuilt
+format_version = 1
+default_kmer_length = 12
+# k-mers are stored as 2 bits per base in numpy.uint32, so cannot be longer than this.
+# This limits the k-mers in the index, not the primers: primers at least as long as
+# the k-mers are looked up by their first k bases, and the rest of each primer is
+# then compared with the genome
+max_kmer_length = 16
+contig_separator = b'$'
+index_files = ['sequence.npy', 'contig_starts.npy', 'contig_names.txt', 'kmers.npy', 'positions.npy', 'info.json']
+
+# 2-bit code of each base, or 255 for anything that is not A, C, G or T.
+# Upper case only, because sequences are made upper case before encoding
+_base_codes = numpy.full(256, 255, dtype=numpy.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    _base_codes[_base] = _code
+_complement = bytes.maketrans(b'ACGT', b'TGCA')
+
+
+def is_exact_indexed(index_dir):
+    # info.json is written last by build(), so a crash part way
+    # through building cannot leave an index that looks finished
+    return all(os.path.exists(os.path.join(index_dir, x)) for x in index_files)
+
+
+def _reverse_complement(seq):
+    return seq.translate(_complement)[::-1]
+
+
+def _check_kmer_length(kmer_length):
+    if not 1 <= kmer_length <= max_kmer_length:
+        raise Error('k-mer length must be from 1 to ' + str(max_kmer_length) + '. Got: ' + str(kmer_length))
+
+
+# Returns the k-mer starting at each position of sequence (a numpy array of
+# upper case ASCII codes) as an integer, and whether each k-mer is all A, C, G, T
+def _kmer_values(sequence, kmer_length):
+    _check_kmer_length(kmer_length)
+    codes = _base_codes[sequence]
+    number_of_kmers = max(len(sequence) - kmer_length + 1, 0)
+    values = numpy.zeros(number_of_kmers, dtype=numpy.uint32)
+    invalid = numpy.zeros(number_of_kmers, dtype=bool)
+
+    for i in range(kmer_length):
+        window = codes[i:i + number_of_kmers]
+        invalid |= window == 255
+        values <<= 2
+        values |= window & 3
+
+    return values, ~invalid
+
+
+# Makes an index of all k-mers in a FASTA file, in the directory index_dir.
+# The contigs are stored as one sequence, separated by a character that
+# never matches a primer, so that a match cannot span two contigs
+def build(fasta_file, index_dir, kmer_length=default_kmer_length):
+    _check_kmer_length(kmer_length)
+
+    if not os.path.exists(index_dir):
+        os.mkdir(index_dir)
+
+    contig_names = []
+    contig_starts = [0]
+    sequences = []
+    for seq in pyfastaq.sequences.file_reader(fasta_file):
+        # bowtie2 uses the name up to the first whitespace, so do the same
+        contig_names.append(seq.id.split()[0])
+        sequences.append(seq.seq.upper().encode())
+        sequences.append(contig_separator)
+        contig_starts.append(contig_starts[-1] + len(seq) + 1)
+
+    sequence = numpy.frombuffer(b''.join(sequences), dtype=numpy.uint8)
+    values, valid = _kmer_values(sequence, kmer_length)
+    positions = numpy.flatnonzero(valid)
+    values = values[positions]
+    order = numpy.argsort(values, kind='stable')
+    position_type = numpy.uint32 if len(sequence) < 2**32 else numpy.int64
+
+    numpy.save(os.path.join(index_dir, 'sequence.npy'), sequence)
+    numpy.save(os.path.join(index_dir, 'contig_starts.npy'), numpy.array(contig_starts, dtype=numpy.int64))
+    with open(os.path.join(index_dir, 'contig_names.txt'), 'w') as f:
+        for name in contig_names:
+            print(name, file=f)
+    numpy.save(os.path.join(index_dir, 'kmers.npy'), values[order])
+    numpy.save(os.path.join(index_dir, 'positions.npy'), positions[order].astype(position_type))
+    with open(os.path.join(index_dir, 'info.json'), 'w') as f:
+        json.dump({'format_version': format_version, 'kmer_length': kmer_length}, f)
+
+
+# Finds every exact match of primers (forwards and reverse complement) using
+# an index made by build(). The index files are memory mapped, so that several
+# processes using the same index share one copy of it in memory
+class ExactIndex:
+    def __init__(self, index_dir, max_candidates=1000000):
+        self.index_dir = os.path.abspath(index_dir)
+        self.max_candidates = max_candidates
+        if not is_exact_indexed(self.index_dir):
+            raise Error('Exact match index not found: ' + self.index_dir)
+
+        with open(os.path.join(self.index_dir, 'info.json')) as f:
+            info = json.load(f)
+        if info.get('format_version', None) != format_version:
+            raise Error('Exact match index ' + self.index_dir + ' was made by a different version of primer3tools. Please remake it')
+
+        self.kmer_length = info['kmer_length']
+        _check_kmer_length(self.kmer_length)
+        self.sequence = numpy.load(os.path.join(self.index_dir, 'sequence.npy'), mmap_mode='r')
+        self.contig_starts = numpy.load(os.path.join(self.index_dir, 'contig_starts.npy'))
+        self.kmers = numpy.load(os.path.join(self.index_dir, 'kmers.npy'), mmap_mode='r')
+        self.positions = numpy.load(os.path.join(self.index_dir, 'positions.npy'), mmap_mode='r')
+        with open(os.path.join(self.index_dir, 'contig_names.txt')) as f:
+            self.contig_names = [x.rstrip('\n') for x in f]
+
+
+    # Returns positions in the sequence of all matches to seq (which is shorter than the
+    # k-mer length, so cannot be looked up in the index). This is slow, but primers
+    # are almost never this short
+    def _short_query_positions(self, seq):
+        if not hasattr(self, '_sequence_bytes'):
+            self._sequence_bytes = self.sequence.tobytes()
+
+        positions = []
+        position = self._sequence_bytes.find(seq)
+        while position != -1:
+            positions.append(position)
+            position = self._sequence_bytes.find(seq, position + 1)
+        return positions
+
+
+    # Returns the positions in the sequence of matches of the queries, which must
+    # all have length query_length (at least the k-mer length) and only contain
+    # A, C, G, T. Also returns which query each position is a match for.
+    # query_array is a 2d array of ASCII codes, one row per query
+    def _query_positions(self, query_array, query_length):
+        if query_length < self.kmer_length:
+            raise Error('Queries looked up in the index must be at least as long as its k-mers (' + str(self.kmer_length) + '). Got length ' + str(query_length))
+        codes = _base_codes[query_array[:, :self.kmer_length]].astype(numpy.uint32)
+        query_values = numpy.zeros(len(query_array), dtype=numpy.uint32)
+        for i in range(self.kmer_length):
+            query_values = (query_values << 2) | codes[:, i]
+        first = numpy.searchsorted(self.kmers, query_values, side='left')
+        counts = numpy.searchsorted(self.kmers, query_values, side='right') - first
+
+        found_queries = []
+        found_positions = []
+        offsets = numpy.arange(self.kmer_length, query_length, dtype=numpy.int64)
+        query_start = 0
+
+        # check candidates in chunks of queries, so that memory use is bounded
+        while query_start < len(counts):
+            query_end = query_start + 1
+            total = int(counts[query_start])
+            while query_end < len(counts) and total + counts[query_end] <= self.max_candidates:
+                total += int(counts[query_end])
+                query_end += 1
+
+            chunk_counts = counts[query_start:query_end]
+            chunk_starts = numpy.cumsum(chunk_counts) - chunk_counts
+            candidate_queries = numpy.repeat(numpy.arange(query_start, query_end, dtype=numpy.int64), chunk_counts)
+            candidate_indexes = numpy.arange(total, dtype=numpy.int64) - numpy.repeat(chunk_starts, chunk_counts) + numpy.repeat(first[query_start:query_end], chunk_counts)
+            candidate_positions = self.positions[candidate_indexes].astype(numpy.int64)
+
+            # the first k bases match already, so only check the rest
+            if len(offsets) and total > 0:
+                in_sequence = candidate_positions + query_length <= len(self.sequence)
+                candidate_queries = candidate_queries[in_sequence]
+                candidate_positions = candidate_positions[in_sequence]
+                windows = self.sequence[candidate_positions[:, None] + offsets]
+                matches = (windows == query_array[candidate_queries][:, offsets]).all(axis=1)
+                candidate_queries = candidate_queries[matches]
+                candidate_positions = candidate_positions[matches]
+
+            found_queries.append(candidate_queries)
+            found_positions.append(candidate_positions)
+            query_start = query_end
+
+        return numpy.concatenate(found_queries), numpy.concatenate(found_positions)
+
+
+    # Returns a HitTable of all exact matches of the primers with the given primer IDs.
+    # Primers can be any length: those shorter than the k-mers are searched for in
+    # the whole sequence instead of being looked up in the index. Primers with bases
+    # other than A, C, G, T never match, as for perfect hits from bowtie2.
+    # Hits are sorted by primer ID, then contig, then position
+    def hit_table(self, catalog, primer_ids):
+        queries = {}
+        for primer_id in primer_ids:
+            seq = catalog.sequences[primer_id].encode()
+            if len(seq) == 0 or len(seq.translate(None, b'ACGT')) > 0:
+                continue
+            queries.setdefault(len(seq), []).append((primer_id, False, seq))
+            reverse = _reverse_complement(seq)
+            # a palindromic primer only gets one hit at each position, as from bowtie2
+            if reverse != seq:
+                queries[len(seq)].append((primer_id, True, reverse))
+
+        hit_primer_ids = [numpy.zeros(0, dtype=numpy.int64)]
+        hit_is_reverse = [numpy.zeros(0, dtype=bool)]
+        hit_positions = [numpy.zeros(0, dtype=numpy.int64)]
+
+        for query_length, length_queries in sorted(queries.items()):
+            if query_length < self.kmer_length:
+                for primer_id, is_reverse, seq in length_queries:
+                    positions = self._short_query_positions(seq)
+                    hit_primer_ids.append(numpy.full(len(positions), primer_id, dtype=numpy.int64))
+                    hit_is_reverse.append(numpy.full(len(positions), is_reverse, dtype=bool))
+                    hit_positions.append(numpy.array(positions, dtype=numpy.int64))
+            else:
+                query_array = numpy.frombuffer(b''.join([x[2] for x in length_queries]), dtype=numpy.uint8).reshape(len(length_queries), query_length)
+                query_indexes, positions = self._query_positions(query_array, query_length)
+                hit_primer_ids.append(numpy.array([x[0] for x in length_queries], dtype=numpy.int64)[query_indexes])
+                hit_is_reverse.append(numpy.array([x[1] for x in length_queries], dtype=bool)[query_indexes])
+                hit_positions.append(positions)
+
+        primer_ids = numpy.concatenate(hit_primer_ids)
+        is_reverse = numpy.concatenate(hit_is_reverse)
+        positions = numpy.concatenate(hit_positions)
+        order = numpy.lexsort((is_reverse, positions, primer_ids))
+        primer_ids, is_reverse, positions = primer_ids[order], is_reverse[order], positions[order]
+        contig_ids = numpy.searchsorted(self.contig_starts, positions, side='right') - 1
+        starts = positions - self.contig_starts[contig_ids]
+        hits = hit_table.HitTable()
+        hits.add_columns(primer_ids, contig_ids, starts, is_reverse, self.contig_names)
+        return hits
+
+
+    # Yields HitTables of all exact matches of the given primer pairs (or all
+    # pairs in the catalog if pair_ids is None), looking up batch_size pairs at a time
+    def hit_tables(self, catalog, pair_ids=None, batch_size=10000):
+        if pair_ids is None:
+            pair_ids = range(len(catalog))
+
+        for i in range(0, len(pair_ids), batch_size):
+            batch = pair_ids[i:i + batch_size]
+            hits = self.hit_table(catalog, [2 * x + y for x in batch for y in (0, 1)])
+            if len(hits):
+                yield hits
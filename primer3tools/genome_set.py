@@ -1,4 +1,5 @@
 import os
+import pyfastaq
 
 
 class Error (Exception): pass
@@ -53,3 +54,12 @@ class GenomeSet:
     def __iter__(self):
         for key in self.genomes:
             yield key
+
+
+def write_combined_fasta(genomes, genome_names, outfile, separator='__'):
+    with open(outfile, 'w') as f_out:
+        for genome_name in sorted(genome_names):
+            file_reader = pyfastaq.sequences.file_reader(genomes[genome_name].fasta_file)
+            for seq in file_reader:
+                seq.id = genome_name + separator + seq.id
+                print(seq, file=f_out)
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+
+
+class Error (Exception): pass
+
+
+# Tables of the database. There is one row per primer pair, and one row per match
+# of a primer pair that would make a PCR product (the same as each hit in
+# all_primers.hits.tsv). Positions are 1-based and strands are '+' or '-'
+schema = [
+    '''CREATE TABLE primer_pairs (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        left_seq TEXT NOT NULL,
+        right_seq TEXT NOT NULL,
+        hits INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE hits (
+        primer_pair_id INTEGER NOT NULL REFERENCES primer_pairs(id),
+        genome TEXT NOT NULL,
+        contig TEXT NOT NULL,
+        left_start INTEGER NOT NULL,
+        left_strand TEXT NOT NULL,
+        right_start INTEGER NOT NULL,
+        right_strand TEXT NOT NULL
+    )''',
+]
+
+# The indexes are made after all the rows are added, which is faster than updating them for every row
+indexes = [
+    'CREATE UNIQUE INDEX primer_pairs_name ON primer_pairs (name)',
+    'CREATE INDEX primer_pairs_hits ON primer_pairs (hits)',
+    'CREATE INDEX hits_primer_pair ON hits (primer_pair_id)',
+    'CREATE INDEX hits_genome_contig ON hits (genome, contig, left_start)',
+]
+
+
+# Writes a new hit store database. Rows are added in batches, each in one transaction,
+# when there are batch_size primer pairs or hits waiting. The database is written to a
+# temporary file, which is renamed by close(), so that there is never an incomplete database
+class HitStoreWriter:
+    def __init__(self, filename, batch_size=100000):
+        self.filename = filename
+        self.tmp_file = filename + '.tmp'
+        self.batch_size = batch_size
+        if os.path.exists(self.tmp_file):
+            os.unlink(self.tmp_file)
+
+        try:
+            self.connection = sqlite3.connect(self.tmp_file)
+        except sqlite3.Error:
+            raise Error('Error opening hit store database ' + self.tmp_file)
+
+        # the file is not used until it is complete, so does not need a journal
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        for statement in schema:
+            self.connection.execute(statement)
+        self.number_of_primer_pairs = 0
+        self.primer_pairs = []
+        self.hits = []
+
+
+    # hits is a list of (genome, contig, left start, left strand, right start, right strand)
+    def add_primer_pair(self, name, left_seq, right_seq, hits):
+        self.number_of_primer_pairs += 1
+        self.primer_pairs.append((self.number_of_primer_pairs, name, left_seq, right_seq, len(hits)))
+        self.hits.extend((self.number_of_primer_pairs,) + tuple(x) for x in hits)
+        if len(self.primer_pairs) >= self.batch_size or len(self.hits) >= self.batch_size:
+            self._write_batch()
+
+
+    def _write_batch(self):
+        with self.connection:
+            self.connection.executemany('INSERT INTO primer_pairs VALUES (?, ?, ?, ?, ?)', self.primer_pairs)
+            self.connection.executemany('INSERT INTO hits VALUES (?, ?, ?, ?, ?, ?, ?)', self.hits)
+        self.primer_pairs = []
+        self.hits = []
+
+
+    def close(self):
+        self._write_batch()
+        with self.connection:
+            for statement in indexes:
+                self.connection.execute(statement)
+        self.connection.close()
+        os.replace(self.tmp_file, self.filename)
+
+
+# Reads a database made by HitStoreWriter. Other programs can use the database
+# directly with SQL (see schema)
+class HitStore:
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            raise Error('Hit store database not found: ' + filename)
+
+        try:
+            self.connection = sqlite3.connect('file:' + os.path.abspath(filename) + '?mode=ro', uri=True)
+        except sqlite3.Error:
+            raise Error('Error opening hit store database ' + filename)
+
+
+    def close(self):
+        self.connection.close()
+
+
+    # Returns the names of primer pairs that have a hit in the genome (and contig,
+    # if contig_name is given), sorted by name. If unique_only is True, only
+    # primer pairs with exactly one hit in all the genomes are returned
+    def primer_pairs_in_genome(self, genome_name, contig_name=None, unique_only=False):
+        query = 'SELECT DISTINCT primer_pairs.name FROM hits JOIN primer_pairs ON primer_pairs.id = hits.primer_pair_id WHERE hits.genome = ?'
+        args = [genome_name]
+        if contig_name is not None:
+            query += ' AND hits.contig = ?'
+            args.append(contig_name)
+        if unique_only:
+            query += ' AND primer_pairs.hits = 1'
+        return [x[0] for x in self.connection.execute(query + ' ORDER BY primer_pairs.name', args)]
+
+
+    # Returns list of hits of a primer pair, each a tuple (genome, contig, left start,
+    # left strand, right start, right strand), in the same order as all_primers.hits.tsv
+    def hits(self, primer_pair_name):
+        return self.connection.execute(
+            'SELECT genome, contig, left_start, left_strand, right_start, right_strand FROM hits JOIN primer_pairs ON primer_pairs.id = hits.primer_pair_id WHERE primer_pairs.name = ? ORDER BY hits.rowid',
+            (primer_pair_name,),
+        ).fetchall()
@@ -0,0 +1,206 @@
+import os
+import array
+import numpy
+from primer3tools import mapping
+
+
+class Error (Exception): pass
+
+
+# Returns the concatenation of the ranges starts[i] to starts[i] + lengths[i]
+def ranges(starts, lengths):
+    return numpy.arange(int(lengths.sum()), dtype=numpy.int64) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths) + numpy.repeat(starts, lengths)
+
+
+# Perfect hits of primers to a genome, stored one column per attribute.
+# Primer IDs are as used by primer_catalog.PrimerCatalog. Contig names are
+# stored once in contig_names, and each hit has the index of its contig in
+# that list. Starts are 0-based
+class HitTable:
+    def __init__(self):
+        self.primer_ids = array.array('q')
+        self.contig_ids = array.array('i')
+        self.starts = array.array('q')
+        self.is_reverse = array.array('b')
+        self.contig_names = []
+        self.contig_name_to_id = {}
+
+
+    def __eq__(self, other):
+        return type(other) is type(self) and self.__dict__ == other.__dict__
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def _contig_id(self, contig_name):
+        contig_id = self.contig_name_to_id.get(contig_name, None)
+        if contig_id is None:
+            contig_id = len(self.contig_names)
+            self.contig_name_to_id[contig_name] = contig_id
+            self.contig_names.append(contig_name)
+        return contig_id
+
+
+    def add(self, primer_id, contig_name, start, is_reverse):
+        self.primer_ids.append(primer_id)
+        self.contig_ids.append(self._contig_id(contig_name))
+        self.starts.append(start)
+        self.is_reverse.append(is_reverse)
+
+
+    # Returns contig_ids (indexes of the list contig_names) changed to be IDs of
+    # this table's contigs, adding any contigs that it does not have yet
+    def _new_contig_ids(self, contig_ids, contig_names):
+        contig_ids = numpy.asarray(contig_ids, dtype=numpy.int64)
+        new_contig_ids = numpy.zeros(len(contig_names), dtype=numpy.int32)
+        used_contig_ids, first_rows = numpy.unique(contig_ids, return_index=True)
+        for contig_id in used_contig_ids[numpy.argsort(first_rows)].tolist():
+            new_contig_ids[contig_id] = self._contig_id(contig_names[contig_id])
+        return new_contig_ids[contig_ids]
+
+
+    # Adds hits from arrays. contig_ids are indexes of the list contig_names
+    def add_columns(self, primer_ids, contig_ids, starts, is_reverse, contig_names):
+        self.primer_ids.frombytes(numpy.asarray(primer_ids, dtype=numpy.int64).tobytes())
+        self.contig_ids.frombytes(self._new_contig_ids(contig_ids, contig_names).tobytes())
+        self.starts.frombytes(numpy.asarray(starts, dtype=numpy.int64).tobytes())
+        self.is_reverse.frombytes(numpy.asarray(is_reverse, dtype=numpy.int8).tobytes())
+
+
+    # Returns numpy arrays of primer IDs, contig IDs, starts, is reverse
+    def columns(self):
+        return (
+            numpy.frombuffer(self.primer_ids, dtype=numpy.int64),
+            numpy.frombuffer(self.contig_ids, dtype=numpy.int32),
+            numpy.frombuffer(self.starts, dtype=numpy.int64),
+            numpy.frombuffer(self.is_reverse, dtype=numpy.int8).astype(bool),
+        )
+
+
+    # Returns a HitTable with at most max_hits hits of each primer (the first ones
+    # added), and an array of the IDs of the primers that had more hits than that
+    def capped(self, max_hits):
+        primer_ids, contig_ids, starts, is_reverse = self.columns()
+        order = numpy.argsort(primer_ids, kind='stable')
+        sorted_ids = primer_ids[order]
+        first_rows = numpy.flatnonzero(numpy.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1]))) if len(sorted_ids) else numpy.zeros(0, dtype=numpy.int64)
+        counts = numpy.diff(numpy.append(first_rows, len(sorted_ids)))
+        ranks = numpy.arange(len(sorted_ids)) - numpy.repeat(first_rows, counts)
+        keep = numpy.zeros(len(primer_ids), dtype=bool)
+        keep[order[ranks < max_hits]] = True
+        hits = HitTable()
+        hits.add_columns(primer_ids[keep], contig_ids[keep], starts[keep], is_reverse[keep], self.contig_names)
+        return hits, sorted_ids[first_rows[counts > max_hits]]
+
+
+    # For hits to a combined index, where contig names are genome__contig,
+    # returns a dictionary of genome name -> HitTable of hits to that genome
+    def split_by_genome(self):
+        contig_genomes = [mapping.split_combined_reference_name(x) for x in self.contig_names]
+        genome_names = sorted(set([x[0] for x in contig_genomes]))
+        genome_ids = {name: i for i, name in enumerate(genome_names)}
+        contig_genome_ids = numpy.array([genome_ids[x[0]] for x in contig_genomes], dtype=numpy.int64)
+        primer_ids, contig_ids, starts, is_reverse = self.columns()
+        hit_genome_ids = contig_genome_ids[contig_ids] if len(contig_genomes) else numpy.zeros(0, dtype=numpy.int64)
+        tables = {}
+
+        for genome_id, genome_name in enumerate(genome_names):
+            rows = hit_genome_ids == genome_id
+            tables[genome_name] = HitTable()
+            tables[genome_name].add_columns(primer_ids[rows], contig_ids[rows], starts[rows], is_reverse[rows], [x[1] for x in contig_genomes])
+
+        return tables
+
+
+# Type of each column of a HitTable, in the same order as HitTable.columns()
+_column_types = [('primer_ids', numpy.int64), ('contig_ids', numpy.int32), ('starts', numpy.int64), ('is_reverse', numpy.int8)]
+
+
+# Returns a numpy memory map of a file of length items (an empty array if length
+# is zero, because empty files cannot be memory mapped)
+def _memmap(filename, dtype, mode, length):
+    if length == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode=mode, shape=(length,))
+
+
+# Hits written to files a HitTable at a time, for when there are too many to keep
+# in memory. close() sorts them by primer ID into new files (keeping the order that
+# the hits of each primer were added), and memory maps those, so that the hits of any
+# primers can then be read without loading the rest (see hits_of_primers). Primer IDs
+# must be less than number_of_primers. Hits are sorted batch_size at a time. The
+# files are called prefix.*, and are deleted by remove()
+class HitFile:
+    def __init__(self, prefix, number_of_primers, batch_size=100000):
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.hits_per_primer = numpy.zeros(number_of_primers, dtype=numpy.int64)
+        self.first_rows = None
+        self.columns = None
+        # only has the contig names, to give each contig the same ID in all batches
+        self.contigs = HitTable()
+        self.files = [open(self._filename(x, sort=False), 'wb') for x, dtype in _column_types]
+
+
+    def __len__(self):
+        return int(self.hits_per_primer.sum())
+
+
+    def _filename(self, column, sort=True):
+        return self.prefix + ('.' if sort else '.unsorted.') + column
+
+
+    def add(self, hits):
+        columns = list(hits.columns())
+        self.hits_per_primer += numpy.bincount(columns[0], minlength=len(self.hits_per_primer))
+        columns[1] = self.contigs._new_contig_ids(columns[1], hits.contig_names)
+        for f, column, (name, dtype) in zip(self.files, columns, _column_types):
+            f.write(column.astype(dtype).tobytes())
+
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.first_rows = numpy.zeros(len(self.hits_per_primer) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.hits_per_primer, out=self.first_rows[1:])
+        number_of_hits = int(self.first_rows[-1])
+        unsorted = [_memmap(self._filename(x, sort=False), dtype, 'r', number_of_hits) for x, dtype in _column_types]
+        columns = [_memmap(self._filename(x), dtype, 'w+', number_of_hits) for x, dtype in _column_types]
+
+        # each hit goes after the hits of the same primer that were added before it
+        next_rows = self.first_rows[:-1].copy()
+        for start in range(0, number_of_hits, self.batch_size):
+            primer_ids = numpy.asarray(unsorted[0][start:start + self.batch_size])
+            order = numpy.argsort(primer_ids, kind='stable')
+            sorted_ids, first_rows, counts = numpy.unique(primer_ids[order], return_index=True, return_counts=True)
+            rows = numpy.repeat(next_rows[sorted_ids] - first_rows, counts) + numpy.arange(len(order), dtype=numpy.int64)
+            next_rows[sorted_ids] += counts
+            for unsorted_column, column in zip(unsorted, columns):
+                column[rows] = unsorted_column[start:start + self.batch_size][order]
+
+        for column in columns:
+            if isinstance(column, numpy.memmap):
+                column.flush()
+        del unsorted, columns
+        for x, dtype in _column_types:
+            os.unlink(self._filename(x, sort=False))
+        self.columns = [_memmap(self._filename(x), dtype, 'r', number_of_hits) for x, dtype in _column_types]
+
+
+    # Returns a HitTable of all the hits of the primers in primer_ids, sorted by primer ID
+    def hits_of_primers(self, primer_ids):
+        primer_ids = numpy.unique(primer_ids)
+        rows = ranges(self.first_rows[primer_ids], self.hits_per_primer[primer_ids])
+        hits = HitTable()
+        hits.add_columns(*[x[rows] for x in self.columns], self.contigs.contig_names)
+        return hits
+
+
+    def remove(self):
+        self.columns = None
+        for x, dtype in _column_types:
+            for sort in (True, False):
+                if os.path.exists(self._filename(x, sort=sort)):
+                    os.unlink(self._filename(x, sort=sort))
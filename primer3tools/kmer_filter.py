@@ -0,0 +1,140 @@
+import os
+import math
+import numpy
+import pyfastaq
+
+
+class Error (Exception): pass
+
+
+# Increase this when the files written by build() change, so that old filters are remade
+format_version = 1
+default_kmer_length = 16
+default_bits_per_kmer = 10
+
+# k-mers are added in chunks of this many, so that memory use is bounded for long contigs
+_chunk_size = 1000000
+
+# 2-bit code of each base, or 255 for anything that is not A, C, G or T.
+# Upper case only, because sequences are made upper case before encoding
+_base_codes = numpy.full(256, 255, dtype=numpy.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    _base_codes[_base] = _code
+
+
+# Returns the canonical value (the smaller of the k-mer and its reverse complement)
+# of the k-mer starting at each position of sequence (a numpy array of upper case
+# ASCII codes), and whether each k-mer is all A, C, G, T. The complement of
+# code c is 3 - c, so a k-mer and its reverse complement get the same value
+def _canonical_kmer_values(sequence, kmer_length):
+    codes = _base_codes[sequence]
+    number_of_kmers = max(len(sequence) - kmer_length + 1, 0)
+    forward = numpy.zeros(number_of_kmers, dtype=numpy.uint64)
+    reverse = numpy.zeros(number_of_kmers, dtype=numpy.uint64)
+    invalid = numpy.zeros(number_of_kmers, dtype=bool)
+
+    for i in range(kmer_length):
+        window = codes[i:i + number_of_kmers]
+        invalid |= window == 255
+        window = (window & 3).astype(numpy.uint64)
+        forward = (forward << numpy.uint64(2)) | window
+        reverse |= (numpy.uint64(3) - window) << numpy.uint64(2 * i)
+
+    return numpy.minimum(forward, reverse), ~invalid
+
+
+# splitmix64 finalizer, so that similar k-mers set unrelated bits
+def _mix(values):
+    values = values ^ (values >> numpy.uint64(30))
+    values = values * numpy.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> numpy.uint64(27))
+    values = values * numpy.uint64(0x94d049bb133111eb)
+    return values ^ (values >> numpy.uint64(31))
+
+
+# Returns a 2d array of the bit positions of each k-mer value (one row per hash function),
+# using double hashing: position i is (h1 + i * h2) mod number_of_bits
+def _bit_positions(values, number_of_hashes, number_of_bits):
+    hash1 = _mix(values)
+    hash2 = _mix(values ^ numpy.uint64(0x9e3779b97f4a7c15)) | numpy.uint64(1)
+    return numpy.array([(hash1 + numpy.uint64(i) * hash2) % numpy.uint64(number_of_bits) for i in range(number_of_hashes)], dtype=numpy.uint64)
+
+
+# Makes a Bloom filter of all k-mers on both strands of the contigs in a FASTA file,
+# and saves it to outfile (which should end .npz). k-mers with any base other than
+# A, C, G, T are not added, because they can never be part of a perfect match of a primer
+def build(fasta_file, outfile, kmer_length=default_kmer_length, bits_per_kmer=default_bits_per_kmer):
+    if not 1 <= kmer_length <= 32:
+        raise Error('k-mer length must be from 1 to 32. Got: ' + str(kmer_length))
+    if bits_per_kmer < 1:
+        raise Error('Bits per k-mer must be at least 1. Got: ' + str(bits_per_kmer))
+
+    sequences = [seq.seq.upper().encode() for seq in pyfastaq.sequences.file_reader(fasta_file)]
+    number_of_kmers = sum([max(len(x) - kmer_length + 1, 0) for x in sequences])
+    number_of_bits = 8 * max(1, math.ceil(bits_per_kmer * number_of_kmers / 8))
+    number_of_hashes = max(1, round(bits_per_kmer * math.log(2)))
+    bits = numpy.zeros(number_of_bits // 8, dtype=numpy.uint8)
+
+    for seq in sequences:
+        sequence = numpy.frombuffer(seq, dtype=numpy.uint8)
+        for start in range(0, max(len(sequence) - kmer_length + 1, 0), _chunk_size):
+            values, valid = _canonical_kmer_values(sequence[start:start + _chunk_size + kmer_length - 1], kmer_length)
+            positions = _bit_positions(values[valid], number_of_hashes, number_of_bits).ravel()
+            numpy.bitwise_or.at(bits, (positions >> numpy.uint64(3)).astype(numpy.int64), numpy.uint8(1) << (positions & numpy.uint64(7)).astype(numpy.uint8))
+
+    tmp_file = outfile + '.tmp.npz'
+    numpy.savez(
+        tmp_file,
+        format_version=numpy.array(format_version),
+        kmer_length=numpy.array(kmer_length),
+        number_of_hashes=numpy.array(number_of_hashes),
+        bits=bits,
+    )
+    # rename at the end, so that a crash never leaves a partly written filter
+    os.replace(tmp_file, outfile)
+
+
+# A Bloom filter made by build(). contains() can say that a sequence is in the genome
+# when it is not, but never the opposite, so it is safe to not map primers that it says
+# are not in the genome
+class KmerFilter:
+    def __init__(self, filename):
+        if not os.path.exists(filename):
+            raise Error('k-mer filter not found: ' + filename)
+
+        try:
+            data = numpy.load(filename)
+            found_version = int(data['format_version'])
+            self.kmer_length = int(data['kmer_length'])
+            self.number_of_hashes = int(data['number_of_hashes'])
+            self.bits = data['bits']
+        except:
+            raise Error('Error loading k-mer filter ' + filename)
+
+        if found_version != format_version:
+            raise Error('k-mer filter ' + filename + ' was made by a different version of primer3tools. Please remake it')
+
+
+    # Returns a boolean array of whether each sequence (a list of upper case strings) could
+    # be in the genome, on either strand. This is True when all its k-mers are in the filter.
+    # Sequences shorter than the k-mer length or with bases other than A, C, G, T are
+    # always True, because they cannot be checked
+    def contains(self, sequences):
+        if len(sequences) == 0:
+            return numpy.zeros(0, dtype=bool)
+
+        # the sequences are joined with a separator, which makes
+        # all the k-mers that span two sequences invalid
+        joined = numpy.frombuffer('$'.join(sequences).encode(), dtype=numpy.uint8)
+        lengths = numpy.array([len(x) for x in sequences], dtype=numpy.int64)
+        starts = numpy.cumsum(lengths + 1) - lengths - 1
+        values, valid = _canonical_kmer_values(joined, self.kmer_length)
+        kmer_starts = numpy.flatnonzero(valid)
+        positions = _bit_positions(values[kmer_starts], self.number_of_hashes, 8 * len(self.bits))
+        is_set = ((self.bits[positions >> numpy.uint64(3)] >> (positions & numpy.uint64(7)).astype(numpy.uint8)) & 1).astype(bool)
+        missing = kmer_starts[~is_set.all(axis=0)]
+        sequence_missing = numpy.bincount(numpy.searchsorted(starts, missing, side='right') - 1, minlength=len(sequences))
+
+        checkable = lengths >= self.kmer_length
+        checkable &= numpy.array([len(x.encode().translate(None, b'ACGT')) == 0 for x in sequences], dtype=bool)
+        return ~checkable | (sequence_missing == 0)
@@ -1,4 +1,6 @@
 import os
+import contextlib
+import pysam
 from primer3tools import common
 
 
@@ -6,6 +8,8 @@ class Error (Exception): pass
 
 
 bowtie2_index_extensions = [x + '.bt2' for x in ['1', '2', '3', '4', 'rev.1', 'rev.2']]
+combined_index_manifest = 'combined_indexes.tsv'
+combined_index_separator = '__'
 
 
 def is_bowtie2_indexed(infile):
@@ -16,30 +20,87 @@ def is_bowtie2_indexed(infile):
     return True
 
 
-def bowtie2_index(infile, outprefix=None):
+def bowtie2_index(infile, outprefix=None, threads=1):
     if outprefix is None:
         outprefix = infile
 
     if not is_bowtie2_indexed(infile):
-        common.syscall('bowtie2-build ' + infile + ' ' + outprefix)
+        # only use --threads when needed, because old versions of bowtie2-build do not have it
+        threads_option = ' --threads ' + str(threads) if threads > 1 else ''
+        common.syscall('bowtie2-build' + threads_option + ' ' + infile + ' ' + outprefix)
 
 
-def run_bowtie2(reads, reference, outfile, threads=1):
-    assert is_bowtie2_indexed(reference)
-    cmd = ' '.join([
+# If max_hits is 0, all alignments are reported. Otherwise, only perfect alignments
+# (which have score 0, the best score in end-to-end mode) are reported, and at most
+# max_hits of them per read
+def _bowtie2_command(reads, reference, threads, max_hits=0):
+    return ' '.join([
         'bowtie2',
         '-x', reference,
         '-U', reads,
         '-f',  # reads are in fasta format
         '--end-to-end --very-fast',
         '--threads', str(threads),
-        '--all', # report all alignments
+        '--all' if max_hits == 0 else '-k ' + str(max_hits) + ' --score-min C,0',
         '--reorder', # force SAM output order to match order of input reads
-        '-S', outfile # output in SAM format
     ])
 
+
+def run_bowtie2(reads, reference, outfile, threads=1, max_hits=0):
+    assert is_bowtie2_indexed(reference)
+    cmd = _bowtie2_command(reads, reference, threads, max_hits=max_hits) + ' -S ' + outfile # output in SAM format
     common.syscall(cmd)
 
 
+# Yields a pysam.AlignmentFile of the bowtie2 output, without writing any files.
+# reads is an iterable of lines of a fasta file, which are piped into bowtie2.
+# If output_format is 'bam', the SAM output is converted to BAM by samtools
+@contextlib.contextmanager
+def stream_bowtie2(reads, reference, threads=1, output_format='sam', max_hits=0):
+    assert is_bowtie2_indexed(reference)
+    cmd = _bowtie2_command('-', reference, threads, max_hits=max_hits)
+    if output_format == 'bam':
+        cmd += ' | samtools view -b -1 -@ ' + str(threads) + ' -'
+    elif output_format != 'sam':
+        raise Error('Output format must be sam or bam. Got: ' + str(output_format))
+
+    with common.syscall_stream(cmd, stdin_lines=reads) as f:
+        with pysam.AlignmentFile(f, 'rb' if output_format == 'bam' else 'r', threads=threads) as sam_reader:
+            yield sam_reader
+
+
+def combined_index_chunks(genome_names, chunk_size):
+    genome_names = sorted(genome_names)
+    chunks = {}
+    for i in range(0, len(genome_names), chunk_size):
+        chunks['combined.' + str(len(chunks) + 1)] = genome_names[i:i + chunk_size]
+    return chunks
+
+
+def write_combined_index_manifest(chunks, outfile):
+    with open(outfile, 'w') as f:
+        for chunk_name in chunks:
+            for genome_name in chunks[chunk_name]:
+                print(chunk_name, genome_name, sep='\t', file=f)
+
+
+def load_combined_index_manifest(infile):
+    chunks = {}
+
+    with open(infile) as f:
+        for line in f:
+            try:
+                chunk_name, genome_name = line.rstrip().split('\t')
+            except:
+                raise Error('Error reading combined index manifest file ' + infile + '. Bad line:\n' + line)
+            chunks.setdefault(chunk_name, []).append(genome_name)
+
+    return chunks
 
 
+def split_combined_reference_name(refname):
+    try:
+        genome_name, contig_name = refname.split(combined_index_separator, maxsplit=1)
+    except:
+        raise Error('Error getting genome name from combined index reference name: ' + refname)
+    return genome_name, contig_name
@@ -0,0 +1,86 @@
+import heapq
+import os
+
+
+class Error (Exception): pass
+
+
+# Rough memory (bytes) used by each match in a dictionary of primer hits (primer name ->
+# genome name -> contig name -> list of (left hit, right hit), see uniqueness.PrimerUniqueness),
+# used to decide when to write the matches to a run file instead of keeping them in memory
+bytes_per_match = 700
+
+
+def number_of_matches(primer_hits):
+    return sum([len(x) for genome_hits in primer_hits.values() for contig_hits in genome_hits.values() for x in contig_hits.values()])
+
+
+# Yields one tuple per match in primer_hits: (primer name, genome name, contig name,
+# index of the match in its list, left hit, right hit), sorted by the first four
+def _records_from_dict(primer_hits):
+    for name in sorted(primer_hits):
+        for genome_name in sorted(primer_hits[name]):
+            for contig_name in sorted(primer_hits[name][genome_name]):
+                for i, (left, right) in enumerate(primer_hits[name][genome_name][contig_name]):
+                    yield name, genome_name, contig_name, i, left, right
+
+
+def _hit_to_strings(hit):
+    start, length, is_reverse, seq = hit
+    return [str(start), str(length), '1' if is_reverse else '0', seq]
+
+
+def _hit_from_strings(fields):
+    return int(fields[0]), int(fields[1]), fields[2] == '1', fields[3]
+
+
+# Writes all the matches in primer_hits to a "run" file, sorted so that
+# several run files can be merged by merge(). One match per line
+def write_run(primer_hits, filename):
+    try:
+        with open(filename, 'w') as f:
+            for name, genome_name, contig_name, i, left, right in _records_from_dict(primer_hits):
+                print(name, genome_name, contig_name, i, *_hit_to_strings(left), *_hit_to_strings(right), sep='\t', file=f)
+    except OSError:
+        raise Error('Error writing matches to temporary file ' + filename)
+
+
+# Yields the records (see _records_from_dict) in a file made by write_run(),
+# apart from those where (primer name, genome name) is in exclude
+def _records_from_file(filename, exclude):
+    with open(filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if (fields[0], fields[1]) not in exclude:
+                yield fields[0], fields[1], fields[2], int(fields[3]), _hit_from_strings(fields[4:8]), _hit_from_strings(fields[8:12])
+
+
+# Merges the matches in run files made by write_run() and the matches in primer_hits,
+# one primer at a time, so that only the matches of one primer are in memory.
+# Matches in the run files where (primer name, genome name) is in exclude are not used.
+# A primer pair's matches to each genome must be in only one of the runs or primer_hits.
+# Yields (primer name, genome name -> contig name -> list of (left hit, right hit)),
+# sorted by primer name. The matches of each primer are the same as if all the runs
+# and primer_hits had been merged into one dictionary
+def merge(filenames, primer_hits, exclude=None):
+    exclude = set() if exclude is None else exclude
+    runs = [_records_from_file(x, exclude) for x in filenames] + [_records_from_dict(primer_hits)]
+    current_name = None
+    genome_hits = {}
+
+    for name, genome_name, contig_name, i, left, right in heapq.merge(*runs, key=lambda x: x[:4]):
+        if name != current_name:
+            if current_name is not None:
+                yield current_name, genome_hits
+            current_name = name
+            genome_hits = {}
+        genome_hits.setdefault(genome_name, {}).setdefault(contig_name, []).append((left, right))
+
+    if current_name is not None:
+        yield current_name, genome_hits
+
+
+def delete_runs(filenames):
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.unlink(filename)
@@ -0,0 +1,145 @@
+import json
+import os
+import resource
+import sys
+import time
+
+
+class Error (Exception): pass
+
+
+# ru_maxrss is in bytes on macOS, and KB everywhere else
+maxrss_bytes = 1 if sys.platform == 'darwin' else 1024
+
+
+# Resource usage of each child process run by common.syscall() and common.syscall_stream()
+# in this process, in the order they finished. Each Stage takes the ones that finished
+# while it was running
+child_processes = []
+
+# Stages that are running in this process, outermost first
+_open_stages = []
+
+
+def record_child_process(command, wall_seconds, rusage):
+    child_processes.append({
+        'program': os.path.basename(command.split()[0]),
+        'command': command,
+        'wall_seconds': round(wall_seconds, 6),
+        'user_seconds': round(rusage.ru_utime, 6),
+        'system_seconds': round(rusage.ru_stime, 6),
+        'peak_rss_bytes': rusage.ru_maxrss * maxrss_bytes,
+        # ru_inblock and ru_oublock count 512 byte blocks of real disk I/O, so do
+        # not include reads and writes of files that are in the page cache
+        'block_read_bytes': rusage.ru_inblock * 512,
+        'block_write_bytes': rusage.ru_oublock * 512,
+    })
+
+
+# Returns (bytes read, bytes written) by this process so far, including
+# pipes and files in the page cache. Uses block I/O if /proc is not there
+def _io_bytes():
+    try:
+        with open('/proc/self/io') as f:
+            counts = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counts['rchar']), int(counts['wchar'])
+    except (OSError, KeyError, ValueError):
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        return rusage.ru_inblock * 512, rusage.ru_oublock * 512
+
+
+# Resets the peak memory of this process, so that _peak_rss() is the peak since
+# the reset. This is only possible on Linux, otherwise the peak is since the process started
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * maxrss_bytes
+
+
+# Measures a stage of a task (for example, primer3 on one genome). Use as a context
+# manager, then stage.record is a dictionary that can be written to a metrics file with
+# write_records(). CPU time includes all child processes that finished during the stage.
+# Peak memory is the largest of this process and each of the child processes.
+# Stages can be nested, for example to measure a whole run as well as each part of it
+class Stage:
+    def __init__(self, task, stage, name=None):
+        self.task = task
+        self.stage = stage
+        self.name = name
+        self.counts = {}
+        self.record = None
+
+
+    def count(self, key, number=1):
+        self.counts[key] = self.counts.get(key, 0) + number
+
+
+    def __enter__(self):
+        # the peak memory is reset for this stage, so any stages that this one
+        # is part of need to keep the peak so far
+        peak_rss = _peak_rss()
+        for stage in _open_stages:
+            stage.peak_rss = max(stage.peak_rss, peak_rss)
+        _reset_peak_rss()
+        self.peak_rss = 0
+        _open_stages.append(self)
+        self.first_child = len(child_processes)
+        self.start_io = _io_bytes()
+        self.start_self = resource.getrusage(resource.RUSAGE_SELF)
+        self.start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start_time = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_seconds = time.perf_counter() - self.start_time
+        end_self = resource.getrusage(resource.RUSAGE_SELF)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end_io = _io_bytes()
+        children = child_processes[self.first_child:]
+        _open_stages.remove(self)
+        self.peak_rss = max([self.peak_rss, _peak_rss()] + [x['peak_rss_bytes'] for x in children])
+        for stage in _open_stages:
+            stage.peak_rss = max(stage.peak_rss, self.peak_rss)
+        cpu_seconds = sum([getattr(end, x) - getattr(start, x) for start, end in [(self.start_self, end_self), (self.start_children, end_children)] for x in ['ru_utime', 'ru_stime']])
+
+        self.record = {
+            'task': self.task,
+            'stage': self.stage,
+            'name': self.name,
+            'wall_seconds': round(wall_seconds, 6),
+            'cpu_seconds': round(cpu_seconds, 6),
+            'peak_rss_bytes': self.peak_rss,
+            'read_bytes': end_io[0] - self.start_io[0],
+            'write_bytes': end_io[1] - self.start_io[1],
+            'counts': self.counts,
+            'children': children,
+        }
+
+
+# Appends records (see Stage) to a metrics file, one JSON object per line
+def write_records(filename, records):
+    try:
+        with open(filename, 'a') as f:
+            for record in records:
+                print(json.dumps(record, sort_keys=True), file=f)
+    except OSError:
+        raise Error('Error writing metrics file ' + filename)
+
+
+def load_records(filename):
+    with open(filename) as f:
+        return [json.loads(line) for line in f]
@@ -0,0 +1,70 @@
+import numpy
+
+
+class Error (Exception): pass
+
+
+# For each hit in reverse_indexes, finds the hits in forward_indexes in the same group
+# that make a PCR product with it, of length in [min_product_length, max_product_length].
+# The forward hit must start before the reverse hit.
+# Returns two arrays: indexes of forward hits and indexes of reverse hits
+def _forward_partners(forward_indexes, reverse_indexes, groups, starts, lengths, min_product_length, max_product_length):
+    if len(forward_indexes) == 0 or len(reverse_indexes) == 0:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return empty, empty
+
+    # Sort forward hits by group then start position, and combine group and
+    # start position into one key, so that one binary search per reverse hit
+    # finds all its partners across all groups at once
+    span = int(starts.max()) + int(lengths.max()) + 2
+    order = numpy.lexsort((starts[forward_indexes], groups[forward_indexes]))
+    forward_sorted = forward_indexes[order]
+    forward_keys = groups[forward_sorted] * span + starts[forward_sorted]
+
+    reverse_starts = starts[reverse_indexes]
+    reverse_ends = reverse_starts + lengths[reverse_indexes]
+    lowest_start = numpy.maximum(reverse_ends - max_product_length, 0)
+    highest_start = numpy.minimum(reverse_ends - min_product_length, reverse_starts - 1)
+    reverse_keys = groups[reverse_indexes] * span
+    first = numpy.searchsorted(forward_keys, reverse_keys + lowest_start, side='left')
+    last = numpy.searchsorted(forward_keys, reverse_keys + highest_start, side='right')
+    counts = numpy.maximum(last - first, 0)
+
+    total = int(counts.sum())
+    count_starts = numpy.cumsum(counts) - counts
+    positions = numpy.arange(total, dtype=numpy.int64) - numpy.repeat(count_starts, counts) + numpy.repeat(first, counts)
+    return forward_sorted[positions], numpy.repeat(reverse_indexes, counts)
+
+
+# Finds all pairs of a left primer hit and a right primer hit that would make a PCR product.
+# Each hit i has group groups[i] (hits can only pair with hits in the same group,
+# which is a primer pair and contig), 0-based start position starts[i], primer length
+# lengths[i], strand is_reverse[i], and is a right primer hit if is_right[i] (otherwise
+# it is a left primer hit).
+# Returns two arrays: indexes of left hits and indexes of right hits, sorted
+# by left index, then right index
+def good_pair_indexes(groups, starts, lengths, is_reverse, is_right, min_product_length, max_product_length):
+    if not len(groups) == len(starts) == len(lengths) == len(is_reverse) == len(is_right):
+        raise Error('Arrays of hits must all be the same length')
+
+    # use small group numbers, so that groups[i] * span (see _forward_partners) does not overflow
+    groups = numpy.unique(numpy.asarray(groups), return_inverse=True)[1].astype(numpy.int64).reshape(-1)
+    starts = numpy.asarray(starts, dtype=numpy.int64)
+    lengths = numpy.asarray(lengths, dtype=numpy.int64)
+    is_reverse = numpy.asarray(is_reverse, dtype=bool)
+    is_right = numpy.asarray(is_right, dtype=bool)
+
+    # left primer forward strand, right primer reverse strand
+    left_forward = numpy.flatnonzero(~is_right & ~is_reverse)
+    right_reverse = numpy.flatnonzero(is_right & is_reverse)
+    left1, right1 = _forward_partners(left_forward, right_reverse, groups, starts, lengths, min_product_length, max_product_length)
+
+    # left primer reverse strand, right primer forward strand
+    left_reverse = numpy.flatnonzero(~is_right & is_reverse)
+    right_forward = numpy.flatnonzero(is_right & ~is_reverse)
+    right2, left2 = _forward_partners(right_forward, left_reverse, groups, starts, lengths, min_product_length, max_product_length)
+
+    left = numpy.concatenate((left1, left2))
+    right = numpy.concatenate((right1, right2))
+    order = numpy.lexsort((right, left))
+    return left[order], right[order]
@@ -1,18 +1,76 @@
 import os
-import tempfile
+import io
+import re
+import pickle
 import shutil
+import multiprocessing
+import multiprocessing.pool
+import concurrent.futures
 import pyfastaq
-from primer3tools import common, primer_pair
+from primer3tools import binary_catalog, common, compression, primer_pair
+
+try:
+    import primer3 as primer3_bindings
+except ImportError:
+    primer3_bindings = None
 
 
 class Error (Exception): pass
 
+
+_bindings_global_args = None
+
+
+# primer3 settings are given to each worker process once here, instead of with every sequence
+def _init_bindings_worker(global_args):
+    global _bindings_global_args
+    _bindings_global_args = global_args
+
+
+# Runs primer3's design function in this process on one sequence, and returns its
+# results in the same form as a record of primer3_core output: a dictionary
+# of string keys and values
+def _design_primers(seq_id, seq):
+    try:
+        results = primer3_bindings.bindings.design_primers({'SEQUENCE_ID': seq_id, 'SEQUENCE_TEMPLATE': seq}, _bindings_global_args)
+    except OSError as error:
+        return {'SEQUENCE_ID': seq_id, 'PRIMER_ERROR': str(error)}
+
+    record = {'SEQUENCE_ID': seq_id}
+    for key, value in results.items():
+        if isinstance(value, (list, tuple)):
+            # skip the lists of dictionaries that summarise all primers, which are
+            # not in primer3_core output. Positions are lists of two numbers
+            if len(value) == 0 or isinstance(value[0], dict):
+                continue
+            value = ','.join([str(x) for x in value])
+        record[key] = str(value)
+    return record
+
+
+# throws a pickle error without this wrapper...
+def _design_primers_wrapper(y):
+    return _design_primers(*y)
+
+
+# Yields the lines of primer3_core input (boulder-IO format) for an
+# iterable of (sequence ID, sequence)
+def _boulder_lines(sequences):
+    for seq_id, seq in sequences:
+        yield 'SEQUENCE_ID=' + seq_id + '\nSEQUENCE_TEMPLATE=' + seq + '\n=\n'
+
 class Primer3:
-    def __init__(self, fasta_file, config_file, genome_name, primer3_command='primer3_core'):
+    def __init__(self, fasta_file, config_file, genome_name, primer3_command='primer3_core', threads=1, window_size=0, engine='subprocess', compression_codec='gzip', compression_level=9):
         self.input_fasta = os.path.abspath(fasta_file)
         self.config_file = os.path.abspath(config_file)
         self.genome_name = genome_name
         self.primer3_command = primer3_command
+        self.threads = threads
+        self.window_size = window_size
+        self.engine = engine
+        self.compression_codec = compression_codec
+        self.compression_level = compression_level
+        compression.check_codec(self.compression_codec, self.compression_level)
 
 
         for filename in [self.input_fasta, self.config_file]:
@@ -20,25 +78,244 @@ class Primer3:
                 raise Error('File not found: "' + filename + '". Cannot continue')
 
 
-        if shutil.which(self.primer3_command) is None:
+        if self.engine == 'auto':
+            self.engine = 'subprocess' if primer3_bindings is None else 'bindings'
+
+        if self.engine == 'bindings':
+            if primer3_bindings is None:
+                raise Error('Error: primer3-py not found. It is needed for the bindings primer3 engine')
+        elif self.engine != 'subprocess':
+            raise Error('engine must be one of subprocess, bindings, auto. Got: ' + str(self.engine))
+        elif shutil.which(self.primer3_command) is None:
             raise Error('Error: primer3 command not found: ' + self.primer3_command)
 
 
     def _run_primer3_core(self, fasta_file, config_file, outfile):
-        tmpdir = tempfile.mkdtemp(prefix='tmp.run_primer3_core.', dir=os.getcwd())
-        boulder_file = os.path.join(tmpdir, 'in.boulder')
-        pyfastaq.tasks.to_boulderio(self.input_fasta, boulder_file)
+        if self.threads > 1 or self.window_size > 0:
+            self._run_primer3_core_sharded(fasta_file, config_file, outfile)
+            return
+
+        # the sequences are piped straight into primer3_core, without writing an input file
+        sequences = ((seq.id, seq.seq) for seq in pyfastaq.sequences.file_reader(fasta_file))
         cmd = ' '.join([
             self.primer3_command,
-            '-p3_settings_file=' + self.config_file,
-            '<',
-            boulder_file,
-            '| gzip -9 -c >',
+            '-p3_settings_file=' + config_file,
+            '|',
+            compression.compress_command(self.compression_codec, self.compression_level, self.threads),
+            '>',
             outfile,
         ])
 
-        common.syscall(cmd)
-        shutil.rmtree(tmpdir)
+        with common.syscall_stream(cmd, stdin_lines=_boulder_lines(sequences)) as f:
+            f.read()
+
+
+    # Returns the largest PCR product size allowed by the config file (primer3's
+    # default range is 100-300). Windows of a contig overlap by this much, so
+    # that every product fits inside at least one window
+    @staticmethod
+    def _max_product_size(config_file):
+        max_size = 300
+        with open(config_file) as f:
+            for line in f:
+                if line.startswith('PRIMER_PRODUCT_SIZE_RANGE='):
+                    sizes = [int(x) for x in re.split('[- ]+', line.rstrip().split('=', maxsplit=1)[1]) if x != '']
+                    max_size = max(sizes)
+        return max_size
+
+
+    # Returns list of tuples (sequence number, sequence ID, start, sequence), one
+    # for each sequence, or one for each window of sequences longer than window_size.
+    # Windows overlap by overlap bases, and start is the position of a window in its sequence
+    @staticmethod
+    def _primer3_jobs(fasta_file, window_size, overlap):
+        jobs = []
+        for seq_number, seq in enumerate(pyfastaq.sequences.file_reader(fasta_file)):
+            if window_size <= 0 or len(seq) <= window_size:
+                jobs.append((seq_number, seq.id, 0, seq.seq))
+            else:
+                start = 0
+                while True:
+                    end = min(start + window_size, len(seq))
+                    jobs.append((seq_number, seq.id, start, seq.seq[start:end]))
+                    if end == len(seq):
+                        break
+                    start += window_size - overlap
+        return jobs
+
+
+    # Splits jobs into at most number_of_groups lists with similar total sequence length
+    @staticmethod
+    def _group_primer3_jobs(jobs, number_of_groups):
+        groups = [[] for i in range(min(number_of_groups, len(jobs)))]
+        group_lengths = [0] * len(groups)
+        for job in sorted(jobs, key=lambda x: -len(x[3])):
+            i = group_lengths.index(min(group_lengths))
+            groups[i].append(job)
+            group_lengths[i] += len(job[3])
+
+        # keep each group in input order, so results are in a predictable order
+        return [sorted(x, key=lambda x: (x[0], x[2])) for x in groups]
+
+
+    # Returns results dictionary of the primer pairs of all windows of one sequence.
+    # windows is a list of (start of window, results of window). Positions are changed from
+    # window coordinates to sequence coordinates, primer pairs found in more than one window
+    # are only kept once, and primer pairs are numbered in order of penalty
+    @staticmethod
+    def _merge_window_results(sequence_id, windows):
+        pair_key = re.compile(r'^PRIMER_(LEFT|RIGHT|INTERNAL|PAIR)_([0-9]+)(.*)$')
+        pairs = {}
+
+        for window_start, results in windows:
+            window_pairs = {}
+            for key, value in results.items():
+                match = pair_key.match(key)
+                if match is None:
+                    continue
+                kind, index, suffix = match.groups()
+                if suffix == '' and kind != 'PAIR':
+                    position, length = value.split(',')
+                    value = str(int(position) + window_start) + ',' + length
+                window_pairs.setdefault(int(index), []).append((kind, suffix, value))
+
+            for pair_data in window_pairs.values():
+                values = {(kind, suffix): value for kind, suffix, value in pair_data}
+                key = tuple(values.get(x, None) for x in [('LEFT', ''), ('RIGHT', ''), ('LEFT', '_SEQUENCE'), ('RIGHT', '_SEQUENCE')])
+                if key not in pairs:
+                    pairs[key] = (float(values.get(('PAIR', '_PENALTY'), 0)), pair_data)
+
+        merged = {'SEQUENCE_ID': sequence_id}
+        number_of_internal = 0
+        sorted_pairs = sorted(pairs.items(), key=lambda x: (x[1][0], int(x[0][0].split(',')[0]), int(x[0][1].split(',')[0])))
+        for kind in ['LEFT', 'RIGHT']:
+            merged['PRIMER_' + kind + '_NUM_RETURNED'] = str(len(sorted_pairs))
+        for index, (key, (penalty, pair_data)) in enumerate(sorted_pairs):
+            for kind, suffix, value in pair_data:
+                merged['PRIMER_' + kind + '_' + str(index) + suffix] = value
+                if kind == 'INTERNAL' and suffix == '':
+                    number_of_internal += 1
+        if number_of_internal > 0:
+            merged['PRIMER_INTERNAL_NUM_RETURNED'] = str(number_of_internal)
+        merged['PRIMER_PAIR_NUM_RETURNED'] = str(len(sorted_pairs))
+        return merged
+
+
+    # Runs primer3_core on a list of (sequence number, sequence ID, start, sequence),
+    # and returns the list of records it outputs, one per sequence
+    def _run_primer3_core_on_jobs(self, jobs, config_file):
+        records = []
+        cmd = self.primer3_command + ' -p3_settings_file=' + config_file
+        with common.syscall_stream(cmd, stdin_lines=_boulder_lines((x[1], x[3]) for x in jobs)) as f:
+            f = io.TextIOWrapper(f)
+            # primer3_core writes one record per input record, in the same order
+            for seq_number, seq_id, start, seq in jobs:
+                record = self._get_next_primer3_sequence_results(f)
+                if record is None:
+                    raise Error('Not enough records in primer3_core output for sequence ' + seq_id)
+                records.append(record)
+        return records
+
+
+    # Runs primer3_core on groups of sequences at once, using one primer3_core
+    # process per thread. If window_size > 0, sequences longer than that are split
+    # into overlapping windows. The output is written to outfile as if primer3_core
+    # had been run once on all the sequences, with the windows of each sequence merged
+    def _run_primer3_core_sharded(self, fasta_file, config_file, outfile):
+        overlap = self._max_product_size(config_file)
+        if self.window_size > 0 and self.window_size <= overlap:
+            raise Error('Window size (' + str(self.window_size) + ') must be larger than the maximum product size (' + str(overlap) + ')')
+
+        jobs = self._primer3_jobs(fasta_file, self.window_size, overlap)
+        groups = self._group_primer3_jobs(jobs, self.threads)
+        pool = multiprocessing.pool.ThreadPool(max(1, min(self.threads, len(groups))))
+        group_records = pool.starmap(self._run_primer3_core_on_jobs, [(group, config_file) for group in groups])
+        pool.close()
+        pool.join()
+
+        results = {}
+        for group, records in zip(groups, group_records):
+            for (seq_number, seq_id, start, seq), record in zip(group, records):
+                results.setdefault(seq_number, []).append((start, record))
+
+        self._write_merged_results(results, outfile)
+
+
+    # results is a dictionary of sequence number -> list of (window start, results record),
+    # with one record per sequence when it was not split into windows. Writes one
+    # record per sequence to outfile, in the form of primer3_core output, and returns them
+    def _write_merged_results(self, results, outfile):
+        records = []
+        f = compression.open_write(outfile, self.compression_codec, self.compression_level, self.threads)
+        for seq_number in sorted(results):
+            if len(results[seq_number]) == 1:
+                record = results[seq_number][0][1]
+            else:
+                record = self._merge_window_results(results[seq_number][0][1]['SEQUENCE_ID'], results[seq_number])
+            for key, value in record.items():
+                print(key + '=' + value, file=f)
+            print('=', file=f)
+            records.append(record)
+        f.close()
+        return records
+
+
+    # Returns dictionary of primer3 settings from a primer3_core settings file, in the form
+    # used by primer3-py. The thermodynamic parameters path is not used, because primer3-py
+    # has its own copy of the parameters
+    @staticmethod
+    def _load_bindings_global_args(config_file):
+        global_args = {}
+        with open(config_file) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if '=' not in line or line == '=' or line.startswith('P3_FILE_TYPE='):
+                    continue
+
+                key, value = line.split('=', maxsplit=1)
+                if key == 'PRIMER_THERMODYNAMIC_PARAMETERS_PATH':
+                    continue
+                elif key == 'PRIMER_PRODUCT_SIZE_RANGE':
+                    global_args[key] = [[int(y) for y in x.split('-')] for x in value.split()]
+                else:
+                    for value_type in (int, float):
+                        try:
+                            value = value_type(value)
+                            break
+                        except ValueError:
+                            pass
+                    global_args[key] = value
+
+        return global_args
+
+
+    # Designs primers using primer3-py in this process (or several processes if threads > 1),
+    # instead of running primer3_core. Writes the results to outfile in the same form as
+    # primer3_core output, and returns the primer pairs
+    def _run_primer3_bindings(self, fasta_file, config_file, outfile):
+        global_args = self._load_bindings_global_args(config_file)
+        overlap = self._max_product_size(config_file)
+        if self.window_size > 0 and self.window_size <= overlap:
+            raise Error('Window size (' + str(self.window_size) + ') must be larger than the maximum product size (' + str(overlap) + ')')
+        jobs = self._primer3_jobs(fasta_file, self.window_size, overlap)
+
+        # a daemonic process (for example, a worker of Primer3Batch) cannot start more processes
+        if self.threads > 1 and len(jobs) > 1 and not multiprocessing.current_process().daemon:
+            with concurrent.futures.ProcessPoolExecutor(min(self.threads, len(jobs)), initializer=_init_bindings_worker, initargs=(global_args,)) as executor:
+                records = list(executor.map(_design_primers_wrapper, [(x[1], x[3]) for x in jobs], chunksize=1))
+        else:
+            _init_bindings_worker(global_args)
+            records = [_design_primers(x[1], x[3]) for x in jobs]
+
+        results = {}
+        for (seq_number, seq_id, start, seq), record in zip(jobs, records):
+            results.setdefault(seq_number, []).append((start, record))
+
+        primer_pairs = {}
+        for record in self._write_merged_results(results, outfile):
+            self._add_primer_pairs_from_results(primer_pairs, record)
+        self._check_primer_pairs(primer_pairs)
+        return primer_pairs
 
 
     def _split_primer3_output_line(self, line):
@@ -91,51 +368,159 @@ class Primer3:
         )
 
 
-    def _load_primer_pairs(self, primer3_core_outfile):
-        primer_pairs = {}
-
-        f = pyfastaq.utils.open_file_read(primer3_core_outfile)
-        while 1:
-            results = self._get_next_primer3_sequence_results(f)
-            if results is None:
-                break
-
-            if 'SEQUENCE_ID' not in results:
-                raise Error('SEQUENCE_ID line not found in primer3_core output. Cannot continue')
-            elif results['SEQUENCE_ID'] in primer_pairs:
-                raise Error('Sequence name found twice:' + results['SEQUENCE_ID'] + ' ... cannot continue')
-            elif self._primer3_found_no_primers(results):
-                continue
+    def _add_primer_pairs_from_results(self, primer_pairs, results):
+        if 'SEQUENCE_ID' not in results:
+            raise Error('SEQUENCE_ID line not found in primer3_core output. Cannot continue')
+        elif results['SEQUENCE_ID'] in primer_pairs:
+            raise Error('Sequence name found twice:' + results['SEQUENCE_ID'] + ' ... cannot continue')
+        elif self._primer3_found_no_primers(results):
+            return
 
-            # remove everything after first white space so IDs match later,
-            # as bowtie2 will do the same in its output SAM file
-            results['SEQUENCE_ID'] = results['SEQUENCE_ID'].split(' ')[0]
-            results_list = self._primer3_sequence_results_to_list(results)
-            primer_pairs[results['SEQUENCE_ID']] = results_list
+        # remove everything after first white space so IDs match later,
+        # as bowtie2 will do the same in its output SAM file
+        results['SEQUENCE_ID'] = results['SEQUENCE_ID'].split(' ')[0]
+        results_list = self._primer3_sequence_results_to_list(results)
+        primer_pairs[results['SEQUENCE_ID']] = results_list
 
-        pyfastaq.utils.close(f)
 
+    def _check_primer_pairs(self, primer_pairs):
         for pair_list in primer_pairs.values():
             for pair in pair_list:
                 if not pair.has_all_info():
                     raise Error('Error making primer pairs. Cannot continue')
 
-        return primer_pairs
 
+    # Yields each record of primer3_core output in filehandle, as a dictionary. This does
+    # the same as calling _get_next_primer3_sequence_results() until the end of the
+    # file, but is faster because the file is read in blocks of block_size characters
+    def _primer3_records(self, filehandle, block_size=1048576):
+        record = {}
+        remainder = ''
 
-    def _write_primers_fasta(self, outfile):
-        f = pyfastaq.utils.open_file_write(outfile)
-        for genome_name in sorted(self.primer_pairs):
-            for pair in self.primer_pairs[genome_name]:
-                print(pair.left_fasta, file=f)
-                print(pair.right_fasta, file=f)
-
-        pyfastaq.utils.close(f)
+        while 1:
+            block = filehandle.read(block_size)
+            if block == '':
+                break
+            lines = (remainder + block).split('\n')
+            remainder = lines.pop()
+
+            for line in lines:
+                if line == '=':
+                    yield record
+                    record = {}
+                    continue
+
+                key, equals, value = line.rstrip().partition('=')
+                if equals == '':
+                    raise Error('Error parsing primer3_core output, no equals in this line:' + line)
+                elif key in record:
+                    raise Error('Error parsing primer3_core output, key found twice in one record:' + key)
+                record[key] = value
+
+        if len(record) or remainder != '':
+            raise Error('Error reading primer3_core output file. Got to end file before a line of just "="')
+
+
+    # Yields (sequence ID, list of PrimerPairs) for each sequence in a primer3_core
+    # output file that has at least one primer pair, in the order of the file.
+    # Only the sequence IDs are kept between records, to check they are unique
+    def _primer_pairs_from_file(self, primer3_core_outfile):
+        sequence_ids = set()
+
+        with compression.open_read(primer3_core_outfile) as f:
+            for results in self._primer3_records(f):
+                if 'SEQUENCE_ID' not in results:
+                    raise Error('SEQUENCE_ID line not found in primer3_core output. Cannot continue')
+                elif results['SEQUENCE_ID'] in sequence_ids:
+                    raise Error('Sequence name found twice:' + results['SEQUENCE_ID'] + ' ... cannot continue')
+                sequence_ids.add(results['SEQUENCE_ID'])
+                if self._primer3_found_no_primers(results):
+                    continue
+
+                # remove everything after first white space so IDs match later,
+                # as bowtie2 will do the same in its output SAM file
+                results['SEQUENCE_ID'] = results['SEQUENCE_ID'].split(' ')[0]
+                pairs = self._primer3_sequence_results_to_list(results)
+                self._check_primer_pairs({results['SEQUENCE_ID']: pairs})
+                yield results['SEQUENCE_ID'], pairs
 
 
-    def run(self, outprefix):
+    def _load_primer_pairs(self, primer3_core_outfile):
+        return dict(self._primer_pairs_from_file(primer3_core_outfile))
+
+
+    # Writes primers to a FASTA file. primer_pairs is an iterable of (sequence ID,
+    # list of PrimerPairs), or if None then all the primer pairs in self.primer_pairs,
+    # sorted by sequence ID. Returns the number of primer pairs written
+    def _write_primers_fasta(self, outfile, primer_pairs=None, catalog_dir=None):
+        if primer_pairs is None:
+            primer_pairs = sorted(self.primer_pairs.items(), key=lambda x: x[0])
+        written = 0
+        catalog = None if catalog_dir is None else binary_catalog.Writer(catalog_dir, self.genome_name)
+
+        with compression.open_write(outfile, self.compression_codec, self.compression_level, self.threads) as f:
+            for sequence_id, pairs in primer_pairs:
+                for pair in pairs:
+                    print(pair.left_fasta, file=f)
+                    print(pair.right_fasta, file=f)
+                    if catalog is not None:
+                        catalog.add(pair)
+                written += len(pairs)
+
+        if catalog is not None:
+            catalog.close()
+        return written
+
+
+    # Yields the same as primer_pairs, sorted by sequence ID. The primer pairs of each
+    # sequence are written to tmp_file as they are read, so that only the pairs of
+    # one sequence are in memory at once. tmp_file is deleted afterwards
+    @staticmethod
+    def _sorted_by_sequence_id(primer_pairs, tmp_file):
+        offsets = {}
+        try:
+            with open(tmp_file, 'wb') as f:
+                for sequence_id, pairs in primer_pairs:
+                    offsets[sequence_id] = f.tell()
+                    pickle.dump(pairs, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+            with open(tmp_file, 'rb') as f:
+                for sequence_id in sorted(offsets):
+                    f.seek(offsets[sequence_id])
+                    yield sequence_id, pickle.load(f)
+        finally:
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+
+
+    # Runs primer3 and writes outprefix.primer3_core.out.gz and outprefix.primers.fasta.gz,
+    # and the same primers to the binary catalog outprefix.primer_catalog (see binary_catalog.Writer).
+    # The primers are written sorted by sequence ID, whatever the order of the sequences
+    # in the FASTA file, so that the primers file does not change if they are reordered.
+    # If keep_primer_pairs is False, self.primer_pairs is not made, and the primer pairs
+    # are sorted through a temporary file instead of in memory, so that memory use does
+    # not grow with the size of the genome.
+    # Returns the number of primer pairs
+    def run(self, outprefix, keep_primer_pairs=True):
         primer3_core_out = outprefix + '.primer3_core.out.gz'
-        self._run_primer3_core(self.input_fasta, self.config_file, primer3_core_out)
-        self.primer_pairs = self._load_primer_pairs(primer3_core_out)
-        self._write_primers_fasta(outprefix + '.primers.fasta.gz')
-
+        primers_fasta = outprefix + '.primers.fasta.gz'
+        catalog_dir = outprefix + '.primer_catalog'
+        self.primer_pairs = {}
+
+        if self.engine == 'bindings':
+            self.primer_pairs = self._run_primer3_bindings(self.input_fasta, self.config_file, primer3_core_out)
+            number_of_pairs = self._write_primers_fasta(primers_fasta, catalog_dir=catalog_dir)
+        else:
+            self._run_primer3_core(self.input_fasta, self.config_file, primer3_core_out)
+            primer_pairs = self._primer_pairs_from_file(primer3_core_out)
+            if keep_primer_pairs:
+                self.primer_pairs = dict(primer_pairs)
+                primer_pairs = None
+            else:
+                primer_pairs = self._sorted_by_sequence_id(primer_pairs, outprefix + '.tmp.primer_pairs.pickle')
+            number_of_pairs = self._write_primers_fasta(primers_fasta, primer_pairs, catalog_dir=catalog_dir)
+
+        if not keep_primer_pairs:
+            self.primer_pairs = None
+
+        return number_of_pairs
@@ -1,8 +1,17 @@
 import os
-import multiprocessing
+import shutil
 import primer3tools
 
 
+# Rough peak memory (bytes) used per byte of FASTA input by each task, plus a fixed
+# overhead per job, used to decide how many jobs can run at once within --max_memory
+memory_per_fasta_byte = {'primers': 2, 'bowtie2': 4, 'exact': 48, 'kmer_filter': 3}
+memory_overhead = 100 * 1024**2
+
+# Name of the file in the output directory of the metrics of the last run (see metrics.Stage)
+metrics_name = 'metrics.jsonl'
+
+
 def _make_directory(d):
     if os.path.exists(d):
         return
@@ -13,44 +22,279 @@ def _make_directory(d):
         raise Error('Error mkdir ' + d)
 
 
-def _run_analysis(genome_name, genome, primer3_config, outprefix):
-    primers_fasta = outprefix + '.primers.fasta.gz'
-    primer3_outfile = outprefix + '.primer3_core.out.gz'
+# Returns the name of the k-mer filter file of a genome (see kmer_filter.build)
+def kmer_filter_file(outprefix):
+    return outprefix + '.kmer_filter.npz'
+
+
+# Makes an index ('bowtie2' or 'exact') of a FASTA file, in the directory outprefix.<index_type>_index
+def _make_index(fasta_file, outprefix, index_type, threads=1):
+    index_dir = outprefix + '.' + index_type + '_index'
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    _make_directory(index_dir)
+
+    if index_type == 'bowtie2':
+        primer3tools.mapping.bowtie2_index(fasta_file, outprefix=os.path.join(index_dir, 'index'), threads=threads)
+    else:
+        primer3tools.exact_index.build(fasta_file, index_dir)
 
-    if genome.make_primers and ((not os.path.exists(primers_fasta)) or (not os.path.exists(primer3_outfile))):
-        p3 = primer3tools.primer3.Primer3(genome.fasta_file, primer3_config, genome_name)
-        p3.run(outprefix)
 
-    bowtie2_index_dir = outprefix + '.bowtie2_index'
-    bowtie2_index = os.path.join(bowtie2_index_dir, 'index')
+# The job functions below return the metrics record of the job
+def _run_primer3(genome_name, genome, primer3_config, primer3_options, outprefix):
+    with primer3tools.metrics.Stage('batch', 'primer3', genome_name) as stage:
+        p3 = primer3tools.primer3.Primer3(genome.fasta_file, primer3_config, genome_name, **primer3_options)
+        stage.count('primer_pairs', p3.run(outprefix, keep_primer_pairs=False))
+    return stage.record
 
-    if not primer3tools.mapping.is_bowtie2_indexed(bowtie2_index):
-        _make_directory(bowtie2_index_dir)
-        primer3tools.mapping.bowtie2_index(genome.fasta_file, outprefix=bowtie2_index)
 
+def _make_genome_index(name, fasta_file, outprefix, index_type, threads=1):
+    with primer3tools.metrics.Stage('batch', index_type + '_index', name) as stage:
+        _make_index(fasta_file, outprefix, index_type, threads=threads)
+        stage.count('genomes')
+        stage.count('fasta_bytes', os.path.getsize(fasta_file))
+    return stage.record
 
-# throws a pickle error without this wrapper...
-def _run_analysis_wrapper(y):
-    _run_analysis(*y)
-    return y
+
+def _make_kmer_filter(name, fasta_file, outprefix):
+    with primer3tools.metrics.Stage('batch', 'kmer_filter', name) as stage:
+        primer3tools.kmer_filter.build(fasta_file, kmer_filter_file(outprefix))
+        stage.count('genomes')
+        stage.count('fasta_bytes', os.path.getsize(fasta_file))
+    return stage.record
+
+
+def _make_combined_index(name, genomes, outprefix, index_type, threads=1):
+    with primer3tools.metrics.Stage('batch', index_type + '_index', name) as stage:
+        # each type of index of the same genomes can be made at the same time, so needs its own FASTA file
+        combined_fasta = outprefix + '.' + index_type + '.fa'
+        primer3tools.genome_set.write_combined_fasta(genomes, genomes, combined_fasta, separator=primer3tools.mapping.combined_index_separator)
+        stage.count('genomes', len(genomes))
+        stage.count('fasta_bytes', os.path.getsize(combined_fasta))
+        _make_index(combined_fasta, outprefix, index_type, threads=threads)
+        os.unlink(combined_fasta)
+    return stage.record
 
 
 class Error (Exception): pass
 
 
 class Primer3Batch:
-    def __init__(self, primer3_config, genomes_file, primer3_outdir, threads=1):
+    def __init__(self, primer3_config, genomes_file, primer3_outdir, threads=1, combined_index_size=0, index_type='bowtie2', primer3_threads=1, primer3_window=0, primer3_engine='subprocess', compression_codec='gzip', compression_level=9, max_memory=0, kmer_filter=False):
         self.primer3_config = os.path.abspath(primer3_config)
         self.genomes_file = os.path.abspath(genomes_file)
         self.primer3_outdir = os.path.abspath(primer3_outdir)
         self.threads = threads
+        self.max_memory = max_memory
+        self.combined_index_size = combined_index_size
+        self.kmer_filter = kmer_filter
+        if primer3_engine == 'auto':
+            primer3_engine = 'subprocess' if primer3tools.primer3.primer3_bindings is None else 'bindings'
+        # the compression of primer3 output files is not part of their artifact keys, because
+        # they are read the same way whatever the compression
+        primer3tools.compression.check_codec(compression_codec, compression_level)
+        self.primer3_options = {'threads': primer3_threads, 'window_size': primer3_window, 'engine': primer3_engine, 'compression_codec': compression_codec, 'compression_level': compression_level}
+
+        if index_type == 'both':
+            self.index_types = ['bowtie2', 'exact']
+        elif index_type == 'none':
+            self.index_types = []
+        elif index_type in ['bowtie2', 'exact']:
+            self.index_types = [index_type]
+        else:
+            raise Error('index_type must be one of bowtie2, exact, both, none. Got: ' + str(index_type))
+
+
+    def _update_combined_index_manifest(self, genomes):
+        # the genome names are checked before anything is changed, so that
+        # a bad name does not lose track of the existing combined indexes
+        if self.combined_index_size > 0:
+            for genome_name in genomes:
+                if primer3tools.mapping.combined_index_separator in genome_name:
+                    raise Error('Genome name "' + genome_name + '" cannot contain "' + primer3tools.mapping.combined_index_separator + '" when making combined indexes')
+            chunks = primer3tools.mapping.combined_index_chunks(genomes, self.combined_index_size)
+            for chunk_name in chunks:
+                if chunk_name in genomes:
+                    raise Error('Genome name "' + chunk_name + '" cannot be used when making combined indexes, because it is the name of a combined index')
+        else:
+            chunks = {}
+
+        manifest = os.path.join(self.primer3_outdir, primer3tools.mapping.combined_index_manifest)
+        if os.path.exists(manifest):
+            old_chunks = primer3tools.mapping.load_combined_index_manifest(manifest)
+            os.unlink(manifest)
+        else:
+            old_chunks = {}
+
+        # an index whose genomes have changed must be rebuilt
+        for chunk_name, genome_names in old_chunks.items():
+            if chunks.get(chunk_name, None) != genome_names:
+                for index_type in ['bowtie2', 'exact']:
+                    index_dir = os.path.join(self.primer3_outdir, chunk_name + '.' + index_type + '_index')
+                    if os.path.exists(index_dir):
+                        shutil.rmtree(index_dir)
+
+        if len(chunks):
+            primer3tools.mapping.write_combined_index_manifest(chunks, manifest)
+
+        return chunks
+
+
+    # Returns a dictionary of artifact name -> key, for every primer3 output
+    # and index that should be in the output directory
+    def _artifact_keys(self, genomes, chunks):
+        hashes = primer3tools.artifacts.hash_files([genomes[x].fasta_file for x in genomes] + [self.primer3_config], threads=self.threads)
+        version = primer3tools.common.version
+        keys = {}
+
+        if any(genomes[x].make_primers for x in genomes):
+            if self.primer3_options['engine'] == 'bindings':
+                primer3_version = 'primer3-py ' + primer3tools.primer3.primer3_bindings.__version__
+            else:
+                primer3_version = primer3tools.artifacts.tool_version('primer3_core', '-about')
+            for name in genomes:
+                if genomes[name].make_primers:
+                    keys[name + '.primers'] = primer3tools.artifacts.artifact_key('primers', version, primer3_version, name, hashes[genomes[name].fasta_file], hashes[self.primer3_config], self.primer3_options['window_size'])
+
+        if len(chunks) == 0:
+            index_inputs = {name: hashes[genomes[name].fasta_file] for name in genomes}
+        else:
+            index_inputs = {chunk_name: [[name, hashes[genomes[name].fasta_file]] for name in genome_names] for chunk_name, genome_names in chunks.items()}
+
+        for index_type in self.index_types:
+            if index_type == 'bowtie2':
+                tool_version = primer3tools.artifacts.tool_version('bowtie2-build', '--version')
+            else:
+                tool_version = [primer3tools.exact_index.format_version, primer3tools.exact_index.default_kmer_length]
+            for name, inputs in index_inputs.items():
+                keys[name + '.' + index_type + '_index'] = primer3tools.artifacts.artifact_key(index_type + '_index', version, tool_version, inputs)
+
+        # k-mer filters are always of each genome, even when the indexes are combined
+        if self.kmer_filter:
+            settings = [primer3tools.kmer_filter.format_version, primer3tools.kmer_filter.default_kmer_length, primer3tools.kmer_filter.default_bits_per_kmer]
+            for name in genomes:
+                keys[name + '.kmer_filter'] = primer3tools.artifacts.artifact_key('kmer_filter', version, settings, hashes[genomes[name].fasta_file])
+
+        return keys
+
+
+    # Returns True if all the output files of an artifact (see _artifact_keys) exist
+    def _artifact_exists(self, name):
+        outprefix, artifact_type = os.path.join(self.primer3_outdir, name).rsplit('.', maxsplit=1)
+        if artifact_type == 'primers':
+            return all(os.path.exists(outprefix + x) for x in ['.primers.fasta.gz', '.primer3_core.out.gz']) and primer3tools.binary_catalog.is_binary_catalog(outprefix + '.primer_catalog')
+        elif artifact_type == 'bowtie2_index':
+            return primer3tools.mapping.is_bowtie2_indexed(os.path.join(outprefix + '.bowtie2_index', 'index'))
+        elif artifact_type == 'exact_index':
+            return primer3tools.exact_index.is_exact_indexed(outprefix + '.exact_index')
+        elif artifact_type == 'kmer_filter':
+            return os.path.exists(kmer_filter_file(outprefix))
+        else:
+            raise Error('Unknown artifact type: ' + name)
+
+
+    # Returns the set of names of the artifacts in keys that need making, because their key
+    # in the manifest is different, or any of their files are missing (for example, deleted
+    # by hand, or primer3 output from a version of primer3tools that did not make them all)
+    def _to_make(self, keys, manifest):
+        return {name for name in keys if not (manifest.is_current(name, keys[name]) and self._artifact_exists(name))}
+
+
+    # Returns a scheduler.Job called name (the name of the artifact it makes) that does
+    # the task ('primers', 'bowtie2', 'exact' or 'kmer_filter'), with its size, threads and memory estimate
+    # (see memory_per_fasta_byte) made from the task and the FASTA files it uses
+    @staticmethod
+    def _scheduler_job(name, function, args, fasta_files, task, threads):
+        size = sum([os.path.getsize(x) for x in fasta_files])
+        memory = memory_overhead + size * memory_per_fasta_byte[task]
+        return primer3tools.scheduler.Job(name, function, args, size=size, threads=threads, memory=memory)
 
 
     def run(self):
         genomes = primer3tools.genome_set.GenomeSet(self.genomes_file)
         _make_directory(self.primer3_outdir)
-        pool = multiprocessing.Pool(self.threads)
+        metrics_file = os.path.join(self.primer3_outdir, metrics_name)
+        if os.path.exists(metrics_file):
+            os.unlink(metrics_file)
+
+        with primer3tools.metrics.Stage('batch', 'total') as stage:
+            job_records = self._run(genomes, metrics_file)
+            stage.count('jobs', len(job_records))
+            stage.count('primer_pairs', sum([x['counts'].get('primer_pairs', 0) for x in job_records]))
+
+        # jobs run in other processes, so the peak memory of the whole run is the largest of any of them
+        stage.record['peak_rss_bytes'] = max([stage.record['peak_rss_bytes']] + [x['peak_rss_bytes'] for x in job_records])
+        primer3tools.metrics.write_records(metrics_file, [stage.record])
+
+
+    # Returns a list of scheduler.Job, one for each artifact in to_make. chunks are
+    # the combined index chunks (empty if each genome has its own index)
+    def _jobs(self, genomes, chunks, to_make):
+        # Every artifact (see _artifact_keys) is made by its own job, so that primer3
+        # and indexing of all genomes run at the same time, and all jobs share the threads
+        primer3_jobs = [x for x in genomes if x + '.primers' in to_make]
+        index_jobs = []
+        for name in genomes if len(chunks) == 0 else chunks:
+            index_jobs += [(name, x) for x in self.index_types if name + '.' + x + '_index' in to_make]
+
+        # the threads are shared between the index jobs, as for mapping in get_unique.
+        # primer3 uses --primer3_threads threads
+        index_threads = max(1, self.threads // max(1, min(self.threads, len(index_jobs))))
+        primer3_options = dict(self.primer3_options, threads=max(1, min(self.primer3_options['threads'], self.threads)))
+        jobs = []
+
+        for name in primer3_jobs:
+            args = (name, genomes[name], self.primer3_config, primer3_options, os.path.join(self.primer3_outdir, name))
+            jobs.append(self._scheduler_job(name + '.primers', _run_primer3, args, [genomes[name].fasta_file], 'primers', primer3_options['threads']))
+
+        for name, index_type in index_jobs:
+            outprefix = os.path.join(self.primer3_outdir, name)
+            if len(chunks) == 0:
+                function, args, fasta_files = _make_genome_index, (name, genomes[name].fasta_file, outprefix, index_type, index_threads), [genomes[name].fasta_file]
+            else:
+                chunk_genomes = {x: genomes[x] for x in chunks[name]}
+                function, args, fasta_files = _make_combined_index, (name, chunk_genomes, outprefix, index_type, index_threads), [x.fasta_file for x in chunk_genomes.values()]
+            jobs.append(self._scheduler_job(name + '.' + index_type + '_index', function, args, fasta_files, index_type, index_threads))
+
+        for name in genomes:
+            if name + '.kmer_filter' in to_make:
+                args = (name, genomes[name].fasta_file, os.path.join(self.primer3_outdir, name))
+                jobs.append(self._scheduler_job(name + '.kmer_filter', _make_kmer_filter, args, [genomes[name].fasta_file], 'kmer_filter', 1))
+
+        return jobs
+
+
+    # Makes everything that is not up to date, and writes the metrics record of each job
+    # to metrics_file as it finishes. Returns the metrics records
+    def _run(self, genomes, metrics_file):
+        chunks = self._update_combined_index_manifest(genomes)
+        keys = self._artifact_keys(genomes, chunks)
+        manifest = primer3tools.artifacts.ArtifactManifest(os.path.join(self.primer3_outdir, primer3tools.artifacts.manifest_name))
+        to_make = self._to_make(keys, manifest)
+
+        # forget artifacts that are about to be remade (so that a crash part way through
+        # making one cannot leave it looking up to date), or are no longer wanted
+        for name in list(manifest.keys):
+            if name in to_make or name not in keys:
+                manifest.remove(name)
+                # an out of date k-mer filter could wrongly stop get_unique --kmer_filter
+                # from mapping primers, so it is deleted instead of only being forgotten
+                if name.endswith('.kmer_filter'):
+                    filename = kmer_filter_file(os.path.join(self.primer3_outdir, name[:-len('.kmer_filter')]))
+                    if os.path.exists(filename):
+                        os.unlink(filename)
+        manifest.save()
+
+        jobs = self._jobs(genomes, chunks, to_make)
 
-        x = [(name, genomes[name], self.primer3_config, os.path.join(self.primer3_outdir, name)) for name in genomes]
-        pool.map(_run_analysis_wrapper, x)
+        # record each artifact as soon as it is made, so that a rerun after
+        # a crash only makes the artifacts that were not finished
+        scheduler = primer3tools.scheduler.Scheduler(threads=self.threads, max_memory=self.max_memory)
+        records = []
+        for job, record in scheduler.run(jobs):
+            manifest.set(job.name, keys[job.name])
+            manifest.save()
+            primer3tools.metrics.write_records(metrics_file, [record])
+            records.append(record)
 
+        return records
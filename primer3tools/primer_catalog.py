@@ -0,0 +1,300 @@
+import bisect
+import hashlib
+import numpy
+import pyfastaq
+from primer3tools import binary_catalog, hit_table
+
+
+class Error (Exception): pass
+
+
+# All primer pairs that are checked for uniqueness. Pair number i has
+# name names[i] (the primer name without the trailing /1 or /2), and
+# its left and right primers have primer IDs 2i and 2i + 1
+class PrimerCatalog:
+    def __init__(self, fasta_file=None):
+        self.names = []
+        self._name_to_id = {}
+        self.sequences = []
+        if fasta_file is not None:
+            self._load_fasta(fasta_file)
+        self._set_lengths()
+        self._pair_keys = None
+
+
+    def __eq__(self, other):
+        return type(other) is type(self) and self.names == other.names and self.sequences == other.sequences
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def _set_lengths(self):
+        self.lengths = numpy.array([len(x) for x in self.sequences], dtype=numpy.int64)
+
+
+    # Primer pair name -> pair ID. A catalog made by from_binary_catalogs()
+    # only makes this when it is first used
+    @property
+    def name_to_id(self):
+        if self._name_to_id is None:
+            name_to_id = {}
+            for pair_id, name in enumerate(self.names):
+                if name in name_to_id:
+                    raise Error('Primer pair name found twice: ' + name)
+                name_to_id[name] = pair_id
+            self._name_to_id = name_to_id
+        return self._name_to_id
+
+
+    def _add_pair(self, name, left_sequence, right_sequence):
+        if name in self.name_to_id:
+            raise Error('Primer pair name found twice: ' + name)
+        self.name_to_id[name] = len(self.names)
+        self.names.append(name)
+        self.sequences.extend([left_sequence, right_sequence])
+
+
+    def _load_fasta(self, fasta_file):
+        for seq in pyfastaq.sequences.file_reader(fasta_file):
+            try:
+                name, left_or_right = seq.id.rsplit('/', maxsplit=1)
+            except:
+                raise Error('Primer name must end with /1 or /2. Got: ' + seq.id)
+
+            expected = '1' if len(self.sequences) % 2 == 0 else '2'
+            if left_or_right != expected or (expected == '2' and name != self.names[-1]):
+                raise Error('Error reading primers from ' + fasta_file + '. Expected each /1 primer to be followed by its /2 primer. Got: ' + seq.id)
+
+            if expected == '1':
+                if name in self.name_to_id:
+                    raise Error('Primer pair name found twice: ' + name)
+                self.name_to_id[name] = len(self.names)
+                self.names.append(name)
+
+            # bowtie2 reports upper case sequences, whatever the case of the input
+            self.sequences.append(seq.seq.upper())
+
+        if len(self.sequences) % 2 != 0:
+            raise Error('Error reading primers from ' + fasta_file + '. Last primer has no /2 primer')
+
+
+    def primer_id(self, primer_name):
+        try:
+            name, left_or_right = primer_name.rsplit('/', maxsplit=1)
+            return 2 * self.name_to_id[name] + {'1': 0, '2': 1}[left_or_right]
+        except:
+            raise Error('Primer not found in primer catalog: ' + primer_name)
+
+
+    # Returns a numpy array of a 64-bit key for each primer pair, made from its name and sequences,
+    # so that primer pairs can be matched between different runs
+    def pair_keys(self):
+        if self._pair_keys is None:
+            keys = bytearray()
+            sequences = iter(self.sequences)
+            for name, left_sequence, right_sequence in zip(self.names, sequences, sequences):
+                data = '\t'.join([name, left_sequence, right_sequence]).encode()
+                keys.extend(hashlib.blake2b(data, digest_size=8).digest())
+            self._pair_keys = numpy.frombuffer(bytes(keys), dtype=numpy.uint64)
+        return self._pair_keys
+
+
+    def content_hash(self):
+        return hashlib.sha256(self.pair_keys().tobytes()).hexdigest()
+
+
+    # Yields lines of a fasta file of the given primer pairs
+    def fasta_lines(self, pair_ids):
+        for pair_id in pair_ids:
+            yield '>' + self.names[pair_id] + '/1\n' + self.sequences[2 * pair_id] + '\n'
+            yield '>' + self.names[pair_id] + '/2\n' + self.sequences[2 * pair_id + 1] + '\n'
+
+
+    def write_fasta(self, filename):
+        with open(filename, 'w') as f:
+            f.writelines(self.fasta_lines(range(len(self))))
+
+
+# Read-only list of the names (items_per_pair=1) or upper case primer sequences
+# (items_per_pair=2) of all the primer pairs in a list of binary_catalog.BinaryCatalog
+# objects. Items are decoded from the memory mapped catalogs when they are used
+class _BinaryCatalogsList:
+    def __init__(self, binary_catalogs, items_per_pair):
+        self.binary_catalogs = binary_catalogs
+        self.items_per_pair = items_per_pair
+        self.starts = [0]
+        for catalog in binary_catalogs:
+            self.starts.append(self.starts[-1] + items_per_pair * len(catalog))
+
+
+    def __len__(self):
+        return self.starts[-1]
+
+
+    def _get(self, i, catalog):
+        if self.items_per_pair == 1:
+            return catalog.name(i)
+        else:
+            # bowtie2 reports upper case sequences, whatever the case of the input
+            return catalog.sequence(i, upper=True)
+
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[x] for x in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('Index out of range: ' + str(i))
+        catalog_index = bisect.bisect_right(self.starts, i) - 1
+        return self._get(i - self.starts[catalog_index], self.binary_catalogs[catalog_index])
+
+
+    def __iter__(self):
+        for catalog in self.binary_catalogs:
+            for start in range(0, len(catalog), binary_catalog.chunk_size):
+                end = start + binary_catalog.chunk_size
+                if self.items_per_pair == 1:
+                    yield from catalog.names(start, end)
+                else:
+                    yield from catalog.sequences(2 * start, 2 * end, upper=True)
+
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(x == y for x, y in zip(self, other))
+
+
+# Returns a PrimerCatalog of the primer pairs in a list of binary_catalog.BinaryCatalog
+# objects, in order, without parsing any FASTA files. Its names and sequences are
+# backed by the memory mapped catalogs, instead of being loaded into memory
+def from_binary_catalogs(binary_catalogs):
+    genome_names = [x.genome_name for x in binary_catalogs]
+    if len(set(genome_names)) != len(genome_names):
+        raise Error('Binary primer catalogs of the same genome given more than once: ' + ','.join(sorted({x for x in genome_names if genome_names.count(x) > 1})))
+
+    catalog = PrimerCatalog()
+    catalog.names = _BinaryCatalogsList(binary_catalogs, 1)
+    catalog.sequences = _BinaryCatalogsList(binary_catalogs, 2)
+    catalog._name_to_id = None
+    catalog.lengths = numpy.concatenate([numpy.diff(x.offsets) for x in binary_catalogs] + [numpy.zeros(0, dtype=numpy.int64)])
+    return catalog
+
+
+# Returns a PrimerCatalog of a list of distinct sequences, two to a "pair", in order.
+# Each pair is named after its sequences. Catalogs need an even number of primers,
+# so with an odd number of sequences the last one is also used as the extra primer
+def sequence_pairs_catalog(sequences):
+    if len(sequences) % 2 == 1:
+        sequences = sequences + [sequences[-1]]
+
+    catalog = PrimerCatalog()
+    for i in range(0, len(sequences), 2):
+        catalog._add_pair(sequences[i] + '_' + sequences[i + 1], sequences[i], sequences[i + 1])
+    catalog._set_lengths()
+    return catalog
+
+
+# The distinct primer sequences of a PrimerCatalog, so that each sequence only
+# needs mapping once, however many primer pairs use it (as left or right primer).
+# The sequences are stored in their own PrimerCatalog (see sequence_pairs_catalog),
+# in order of first appearance. The extra primer when there is an odd number of
+# sequences is never used. The pairs change when sequences are added, so mapping
+# checkpoints are kept per sequence (see sequence_keys)
+class UniquePrimers:
+    def __init__(self, catalog):
+        sequence_ids = {}
+        unique_sequences = []
+        self.query_ids = numpy.zeros(len(catalog.sequences), dtype=numpy.int64)
+
+        for primer_id, seq in enumerate(catalog.sequences):
+            if seq not in sequence_ids:
+                sequence_ids[seq] = len(unique_sequences)
+                unique_sequences.append(seq)
+            self.query_ids[primer_id] = sequence_ids[seq]
+
+        self.catalog = sequence_pairs_catalog(unique_sequences)
+        self.number_of_primers = len(catalog.sequences)
+        self.number_of_sequences = len(sequence_ids)
+
+
+    # Returns a numpy array of a 64-bit key of each distinct sequence (in order, not
+    # including the extra primer), so that hits of sequences can be matched between runs
+    def sequence_keys(self):
+        keys = bytearray()
+        for seq in self.catalog.sequences[:self.number_of_sequences]:
+            keys.extend(hashlib.blake2b(seq.encode(), digest_size=8).digest())
+        return numpy.frombuffer(bytes(keys), dtype=numpy.uint64)
+
+
+    # Returns number of primers / number of distinct sequences
+    def dedup_ratio(self):
+        return self.number_of_primers / max(1, self.number_of_sequences)
+
+
+    # Returns a HitTable of the hits of the sequences of primer_ids (an array of primer
+    # IDs of the original catalog), given to each of those primers. columns are the
+    # columns of a HitTable of hits of self.catalog, sorted by query ID. Hits are
+    # sorted by primer ID, otherwise in the same order as the columns
+    def _expand(self, columns, contig_names, primer_ids):
+        query_ids, contig_ids, starts, is_reverse = columns
+        primer_ids = primer_ids[numpy.argsort(self.query_ids[primer_ids], kind='stable')]
+        primer_queries = self.query_ids[primer_ids]
+        wanted = numpy.unique(primer_queries)
+        first_rows = numpy.searchsorted(query_ids, wanted, side='left')
+        rows = hit_table.ranges(first_rows, numpy.searchsorted(query_ids, wanted, side='right') - first_rows)
+        first_primers = numpy.searchsorted(primer_queries, query_ids[rows], side='left')
+        counts = numpy.searchsorted(primer_queries, query_ids[rows], side='right') - first_primers
+        expanded_primer_ids = primer_ids[hit_table.ranges(first_primers, counts)]
+        rows = numpy.repeat(rows, counts)
+        order = numpy.argsort(expanded_primer_ids, kind='stable')
+        expanded = hit_table.HitTable()
+        expanded.add_columns(expanded_primer_ids[order], contig_ids[rows[order]], starts[rows[order]], is_reverse[rows[order]], contig_names)
+        return expanded
+
+
+    @staticmethod
+    def _sorted_columns(hits):
+        columns = hits.columns()
+        order = numpy.argsort(columns[0], kind='stable')
+        return tuple(x[order] for x in columns)
+
+
+    # Given a HitTable of hits of the sequences in self.catalog, returns a HitTable
+    # of the same hits for every primer of the original catalog that has that
+    # sequence. Hits are sorted by primer ID, otherwise in the same order as the input
+    def expand_hits(self, hits):
+        return self._expand(self._sorted_columns(hits), hits.contig_names, numpy.arange(self.number_of_primers, dtype=numpy.int64))
+
+
+    # Yields arrays of the primer IDs of batches of consecutive primer pairs of the original
+    # catalog that have about batch_size hits when expanded, given the number of hits of
+    # each sequence. Primer pairs with no hits are not in any of them
+    def _primer_id_batches(self, hits_per_sequence, batch_size):
+        hits_per_pair = hits_per_sequence[self.query_ids].reshape(-1, 2).sum(axis=1)
+        pair_ids = numpy.flatnonzero(hits_per_pair)
+        pair_hits = hits_per_pair[pair_ids]
+        batches = (numpy.cumsum(pair_hits) - pair_hits) // max(1, batch_size)
+        for batch_pair_ids in numpy.split(pair_ids, numpy.flatnonzero(numpy.diff(batches)) + 1):
+            if len(batch_pair_ids):
+                yield numpy.stack([2 * batch_pair_ids, 2 * batch_pair_ids + 1], axis=1).ravel()
+
+
+    # The same as expand_hits, but yields the hits in HitTables of consecutive primer pairs
+    # of the original catalog, so that they are not all in memory at once. Each has all the
+    # hits of its primer pairs, and about batch_size hits, unless one primer pair has more.
+    # Primer pairs with no hits are not in any of them
+    def expand_hits_in_batches(self, hits, batch_size):
+        columns = self._sorted_columns(hits)
+        hits_per_sequence = numpy.bincount(columns[0], minlength=len(self.catalog.sequences))
+        for primer_ids in self._primer_id_batches(hits_per_sequence, batch_size):
+            yield self._expand(columns, hits.contig_names, primer_ids)
+
+
+    # The same as expand_hits_in_batches, but the hits are in a closed hit_table.HitFile,
+    # and only the hits of the sequences of one batch are read from it at a time
+    def expand_hit_file_in_batches(self, hit_file, batch_size):
+        for primer_ids in self._primer_id_batches(hit_file.hits_per_primer, batch_size):
+            hits = hit_file.hits_of_primers(self.query_ids[primer_ids])
+            yield self._expand(hits.columns(), hits.contig_names, primer_ids)
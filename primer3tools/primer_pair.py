@@ -3,32 +3,35 @@ from pyfastaq import sequences
 class Error (Exception): pass
 
 
+# There can be millions of these, so they only store the primer3 results needed,
+# in slots instead of a __dict__. The names and pyfastaq Fasta objects of the
+# primers are made when they are used
 class PrimerPair:
+    __slots__ = ['index', 'genome_name', 'sequence_id', 'left_start', 'right_start', 'left_seq', 'right_seq', '_hits_to_genomes']
+
     def __init__(self, data_dict, index, genome_name):
         self.index = index
         self.genome_name = genome_name
         self.sequence_id = None
         self.left_start = None
         self.right_start = None
-        self.left_fasta = None
-        self.right_fasta = None
-        self.hits_to_genomes = {}
+        self.left_seq = None
+        self.right_seq = None
+        self._hits_to_genomes = None
 
         if data_dict is not None and self.index is not None:
             try:
                 self.sequence_id = data_dict.get('SEQUENCE_ID', None)
 
                 # primer3 reports the end position of the sequence, and it is reverse complemented,
-                # so the primer pairs look like proper read pairs
+                # so the primer pairs look like proper read pairs
                 left_sequence = data_dict.get('PRIMER_LEFT_' + str(self.index) + '_SEQUENCE', None)
                 right_sequence = data_dict.get('PRIMER_RIGHT_' + str(self.index) + '_SEQUENCE', None)
                 self.left_start = int(data_dict['PRIMER_LEFT_' + str(self.index)].split(',')[0])
                 right_end = int(data_dict['PRIMER_RIGHT_' + str(self.index)].split(',')[0])
                 self.right_start = right_end - len(right_sequence) + 1
-
-                name_prefix = '__'.join([self.genome_name, self.sequence_id, str(self.index), str(self.left_start), str(self.right_start)])
-                self.left_fasta = sequences.Fasta(name_prefix + '/1', left_sequence)
-                self.right_fasta = sequences.Fasta(name_prefix + '/2', right_sequence)
+                self.left_seq = left_sequence
+                self.right_seq = right_sequence
             except:
                 raise Error('Error making PrimerPair from data_dict:\n' + str(data_dict))
 
@@ -37,8 +40,34 @@ class PrimerPair:
             raise Error('Error making PrimerPair from data_dict:\n' + str(data_dict))
 
 
+    def _values(self):
+        return tuple(getattr(self, x) for x in self.__slots__ if x != '_hits_to_genomes') + (self._hits_to_genomes or {},)
+
+
     def __eq__(self, other):
-        return type(other) is type(self) and self.__dict__ == other.__dict__
+        return type(other) is type(self) and self._values() == other._values()
+
+
+    @property
+    def hits_to_genomes(self):
+        if self._hits_to_genomes is None:
+            self._hits_to_genomes = {}
+        return self._hits_to_genomes
+
+
+    @property
+    def name(self):
+        return '__'.join([self.genome_name, self.sequence_id, str(self.index), str(self.left_start), str(self.right_start)])
+
+
+    @property
+    def left_fasta(self):
+        return None if self.left_seq is None else sequences.Fasta(self.name + '/1', self.left_seq)
+
+
+    @property
+    def right_fasta(self):
+        return None if self.right_seq is None else sequences.Fasta(self.name + '/2', self.right_seq)
 
 
     def has_all_info(self):
@@ -46,8 +75,8 @@ class PrimerPair:
             self.sequence_id,
             self.left_start,
             self.right_start,
-            self.left_fasta,
-            self.right_fasta
+            self.left_seq,
+            self.right_seq
         ]
 
 
@@ -57,7 +86,7 @@ class PrimerPair:
             str(self.index),
             str(self.left_start),
             str(self.right_start),
-            self.left_fasta.seq,
-            self.right_fasta.seq
+            self.left_seq,
+            self.right_seq
         ])
 
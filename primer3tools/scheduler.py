@@ -0,0 +1,91 @@
+import concurrent.futures
+
+
+class Error (Exception): pass
+
+
+# A job for Scheduler: function(*args) is run in a separate process. size is used
+# to order the jobs (for example, the size of the input files), and threads and
+# memory (in bytes) are the resources the job is expected to use
+class Job:
+    def __init__(self, name, function, args, size=0, threads=1, memory=0):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.size = size
+        self.threads = threads
+        self.memory = memory
+
+
+    def __repr__(self):
+        return 'Job(' + ', '.join([repr(self.name), 'size=' + str(self.size), 'threads=' + str(self.threads), 'memory=' + str(self.memory)]) + ')'
+
+
+# Runs jobs in separate processes, largest first, so that the longest jobs do not
+# start last. A job is only started when the threads and memory it needs are free,
+# out of a total of threads and max_memory (in bytes, where 0 means no limit).
+# Jobs are started strictly in order of size, so a large job waiting for
+# resources is not overtaken by smaller jobs. A job that needs more than the total
+# is given the total, and so runs on its own
+class Scheduler:
+    def __init__(self, threads=1, max_memory=0):
+        if threads < 1:
+            raise Error('Number of threads must be at least 1. Got: ' + str(threads))
+        if max_memory < 0:
+            raise Error('Maximum memory cannot be negative. Got: ' + str(max_memory))
+
+        self.threads = threads
+        self.max_memory = max_memory
+
+
+    @staticmethod
+    def _sort_jobs(jobs):
+        return sorted(jobs, key=lambda x: (-x.size, x.name))
+
+
+    # Returns the threads and memory that a job is given from the total
+    def _job_resources(self, job):
+        threads = max(1, min(job.threads, self.threads))
+        memory = job.memory if self.max_memory == 0 else min(job.memory, self.max_memory)
+        return threads, memory
+
+
+    # Returns the number of jobs at the start of pending (which is sorted by
+    # _sort_jobs) that can be started with the free threads and memory
+    def _number_to_start(self, pending, free_threads, free_memory):
+        number = 0
+        for job in pending:
+            threads, memory = self._job_resources(job)
+            if threads > free_threads or (self.max_memory > 0 and memory > free_memory):
+                break
+            free_threads -= threads
+            free_memory -= memory
+            number += 1
+        return number
+
+
+    # Runs all the jobs, and yields (job, return value of job's function) as each job finishes
+    def run(self, jobs):
+        pending = self._sort_jobs(jobs)
+        if len(pending) == 0:
+            return
+
+        free_threads = self.threads
+        free_memory = self.max_memory
+        running = {}
+
+        with concurrent.futures.ProcessPoolExecutor(min(self.threads, len(pending))) as executor:
+            while len(pending) or len(running):
+                for i in range(self._number_to_start(pending, free_threads, free_memory)):
+                    job = pending.pop(0)
+                    threads, memory = self._job_resources(job)
+                    free_threads -= threads
+                    free_memory -= memory
+                    running[executor.submit(job.function, *job.args)] = (job, threads, memory)
+
+                finished, not_finished = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    job, threads, memory = running.pop(future)
+                    free_threads += threads
+                    free_memory += memory
+                    yield job, future.result()
@@ -7,7 +7,16 @@ def run():
         usage = 'primer3tools batch [options] <primer3_config> <genomes_file> <outdir>'
     )
 
-    parser.add_argument('--threads', type=int, help='Number of threads [%(default)s]', default=1)
+    parser.add_argument('--threads', type=int, help='Total number of threads. Primer3 and indexing tasks of all genomes are run at once (largest first) while there are threads free, and bowtie2-build threads are shared between them [%(default)s]', default=1, metavar='INT')
+    parser.add_argument('--max_memory', type=float, help='Maximum total memory in GB. Tasks are only run at once if their estimated total memory is less than this. 0 means no limit [%(default)s]', default=0, metavar='FLOAT')
+    parser.add_argument('--combined_index_size', type=int, help='Number of genomes in each combined bowtie2 index. 0 means make one index per genome [%(default)s]', default=0, metavar='INT')
+    parser.add_argument('--index_type', choices=['bowtie2', 'exact', 'both', 'none'], help='Type of index to make of each genome. bowtie2: for the bowtie2 mapper of get_unique. exact: for the exact match mapper of get_unique. both: make both types. none: do not make an index, for the scan mapper of get_unique [%(default)s]', default='bowtie2')
+    parser.add_argument('--kmer_filter', action='store_true', help='Also make a Bloom filter of the k-mers of each genome, for primer3tools get_unique --kmer_filter')
+    parser.add_argument('--primer3_threads', type=int, help='Number of primer3_core processes to run on each genome at once, each on a different group of contigs [%(default)s]', default=1, metavar='INT')
+    parser.add_argument('--primer3_window', type=int, help='Split contigs longer than this into overlapping windows, and run primer3_core on each window. The overlap is the maximum product size in the primer3 config file. 0 means do not split contigs [%(default)s]', default=0, metavar='INT')
+    parser.add_argument('--primer3_engine', choices=['subprocess', 'bindings', 'auto'], help='How primer3 is run. subprocess: run primer3_core. bindings: call primer3 in-process using the python package primer3-py, which must be installed. auto: use bindings if primer3-py is installed, otherwise subprocess [%(default)s]', default='subprocess')
+    parser.add_argument('--compression', choices=primer3tools.compression.codecs, help='How primer3 output files (*.primer3_core.out.gz and *.primers.fasta.gz) are compressed. gzip: use gzip. pigz: use pigz (which must be in your path), with --primer3_threads threads. none: do not compress. The files are named *.gz whatever this option is [%(default)s]', default='gzip')
+    parser.add_argument('--compression_level', type=int, help='Compression level of primer3 output files, from 1 (fastest) to 9 (smallest). Ignored if --compression is none [%(default)s]', default=9, metavar='INT')
     parser.add_argument('primer3_config', help='Primer3 config file')
     parser.add_argument('genomes_file', help='File of genomes information')
     parser.add_argument('outdir', help='Primer3 output directory')
@@ -17,6 +26,15 @@ def run():
         options.primer3_config,
         options.genomes_file,
         options.outdir,
-        threads=options.threads
+        threads=options.threads,
+        max_memory=int(options.max_memory * 1024**3),
+        combined_index_size=options.combined_index_size,
+        index_type=options.index_type,
+        primer3_threads=options.primer3_threads,
+        primer3_window=options.primer3_window,
+        primer3_engine=options.primer3_engine,
+        compression_codec=options.compression,
+        compression_level=options.compression_level,
+        kmer_filter=options.kmer_filter,
     )
     batch.run()
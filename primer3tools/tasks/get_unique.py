@@ -9,6 +9,15 @@ def run():
 
     parser.add_argument('--min_product_length', type=int, help='Minimum length of PCR product [%(default)s]', default=50, metavar='INT')
     parser.add_argument('--max_product_length', type=int, help='Maximum length of PCR product [%(default)s]', default=1000, metavar='INT')
+    parser.add_argument('--threads', type=int, help='Number of threads, shared between concurrent bowtie2 runs and the threads of each run [%(default)s]', default=1, metavar='INT')
+    parser.add_argument('--mapper', choices=['bowtie2', 'exact', 'scan'], help='How perfect matches of primers to genomes are found. bowtie2: use bowtie2. exact: use the exact match index made by "primer3tools batch --index_type exact". scan: read each genome FASTA file, without needing an index [%(default)s]', default='bowtie2')
+    parser.add_argument('--mapping_io', choices=['file', 'sam', 'bam'], help='How primers are given to bowtie2 and its output is read. file: use a temporary SAM file. sam: stream primers into bowtie2 and read its SAM output through a pipe. bam: as sam, but convert to BAM using samtools [%(default)s]', default='file')
+    parser.add_argument('--checkpoint_dir', help='Directory of checkpoint files of mapping results. When rerunning with the same directory, only new primers and new genomes are mapped, and an interrupted run continues from the last finished genome', metavar='DIR')
+    parser.add_argument('--no_dedup_primers', action='store_true', help='Map every primer. By default, each distinct primer sequence is only mapped once, and its hits are used for every primer pair that has that sequence')
+    parser.add_argument('--max_hits_per_primer', type=int, help='Only keep up to this many hits of each primer in each genome (or combined index). Primer pairs with more hits than this (and at least two matches) cannot be unique, so their hits in out.all_primers.hits.tsv are incomplete, and they are listed in out.repetitive_primer_pairs.txt. Unique primer pairs are the same whatever this is. 0 means no limit [%(default)s]', default=0, metavar='INT')
+    parser.add_argument('--kmer_filter', action='store_true', help='Use the k-mer filter of each genome made by primer3tools batch --kmer_filter to skip mapping primer pairs to genomes where they cannot match. The output files are the same as without this option')
+    parser.add_argument('--max_memory', type=float, help='Maximum memory in GB (roughly) for the matches of primer pairs. When they would use more than this, they are written to temporary files, which are merged when writing the output files. 0 means keep all the matches in memory [%(default)s]', default=0, metavar='FLOAT')
+    parser.add_argument('--hits_db', action='store_true', help='Also write the hits of all primer pairs to a SQLite database called outprefix.hits.sqlite, with one row per hit, indexed by primer pair, genome and contig')
     parser.add_argument('genomes_file', help='Input file')
     parser.add_argument('primer3_outdir', help='Primer3 output directory')
     parser.add_argument('outprefix', help='Prefix of output files')
@@ -21,6 +30,15 @@ def run():
         options.outprefix,
         min_product_length=options.min_product_length,
         max_product_length=options.max_product_length,
+        threads=options.threads,
+        mapping_io=options.mapping_io,
+        checkpoint_dir=options.checkpoint_dir,
+        mapper=options.mapper,
+        dedup_primers=not options.no_dedup_primers,
+        hits_db=options.hits_db,
+        max_hits_per_primer=options.max_hits_per_primer,
+        kmer_filter=options.kmer_filter,
+        max_memory=int(options.max_memory * 1024**3),
     )
 
     u.run()
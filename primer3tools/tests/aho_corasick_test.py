@@ -0,0 +1,116 @@
+import unittest
+import os
+import random
+from primer3tools import aho_corasick, hit_table, primer_catalog
+
+modules_dir = os.path.dirname(os.path.abspath(aho_corasick.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestAhoCorasick(unittest.TestCase):
+    def test_automaton_scan(self):
+        '''test Automaton scan'''
+        automaton = aho_corasick.Automaton([b'ACG', b'CG', b'GTA', b'ACGTAC', b'A'])
+        expected = [(0, 4), (0, 0), (1, 1), (2, 2), (4, 4), (0, 3), (4, 0), (5, 1), (9, 4), (10, 4)]
+        self.assertEqual(expected, list(automaton.scan('ACGTACGNNAa')))
+        self.assertEqual([], list(automaton.scan('')))
+        self.assertEqual([], list(automaton.scan(b'TTTT')))
+
+        with self.assertRaises(aho_corasick.Error):
+            aho_corasick.Automaton([b'ACN'])
+        with self.assertRaises(aho_corasick.Error):
+            aho_corasick.Automaton([b''])
+
+
+    def test_automaton_scan_random(self):
+        '''test Automaton scan against brute force search'''
+        random.seed(42)
+        patterns = list(set(''.join(random.choice('ACGT') for _ in range(random.randint(1, 6))).encode() for _ in range(100)))
+        seq = ''.join(random.choice('ACGTN') for _ in range(2000))
+        expected = set()
+        for i, pattern in enumerate(patterns):
+            for start in range(len(seq) - len(pattern) + 1):
+                if seq[start:start + len(pattern)] == pattern.decode():
+                    expected.add((start, i))
+
+        got = list(aho_corasick.Automaton(patterns).scan(seq))
+        self.assertEqual(len(expected), len(got))
+        self.assertEqual(expected, set(got))
+
+
+    def test_primer_scanner(self):
+        '''test PrimerScanner'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'exact_index_test.primers.fa'))
+        # same hits as found by exact_index_test
+        expected = hit_table.HitTable()
+        expected.add(0, 'ctg1', 0, True)
+        expected.add(0, 'ctg1', 3, False)
+        expected.add(0, 'ctg1', 22, False)
+        expected.add(1, 'ctg1', 12, False)
+        expected.add(1, 'ctg1', 16, False)
+        expected.add(1, 'ctg2', 3, False)
+        expected.add(2, 'ctg1', 9, False)
+        expected.add(2, 'ctg2', 0, False)
+        expected.add(4, 'ctg1', 3, True)
+        expected.add(4, 'ctg1', 4, True)
+        expected.add(4, 'ctg1', 6, False)
+        expected.add(4, 'ctg1', 7, False)
+        expected.add(4, 'ctg1', 22, True)
+        expected.add(4, 'ctg1', 23, True)
+        expected.add(4, 'ctg1', 25, False)
+        expected.add(4, 'ctg1', 26, False)
+        expected.add(5, 'ctg1', 10, False)
+        expected.add(5, 'ctg2', 1, False)
+        # the default k is longer than all the primers. Check that the k-mer lookup
+        # also works, including primers that match across two chunks of a contig
+        for kmer_length, chunk_size in [(12, 1000000), (4, 1000000), (4, 5), (2, 1)]:
+            scanner = aho_corasick.PrimerScanner(catalog, range(6), kmer_length=kmer_length, chunk_size=chunk_size)
+            self.assertEqual(expected, scanner.hit_table(os.path.join(data_dir, 'exact_index_test.fa')))
+
+        scanner = aho_corasick.PrimerScanner(catalog, [2, 3])
+        expected = hit_table.HitTable()
+        expected.add(2, 'ctg1', 9, False)
+        expected.add(2, 'ctg2', 0, False)
+        self.assertEqual(expected, scanner.hit_table(os.path.join(data_dir, 'exact_index_test.fa')))
+
+
+    def test_primer_scanner_random(self):
+        '''test PrimerScanner against Automaton'''
+        random.seed(42)
+        primers_fasta = 'tmp.aho_corasick_test.primers.fa'
+        genome_fasta = 'tmp.aho_corasick_test.genome.fa'
+        genome = [''.join(random.choice('ACGTacgN') for _ in range(length)) for length in [3000, 10, 0, 500]]
+        with open(genome_fasta, 'w') as f:
+            for i, seq in enumerate(genome):
+                print('>ctg' + str(i) + ' description', seq, sep='\n', file=f)
+
+        # primers from the genome, so that most of them match, and some random ones
+        with open(primers_fasta, 'w') as f:
+            for i in range(60):
+                length = random.randint(2, 20)
+                start = random.randint(0, len(genome[0]) - length)
+                left = genome[0][start:start + length].upper().replace('N', 'A') if i % 3 else ''.join(random.choice('ACGT') for _ in range(length))
+                print('>p' + str(i) + '/1', left, '>p' + str(i) + '/2', 'ACGTACGT' if i == 0 else random.choice(['ACN', 'GC', 'TTAGCA']), sep='\n', file=f)
+
+        catalog = primer_catalog.PrimerCatalog(primers_fasta)
+        contig_names = ['ctg' + str(i) for i in range(len(genome))]
+        expected = hit_table.HitTable()
+        for primer_id in range(len(catalog.sequences)):
+            seq = catalog.sequences[primer_id]
+            if 'N' in seq:
+                continue
+            reverse = seq.translate(str.maketrans('ACGT', 'TGCA'))[::-1]
+            found = set()
+            for is_reverse, pattern in [(False, seq), (True, reverse)][:1 if reverse == seq else 2]:
+                for contig_id, contig in enumerate(genome):
+                    found.update([(contig_id, x[0], is_reverse) for x in aho_corasick.Automaton([pattern.encode()]).scan(contig)])
+            for contig_id, start, is_reverse in sorted(found):
+                expected.add(primer_id, contig_names[contig_id], start, is_reverse)
+        self.assertGreater(len(expected), 100)
+
+        for kmer_length, chunk_size in [(12, 1000000), (8, 100), (3, 7)]:
+            scanner = aho_corasick.PrimerScanner(catalog, range(len(catalog.sequences)), kmer_length=kmer_length, chunk_size=chunk_size)
+            self.assertEqual(expected, scanner.hit_table(genome_fasta))
+
+        os.unlink(primers_fasta)
+        os.unlink(genome_fasta)
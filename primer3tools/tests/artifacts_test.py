@@ -0,0 +1,60 @@
+import unittest
+import os
+from primer3tools import artifacts, common
+
+modules_dir = os.path.dirname(os.path.abspath(artifacts.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestArtifacts(unittest.TestCase):
+    def test_hash_files(self):
+        '''test hash_files'''
+        file1 = os.path.join(data_dir, 'uniqueness_test_parse_sam.sam')
+        file2 = os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa')
+        expected = {
+            file1: common.sha256_of_files([file1]),
+            file2: common.sha256_of_files([file2]),
+        }
+        self.assertEqual(expected, artifacts.hash_files([file1, file2]))
+        self.assertEqual(expected, artifacts.hash_files([file2, file1, file2], threads=2))
+        self.assertEqual({}, artifacts.hash_files([], threads=2))
+
+
+    def test_artifact_key(self):
+        '''test artifact_key'''
+        key = artifacts.artifact_key('primers', 'hash1', ['genome', 'hash2'])
+        self.assertEqual(key, artifacts.artifact_key('primers', 'hash1', ['genome', 'hash2']))
+        self.assertNotEqual(key, artifacts.artifact_key('primers', 'hash1', ['genome', 'hash3']))
+        self.assertNotEqual(key, artifacts.artifact_key('primers', 'hash1genome', 'hash2'))
+
+
+    def test_tool_version(self):
+        '''test tool_version'''
+        self.assertEqual('42', artifacts.tool_version('echo', '42'))
+
+
+    def test_artifact_manifest(self):
+        '''test ArtifactManifest'''
+        tmpfile = 'tmp.test_artifact_manifest.json'
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        manifest = artifacts.ArtifactManifest(tmpfile)
+        self.assertFalse(manifest.is_current('a', 'key1'))
+        manifest.set('a', 'key1')
+        manifest.set('b', 'key2')
+        manifest.save()
+
+        manifest = artifacts.ArtifactManifest(tmpfile)
+        self.assertTrue(manifest.is_current('a', 'key1'))
+        self.assertFalse(manifest.is_current('a', 'key2'))
+        self.assertTrue(manifest.is_current('b', 'key2'))
+        manifest.remove('b')
+        manifest.remove('c')
+        manifest.save()
+
+        manifest = artifacts.ArtifactManifest(tmpfile)
+        self.assertEqual({'a': 'key1'}, manifest.keys)
+        os.unlink(tmpfile)
+
+        with self.assertRaises(artifacts.Error):
+            artifacts.ArtifactManifest(os.path.join(data_dir, 'uniqueness_test_parse_sam.sam'))
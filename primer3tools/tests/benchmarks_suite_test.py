@@ -0,0 +1,36 @@
+import unittest
+import os
+import subprocess
+import sys
+from primer3tools import uniqueness
+
+modules_dir = os.path.dirname(os.path.abspath(uniqueness.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+suite_script = os.path.join(os.path.dirname(modules_dir), 'benchmarks', 'suite.py')
+
+
+@unittest.skipUnless(os.path.exists(suite_script), 'benchmarks/suite.py not found')
+class TestBenchmarksSuite(unittest.TestCase):
+    def test_suite_smoke(self):
+        '''test benchmarks/suite.py runs a tiny configuration with the stand-ins'''
+        outfile = 'tmp.benchmarks_suite_test.tsv'
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(modules_dir) + os.pathsep + os.environ.get('PYTHONPATH', ''))
+        cmd = [sys.executable, suite_script, '--stand_ins', 'all', '--genomes', '2', '--primers_per_contig', '3', '--genome_size', '10000', '--contigs', '2', '--outfile', outfile]
+        completed = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(0, completed.returncode, msg=completed.stderr)
+
+        with open(outfile) as f:
+            rows = [x.rstrip('\n').split('\t') for x in f]
+        self.assertEqual('\n'.join(['\t'.join(x) for x in rows]) + '\n', completed.stdout)
+        columns = rows[0]
+        self.assertEqual(['genomes', 'genome_size', 'primers_per_contig', 'primer_pairs', 'stage'], columns[:5])
+        results = [dict(zip(columns, x)) for x in rows[1:]]
+        self.assertEqual(['bowtie2_index', 'primer3', 'bowtie2', 'parse_sam', 'update_primer_hits', 'write_output'], [x['stage'] for x in results])
+        for result in results:
+            self.assertEqual('2', result['genomes'])
+            self.assertEqual(len(columns), len(result))
+            self.assertGreater(int(result['items']), 0)
+        # the stand-in primer3_core returns the requested number of primer pairs per contig
+        self.assertEqual('6', results[1]['primer_pairs'])
+        self.assertEqual([], [x for x in os.listdir('.') if x.startswith('tmp.benchmark_suite.')])
+        os.unlink(outfile)
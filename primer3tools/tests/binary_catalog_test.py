@@ -0,0 +1,102 @@
+import unittest
+import os
+import pickle
+import shutil
+from primer3tools import binary_catalog, primer_pair
+
+modules_dir = os.path.dirname(os.path.abspath(binary_catalog.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+def make_primer_pair(sequence_id, index, left_start, left_seq, right_end, right_seq):
+    data_dict = {
+        'SEQUENCE_ID': sequence_id,
+        'PRIMER_LEFT_' + str(index): str(left_start) + ',' + str(len(left_seq)),
+        'PRIMER_RIGHT_' + str(index): str(right_end) + ',' + str(len(right_seq)),
+        'PRIMER_LEFT_' + str(index) + '_SEQUENCE': left_seq,
+        'PRIMER_RIGHT_' + str(index) + '_SEQUENCE': right_seq,
+    }
+    return primer_pair.PrimerPair(data_dict, index, 'genome1')
+
+
+class TestBinaryCatalog(unittest.TestCase):
+    def test_write_and_load(self):
+        '''test Writer and BinaryCatalog'''
+        pairs = [
+            make_primer_pair('contig1', 0, 10, 'ACGTACGTAC', 200, 'TTTGGGCCCAA'),
+            make_primer_pair('contig1', 1, 42, 'acgtAACCg', 300, 'GGGG'),
+            make_primer_pair('contig 2', 0, 1, 'ACNGT', 100, 'ACGTRACGT'),
+            make_primer_pair('contig1', 2, 0, 'C', 9, 'TGCATGCATGCATGCATGCA'),
+        ]
+        catalog_dir = 'tmp.test_binary_catalog_write_and_load'
+        writer = binary_catalog.Writer(catalog_dir, 'genome1')
+        for pair in pairs:
+            writer.add(pair)
+        self.assertFalse(binary_catalog.is_binary_catalog(catalog_dir))
+        writer.close()
+        self.assertTrue(binary_catalog.is_binary_catalog(catalog_dir))
+
+        catalog = binary_catalog.BinaryCatalog(catalog_dir)
+        self.assertEqual(4, len(catalog))
+        self.assertEqual(['contig1', 'contig 2'], catalog.contig_names)
+        self.assertEqual({4: 'ACNGT', 5: 'ACGTRACGT'}, catalog.exceptions)
+        expected_sequences = [x for pair in pairs for x in [pair.left_seq, pair.right_seq]]
+        self.assertEqual(expected_sequences, catalog.sequences())
+        self.assertEqual(expected_sequences, [catalog.sequence(i) for i in range(2 * len(pairs))])
+        self.assertEqual([x.name for x in pairs], catalog.names())
+        self.assertEqual(pairs[2].name, catalog.name(2))
+        self.assertEqual([x.upper() for x in expected_sequences], catalog.sequences(upper=True))
+        self.assertEqual([x.upper() for x in expected_sequences], [catalog.sequence(i, upper=True) for i in range(2 * len(pairs))])
+        self.assertEqual(expected_sequences[3:6], catalog.sequences(3, 6))
+        self.assertEqual([x.name for x in pairs[1:3]], catalog.names(1, 3))
+        expected_lines = [str(x) + '\n' for pair in pairs for x in [pair.left_fasta, pair.right_fasta]]
+        self.assertEqual(expected_lines, list(catalog.fasta_lines()))
+        original_chunk_size = binary_catalog.chunk_size
+        binary_catalog.chunk_size = 3
+        self.assertEqual(expected_lines, list(catalog.fasta_lines()))
+        binary_catalog.chunk_size = original_chunk_size
+
+        # pickling opens the catalog again from its files
+        unpickled = pickle.loads(pickle.dumps(catalog))
+        self.assertEqual(catalog.catalog_dir, unpickled.catalog_dir)
+        self.assertEqual(expected_sequences, unpickled.sequences())
+
+        # the same files are written when the primers are written in batches, with
+        # at most batch_size pairs waiting to be written
+        for batch_size in [1, 3]:
+            batch_dir = catalog_dir + '.batch_size_' + str(batch_size)
+            writer = binary_catalog.Writer(batch_dir, 'genome1', batch_size=batch_size)
+            for pair in pairs:
+                writer.add(pair)
+                self.assertLess(len(writer.pairs), 4 * batch_size)
+            self.assertEqual(len(pairs) % batch_size, len(writer.pairs) // 4)
+            writer.close()
+            for filename in binary_catalog.catalog_files:
+                with open(os.path.join(catalog_dir, filename), 'rb') as f_expected, open(os.path.join(batch_dir, filename), 'rb') as f_got:
+                    self.assertEqual(f_expected.read(), f_got.read())
+            self.assertEqual(expected_sequences, binary_catalog.BinaryCatalog(batch_dir).sequences())
+            shutil.rmtree(batch_dir)
+
+        # writing again replaces the old catalog
+        writer = binary_catalog.Writer(catalog_dir, 'genome1')
+        writer.close()
+        catalog = binary_catalog.BinaryCatalog(catalog_dir)
+        self.assertEqual(0, len(catalog))
+        self.assertEqual((0, 4), catalog.pairs.shape)
+        self.assertEqual([], catalog.sequences())
+        self.assertEqual([], list(catalog.fasta_lines()))
+        shutil.rmtree(catalog_dir)
+
+
+    def test_load_fails(self):
+        '''test BinaryCatalog fails on missing or old catalog'''
+        with self.assertRaises(binary_catalog.Error):
+            binary_catalog.BinaryCatalog('not_a_directory')
+
+        catalog_dir = 'tmp.test_binary_catalog_load_fails'
+        binary_catalog.Writer(catalog_dir, 'genome1').close()
+        with open(os.path.join(catalog_dir, 'info.json'), 'w') as f:
+            print('{"format_version": 0, "genome_name": "genome1", "number_of_pairs": 0}', file=f)
+        with self.assertRaises(binary_catalog.Error):
+            binary_catalog.BinaryCatalog(catalog_dir)
+        shutil.rmtree(catalog_dir)
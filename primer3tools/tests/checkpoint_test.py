@@ -0,0 +1,134 @@
+import unittest
+import os
+import hashlib
+import zipfile
+import numpy
+from primer3tools import checkpoint, hit_table
+
+modules_dir = os.path.dirname(os.path.abspath(checkpoint.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_writer_and_load(self):
+        '''test Writer and load'''
+        hits1 = hit_table.HitTable()
+        hits1.add(0, 'contig1', 10, False)
+        hits1.add(1, 'contig2', 20, True)
+        hits2 = hit_table.HitTable()
+        hits2.add(5, 'contig3', 30, False)
+        hits2.add(4, 'contig1', 40, True)
+        tmpfile = 'tmp.test_checkpoint_writer_and_load.npz'
+        writer = checkpoint.Writer(tmpfile, 'index_hash', [42, 7, 100])
+        for hits in [hits1, hit_table.HitTable(), hits2]:
+            writer.add(hits)
+        self.assertFalse(os.path.exists(tmpfile))
+        writer.close()
+        self.assertFalse(os.path.exists(writer.tmp_file))
+        with zipfile.ZipFile(tmpfile) as f:
+            self.assertEqual({zipfile.ZIP_DEFLATED}, {x.compress_type for x in f.infolist()})
+
+        loaded = checkpoint.load(tmpfile)
+        self.assertEqual('index_hash', loaded.index_hash)
+        self.assertEqual(hashlib.sha256(numpy.array([42, 7, 100], dtype=numpy.uint64).tobytes()).hexdigest(), loaded.primers_hash)
+        self.assertEqual([42, 7, 100], loaded.pair_keys.tolist())
+        self.assertIsNone(loaded.hits)
+        self.assertEqual([hits1, hit_table.HitTable(), hits2], list(loaded.hit_tables()))
+        # the parts can be read again
+        self.assertEqual([hits1, hit_table.HitTable(), hits2], list(loaded.hit_tables()))
+        os.unlink(tmpfile)
+
+        writer = checkpoint.Writer(tmpfile, 'index_hash', [])
+        writer.close()
+        loaded = checkpoint.load(tmpfile)
+        self.assertEqual([], loaded.pair_keys.tolist())
+        self.assertEqual([], list(loaded.hit_tables()))
+        os.unlink(tmpfile)
+
+
+    def test_writer_mapped(self):
+        '''test Writer with only some pairs mapped'''
+        hits = hit_table.HitTable()
+        hits.add(1, 'contig1', 10, False)
+        hits.add(4, 'contig2', 20, True)
+        hits.add(5, 'contig1', 30, False)
+        tmpfile = 'tmp.test_checkpoint_writer_mapped.npz'
+        writer = checkpoint.Writer(tmpfile, 'index_hash', [42, 7, 100, 8], numpy.array([True, False, True, False]))
+        writer.add(hits)
+        writer.close()
+        got = checkpoint.load(tmpfile)
+        self.assertEqual('index_hash', got.index_hash)
+        self.assertEqual([42, 100], got.pair_keys.tolist())
+        self.assertEqual(hashlib.sha256(got.pair_keys.tobytes()).hexdigest(), got.primers_hash)
+        expected = hit_table.HitTable()
+        expected.add(1, 'contig1', 10, False)
+        expected.add(2, 'contig2', 20, True)
+        expected.add(3, 'contig1', 30, False)
+        self.assertEqual([expected], list(got.hit_tables()))
+        os.unlink(tmpfile)
+
+
+    def test_load_one_part(self):
+        '''test load of a checkpoint file that has all the hits in one part'''
+        tmpfile = 'tmp.test_checkpoint_load_one_part.npz'
+        numpy.savez_compressed(
+            tmpfile,
+            index_hash=numpy.array('index_hash'),
+            primers_hash=numpy.array('primers_hash'),
+            pair_keys=numpy.array([42, 7], dtype=numpy.uint64),
+            primer_ids=numpy.array([0, 3]),
+            contig_ids=numpy.array([0, 1], dtype=numpy.int32),
+            starts=numpy.array([10, 20]),
+            is_reverse=numpy.array([False, True]),
+            contig_names=numpy.array(['contig1', 'contig2']),
+        )
+        loaded = checkpoint.load(tmpfile)
+        expected = hit_table.HitTable()
+        expected.add(0, 'contig1', 10, False)
+        expected.add(3, 'contig2', 20, True)
+        self.assertEqual('primers_hash', loaded.primers_hash)
+        self.assertEqual([expected], list(loaded.hit_tables()))
+        os.unlink(tmpfile)
+
+
+    def test_load_fails(self):
+        '''test load fails on bad file'''
+        with self.assertRaises(checkpoint.Error):
+            checkpoint.load(os.path.join(data_dir, 'uniqueness_test_parse_sam.sam'))
+
+
+    def test_hit_tables_for_pair_keys(self):
+        '''test found_pair_keys and hit_tables_for_pair_keys'''
+        hits1 = hit_table.HitTable()
+        hits1.add(0, 'contig1', 10, False)
+        hits1.add(3, 'contig2', 20, True)
+        hits2 = hit_table.HitTable()
+        hits2.add(4, 'contig3', 30, False)
+        hits2.add(5, 'contig1', 40, True)
+        tmpfile = 'tmp.test_checkpoint_hit_tables_for_pair_keys.npz'
+        writer = checkpoint.Writer(tmpfile, 'index_hash', [42, 7, 100])
+        writer.add(hits1)
+        writer.add(hits2)
+        writer.close()
+        ckpt = checkpoint.load(tmpfile)
+
+        self.assertEqual([False, True, True, False], ckpt.found_pair_keys([5, 100, 42, 8]).tolist())
+        expected1 = hit_table.HitTable()
+        expected1.add(4, 'contig1', 10, False)
+        expected2 = hit_table.HitTable()
+        expected2.add(2, 'contig3', 30, False)
+        expected2.add(3, 'contig1', 40, True)
+        self.assertEqual([expected1, expected2], list(ckpt.hit_tables_for_pair_keys([5, 100, 42, 8])))
+        # parts that have none of the pairs are skipped
+        expected = hit_table.HitTable()
+        expected.add(0, 'contig1', 10, False)
+        self.assertEqual([expected], list(ckpt.hit_tables_for_pair_keys([42])))
+        self.assertEqual([], ckpt.found_pair_keys([]).tolist())
+        self.assertEqual([], list(ckpt.hit_tables_for_pair_keys([])))
+        os.unlink(tmpfile)
+
+        in_memory = checkpoint.MappingCheckpoint('index_hash', 'primers_hash', [42, 7, 100], hits1)
+        self.assertEqual([expected1], list(in_memory.hit_tables_for_pair_keys([5, 100, 42, 8])))
+        empty = checkpoint.MappingCheckpoint('index_hash', 'primers_hash', [], hit_table.HitTable())
+        self.assertEqual([False, False], empty.found_pair_keys([1, 2]).tolist())
+        self.assertEqual([], list(empty.hit_tables_for_pair_keys([1, 2])))
@@ -0,0 +1,89 @@
+import unittest
+import os
+import time
+from unittest.mock import patch
+from primer3tools import common
+
+modules_dir = os.path.dirname(os.path.abspath(common.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestCommon(unittest.TestCase):
+    def test_syscall_stream(self):
+        '''test syscall_stream'''
+        lines = ['line' + str(i) + '\n' for i in range(10000)]
+        with common.syscall_stream('cat | tr a-z A-Z', stdin_lines=lines) as f:
+            got = f.read().decode()
+        self.assertEqual(''.join(lines).upper(), got)
+
+        with common.syscall_stream('echo hello') as f:
+            got = f.read().decode()
+        self.assertEqual('hello\n', got)
+
+
+    def test_syscall_stream_fails(self):
+        '''test syscall_stream on failing command'''
+        with self.assertRaises(SystemExit):
+            with common.syscall_stream('false') as f:
+                f.read()
+
+        with self.assertRaises(SystemExit):
+            with common.syscall_stream('cat | false | cat', stdin_lines=['x\n'] * 100000) as f:
+                f.read()
+
+        # when reading the output fails because the command failed (for example, pysam
+        # finding no SAM header), the command's failure is reported instead
+        with self.assertRaises(SystemExit):
+            with common.syscall_stream('echo "bowtie2 error" >&2; exit 2') as f:
+                raise ValueError('file does not contain alignment data')
+
+        # when the command is still running, it is killed and the original error is raised
+        start_time = time.perf_counter()
+        with self.assertRaises(ValueError):
+            with common.syscall_stream('sleep 30') as f:
+                raise ValueError('error reading output')
+        self.assertLess(time.perf_counter() - start_time, 10)
+
+        # a command that exits successfully does not hide the error
+        with self.assertRaises(ValueError):
+            with common.syscall_stream('true') as f:
+                f.read()
+                raise ValueError('error reading output')
+
+
+    def test_sha256_of_files(self):
+        '''test sha256_of_files'''
+        file1 = os.path.join(data_dir, 'uniqueness_test_parse_sam.sam')
+        file2 = os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa')
+        self.assertEqual('e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855', common.sha256_of_files([]))
+        self.assertEqual(common.sha256_of_files([file1, file2]), common.sha256_of_files([file1, file2], chunk_size=7))
+        self.assertNotEqual(common.sha256_of_files([file1, file2]), common.sha256_of_files([file2, file1]))
+
+
+    def test_cached_sha256_of_files(self):
+        '''test cached_sha256_of_files'''
+        tmp_file = 'tmp.test_cached_sha256_of_files.txt'
+        cache_file = 'tmp.test_cached_sha256_of_files.json'
+        with open(tmp_file, 'w') as f:
+            print('abc', file=f)
+        expected = common.sha256_of_files([tmp_file])
+        self.assertEqual(expected, common.cached_sha256_of_files([tmp_file], cache_file))
+        self.assertTrue(os.path.exists(cache_file))
+
+        # the file is not read again while it has not changed
+        with patch.object(common, 'sha256_of_files', side_effect=Exception('file read again')):
+            self.assertEqual(expected, common.cached_sha256_of_files([tmp_file], cache_file))
+
+        with open(tmp_file, 'a') as f:
+            print('def', file=f)
+        expected = common.sha256_of_files([tmp_file])
+        self.assertEqual(expected, common.cached_sha256_of_files([tmp_file], cache_file))
+
+        # a bad cache file is replaced
+        with open(cache_file, 'w') as f:
+            print('not json', file=f)
+        self.assertEqual(expected, common.cached_sha256_of_files([tmp_file], cache_file))
+        with patch.object(common, 'sha256_of_files', side_effect=Exception('file read again')):
+            self.assertEqual(expected, common.cached_sha256_of_files([tmp_file], cache_file))
+        os.unlink(tmp_file)
+        os.unlink(cache_file)
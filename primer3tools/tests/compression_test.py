@@ -0,0 +1,68 @@
+import unittest
+import os
+import shutil
+from unittest.mock import patch
+from primer3tools import compression
+
+modules_dir = os.path.dirname(os.path.abspath(compression.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestCompression(unittest.TestCase):
+    def test_check_codec(self):
+        '''test check_codec'''
+        compression.check_codec('gzip', 1)
+        compression.check_codec('none', 0)
+        with self.assertRaises(compression.Error):
+            compression.check_codec('bzip2', 9)
+        with self.assertRaises(compression.Error):
+            compression.check_codec('gzip', 10)
+
+
+    def test_compress_command(self):
+        '''test compress_command'''
+        self.assertEqual('gzip -9 -c', compression.compress_command())
+        self.assertEqual('gzip -1 -c', compression.compress_command('gzip', 1, 4))
+        self.assertEqual('cat', compression.compress_command('none', 9))
+
+
+    def test_open_write_and_open_read(self):
+        '''test open_write and open_read'''
+        lines = ['line' + str(i) for i in range(1000)]
+        tmpfile = 'tmp.compression_test.gz'
+        codecs = [('none', 9, False), ('gzip', 1, True), ('gzip', 9, True)]
+        if shutil.which('pigz') is not None:
+            codecs.append(('pigz', 6, True))
+
+        for codec, level, gzipped in codecs:
+            with compression.open_write(tmpfile, codec, level, threads=2) as f:
+                for line in lines:
+                    print(line, file=f)
+            self.assertEqual(gzipped, compression.is_gzipped(tmpfile))
+            with compression.open_read(tmpfile) as f:
+                self.assertEqual(lines, [x.rstrip() for x in f])
+            os.unlink(tmpfile)
+
+        # files not ending in .gz are never compressed
+        tmpfile = 'tmp.compression_test.txt'
+        with compression.open_write(tmpfile, 'gzip', 9) as f:
+            print('x', file=f)
+        self.assertFalse(compression.is_gzipped(tmpfile))
+        os.unlink(tmpfile)
+
+
+    def test_open_write_command_fails(self):
+        '''test open_write when the compression command fails'''
+        tmpfile = 'tmp.compression_test_command_fails.gz'
+        # the command reads all its input before failing, or exits without reading any
+        for cmd in ['gzip -c; exit 3', 'exit 3']:
+            with patch.object(compression, 'compress_command', return_value=cmd):
+                with self.assertRaises(compression.Error):
+                    with compression.open_write(tmpfile, 'gzip', 9) as f:
+                        for i in range(100000):
+                            print('line', i, file=f)
+
+                f = compression.open_write(tmpfile, 'gzip', 9)
+                with self.assertRaises(compression.Error):
+                    f.close()
+            os.unlink(tmpfile)
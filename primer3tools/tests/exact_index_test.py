@@ -0,0 +1,201 @@
+import unittest
+import os
+import json
+import random
+import shutil
+import numpy
+from unittest.mock import patch
+from primer3tools import exact_index, hit_table, mapping, primer_catalog, uniqueness
+
+modules_dir = os.path.dirname(os.path.abspath(exact_index.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+stand_ins_dir = os.path.join(os.path.dirname(modules_dir), 'benchmarks', 'stand_ins')
+
+
+# Returns a HitTable of all the hits in a list of HitTables, added in sorted order,
+# so that HitTables of the same hits found in different orders are equal
+def sorted_hit_table(hit_tables):
+    rows = []
+    for hits in hit_tables:
+        primer_ids, contig_ids, starts, is_reverse = hits.columns()
+        rows.extend(zip(primer_ids.tolist(), [hits.contig_names[x] for x in contig_ids.tolist()], starts.tolist(), is_reverse.tolist()))
+    sorted_hits = hit_table.HitTable()
+    for row in sorted(rows):
+        sorted_hits.add(*row)
+    return sorted_hits
+
+
+class TestExactIndex(unittest.TestCase):
+    def test_build_and_hit_tables(self):
+        '''test build and hit_tables'''
+        tmp_dir = 'tmp.test_exact_index_build_and_hit_tables'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        self.assertFalse(exact_index.is_exact_indexed(tmp_dir))
+        exact_index.build(os.path.join(data_dir, 'exact_index_test.fa'), tmp_dir, kmer_length=4)
+        self.assertTrue(exact_index.is_exact_indexed(tmp_dir))
+        index = exact_index.ExactIndex(tmp_dir)
+        self.assertEqual(['ctg1', 'ctg2'], index.contig_names)
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'exact_index_test.primers.fa'))
+
+        expected = hit_table.HitTable()
+        expected.add(0, 'ctg1', 0, True)
+        expected.add(0, 'ctg1', 3, False)
+        expected.add(0, 'ctg1', 22, False)
+        expected.add(1, 'ctg1', 12, False)
+        expected.add(1, 'ctg1', 16, False)
+        expected.add(1, 'ctg2', 3, False)
+        expected.add(2, 'ctg1', 9, False)
+        expected.add(2, 'ctg2', 0, False)
+        expected.add(4, 'ctg1', 3, True)
+        expected.add(4, 'ctg1', 4, True)
+        expected.add(4, 'ctg1', 6, False)
+        expected.add(4, 'ctg1', 7, False)
+        expected.add(4, 'ctg1', 22, True)
+        expected.add(4, 'ctg1', 23, True)
+        expected.add(4, 'ctg1', 25, False)
+        expected.add(4, 'ctg1', 26, False)
+        expected.add(5, 'ctg1', 10, False)
+        expected.add(5, 'ctg2', 1, False)
+        self.assertEqual([expected], list(index.hit_tables(catalog)))
+
+        got = list(index.hit_tables(catalog, pair_ids=[2, 0], batch_size=1))
+        self.assertEqual(2, len(got))
+        self.assertEqual([4, 4, 4, 4, 4, 4, 4, 4, 5, 5], got[0].primer_ids.tolist())
+        self.assertEqual([0, 0, 0, 1, 1, 1], got[1].primer_ids.tolist())
+        self.assertEqual([], list(index.hit_tables(catalog, pair_ids=[])))
+        shutil.rmtree(tmp_dir)
+
+        with self.assertRaises(exact_index.Error):
+            exact_index.ExactIndex(tmp_dir)
+
+
+    def test_kmer_length_limit(self):
+        '''test k-mers longer than max_kmer_length are rejected'''
+        tmp_dir = 'tmp.test_exact_index_kmer_length_limit'
+        fasta_file = os.path.join(data_dir, 'exact_index_test.fa')
+        for kmer_length in [0, exact_index.max_kmer_length + 1]:
+            with self.assertRaises(exact_index.Error):
+                exact_index.build(fasta_file, tmp_dir, kmer_length=kmer_length)
+
+        exact_index.build(fasta_file, tmp_dir, kmer_length=exact_index.max_kmer_length)
+        index = exact_index.ExactIndex(tmp_dir)
+        with self.assertRaises(exact_index.Error):
+            index._query_positions(numpy.frombuffer(b'ACGT', dtype=numpy.uint8).reshape(1, 4), 4)
+
+        # an index that says it has longer k-mers cannot be used
+        with open(os.path.join(tmp_dir, 'info.json'), 'w') as f:
+            json.dump({'format_version': exact_index.format_version, 'kmer_length': 20}, f)
+        with self.assertRaises(exact_index.Error):
+            exact_index.ExactIndex(tmp_dir)
+        shutil.rmtree(tmp_dir)
+
+
+    def test_hit_table_random(self):
+        '''test hit_table against brute force search'''
+        random.seed(42)
+        complement = str.maketrans('ACGT', 'TGCA')
+        contigs = {'contig' + str(i): ''.join(random.choice('ACGT') for _ in range(random.randint(1, 500))) for i in range(5)}
+        tmp_fasta = 'tmp.test_exact_index_hit_table_random.fa'
+        tmp_primers = 'tmp.test_exact_index_hit_table_random.primers.fa'
+        tmp_dir = 'tmp.test_exact_index_hit_table_random'
+        with open(tmp_fasta, 'w') as f:
+            for name, seq in contigs.items():
+                print('>' + name, seq, sep='\n', file=f)
+
+        with open(tmp_primers, 'w') as f:
+            for i in range(200):
+                primers = []
+                for j in range(2):
+                    seq = random.choice(list(contigs.values()))
+                    length = random.choice([5, 10, 11, 15])
+                    start = random.randint(0, max(0, len(seq) - length))
+                    primer = seq[start:start + length]
+                    if random.random() < 0.5:
+                        primer = primer.translate(complement)[::-1]
+                    if random.random() < 0.2:
+                        primer = 'ACGTAC'
+                    primers.append(primer)
+                print('>primer' + str(i) + '/1', primers[0], '>primer' + str(i) + '/2', primers[1], sep='\n', file=f)
+
+        exact_index.build(tmp_fasta, tmp_dir, kmer_length=8)
+        catalog = primer_catalog.PrimerCatalog(tmp_primers)
+        index = exact_index.ExactIndex(tmp_dir, max_candidates=10)
+        got = set()
+        for hits in index.hit_tables(catalog, batch_size=7):
+            for primer_id, contig_id, start, is_reverse in zip(*[x.tolist() for x in hits.columns()]):
+                got.add((primer_id, hits.contig_names[contig_id], start, is_reverse))
+
+        expected = set()
+        for primer_id, primer in enumerate(catalog.sequences):
+            reverse = primer.translate(complement)[::-1]
+            for contig_name, seq in contigs.items():
+                for start in range(len(seq) - len(primer) + 1):
+                    if seq[start:start + len(primer)] == primer:
+                        expected.add((primer_id, contig_name, start, False))
+                    elif seq[start:start + len(primer)] == reverse:
+                        expected.add((primer_id, contig_name, start, True))
+
+        self.assertEqual(expected, got)
+        os.unlink(tmp_fasta)
+        os.unlink(tmp_primers)
+        shutil.rmtree(tmp_dir)
+
+
+    def test_hit_tables_same_as_bowtie2(self):
+        '''test ExactIndex finds the same perfect hits as mapping with bowtie2'''
+        # use bowtie2 if it is installed, otherwise the stand-ins used by the benchmarks
+        path = os.environ['PATH']
+        if shutil.which('bowtie2') is None or shutil.which('bowtie2-build') is None:
+            if not os.path.exists(stand_ins_dir):
+                self.skipTest('bowtie2 not found in path')
+            path = stand_ins_dir + os.pathsep + path
+
+        random.seed(42)
+        complement = str.maketrans('ACGT', 'TGCA')
+        contigs = {'contig' + str(i): ''.join(random.choices('ACGT', k=random.randint(200, 2000))) for i in range(4)}
+        primers = []
+        for i in range(60):
+            contig = random.choice(list(contigs.values()))
+            length = random.randint(15, 30)
+            start = random.randint(0, len(contig) - length)
+            primers.append(contig[start:start + length])
+        # primers that are not in the genome, and one that is its own reverse complement
+        primers.extend([''.join(random.choices('ACGT', k=20)) for i in range(4)])
+        primers.append('ACGTTGCAATGCATTGCAACGT')
+        # more copies of some primers, on both strands, including one at the end of a contig
+        insertions = {name: [] for name in contigs}
+        for primer in primers[:10] + primers[-1:]:
+            for name in random.sample(list(contigs), 2):
+                insertions[name].append(primer if random.random() < 0.5 else primer.translate(complement)[::-1])
+        contigs = {name: seq[:100] + 'NNNNN'.join(insertions[name]) + seq[100:] + primers[0] for name, seq in contigs.items()}
+        contigs['contig0'] = contigs['contig0'][:300].lower() + contigs['contig0'][300:]
+
+        tmp_prefix = 'tmp.test_exact_index_hit_tables_same_as_bowtie2'
+        genome_fasta = tmp_prefix + '.genome.fa'
+        primers_fasta = tmp_prefix + '.primers.fa'
+        with open(genome_fasta, 'w') as f:
+            for name, seq in contigs.items():
+                print('>' + name + ' description', seq, sep='\n', file=f)
+        with open(primers_fasta, 'w') as f:
+            for i in range(0, len(primers) - 1, 2):
+                print('>pair' + str(i) + '/1', primers[i], '>pair' + str(i) + '/2', primers[i + 1], sep='\n', file=f)
+        catalog = primer_catalog.PrimerCatalog(primers_fasta)
+
+        with patch.dict(os.environ, {'PATH': path, 'PYTHONPATH': os.path.dirname(modules_dir) + os.pathsep + os.environ.get('PYTHONPATH', '')}):
+            mapping.bowtie2_index(genome_fasta, tmp_prefix + '.bowtie2')
+            bowtie2_mapper = uniqueness.PrimerUniqueness('genomes', 'primer3_outdir', tmp_prefix, mapper='bowtie2', hit_batch_size=7)
+            bowtie2_hits = sorted_hit_table(bowtie2_mapper._map_primers(primers_fasta, catalog, None, tmp_prefix + '.bowtie2', 'job', 1))
+
+        exact_index.build(genome_fasta, tmp_prefix + '.exact_index')
+        exact_mapper = uniqueness.PrimerUniqueness('genomes', 'primer3_outdir', tmp_prefix, mapper='exact')
+        exact_hits = sorted_hit_table(exact_mapper._map_primers(primers_fasta, catalog, None, tmp_prefix + '.exact_index', 'job', 1))
+        self.assertGreater(len(exact_hits), len(catalog.sequences))
+        self.assertEqual(bowtie2_hits, exact_hits)
+
+        for filename in os.listdir('.'):
+            if filename.startswith(tmp_prefix):
+                if os.path.isdir(filename):
+                    shutil.rmtree(filename)
+                else:
+                    os.unlink(filename)
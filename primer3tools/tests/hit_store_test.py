@@ -0,0 +1,49 @@
+import unittest
+import os
+import sqlite3
+from primer3tools import hit_store
+
+modules_dir = os.path.dirname(os.path.abspath(hit_store.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestHitStore(unittest.TestCase):
+    def test_write_and_read(self):
+        '''test HitStoreWriter and HitStore'''
+        tmp_db = 'tmp.hit_store_test.sqlite'
+        if os.path.exists(tmp_db):
+            os.unlink(tmp_db)
+
+        # small batch size, so that rows are written in several transactions
+        writer = hit_store.HitStoreWriter(tmp_db, batch_size=2)
+        writer.add_primer_pair('pair1', 'AAAA', 'CCCC', [('g1', 'c1', 1, '+', 100, '-')])
+        writer.add_primer_pair('pair2', 'GGGG', 'TTTT', [('g2', 'c1', 10, '-', 5, '+'), ('g1', 'c2', 3, '+', 300, '-'), ('g1', 'c1', 50, '+', 150, '-')])
+        writer.add_primer_pair('pair3', 'ACGT', 'TGCA', [])
+        self.assertFalse(os.path.exists(tmp_db))
+        writer.close()
+        self.assertFalse(os.path.exists(tmp_db + '.tmp'))
+
+        store = hit_store.HitStore(tmp_db)
+        self.assertEqual(['pair1', 'pair2'], store.primer_pairs_in_genome('g1'))
+        self.assertEqual(['pair1', 'pair2'], store.primer_pairs_in_genome('g1', contig_name='c1'))
+        self.assertEqual(['pair2'], store.primer_pairs_in_genome('g1', contig_name='c2'))
+        self.assertEqual(['pair1'], store.primer_pairs_in_genome('g1', unique_only=True))
+        self.assertEqual(['pair2'], store.primer_pairs_in_genome('g2'))
+        self.assertEqual([], store.primer_pairs_in_genome('g3'))
+        self.assertEqual([('g2', 'c1', 10, '-', 5, '+'), ('g1', 'c2', 3, '+', 300, '-'), ('g1', 'c1', 50, '+', 150, '-')], store.hits('pair2'))
+        self.assertEqual([], store.hits('pair3'))
+        self.assertEqual([], store.hits('not_a_pair'))
+        got = store.connection.execute('SELECT name, left_seq, right_seq, hits FROM primer_pairs ORDER BY id').fetchall()
+        self.assertEqual([('pair1', 'AAAA', 'CCCC', 1), ('pair2', 'GGGG', 'TTTT', 3), ('pair3', 'ACGT', 'TGCA', 0)], got)
+
+        # the database is opened read only
+        with self.assertRaises(sqlite3.OperationalError):
+            store.connection.execute('DELETE FROM hits')
+        store.close()
+        os.unlink(tmp_db)
+
+
+    def test_hit_store_not_found(self):
+        '''test HitStore fails on missing file'''
+        with self.assertRaises(hit_store.Error):
+            hit_store.HitStore('tmp.hit_store_test.not_a_file')
@@ -0,0 +1,127 @@
+import unittest
+import os
+import random
+import numpy
+from primer3tools import hit_table
+
+modules_dir = os.path.dirname(os.path.abspath(hit_table.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestHitTable(unittest.TestCase):
+    def test_add_and_columns(self):
+        '''test add and columns'''
+        hits = hit_table.HitTable()
+        hits.add(3, 'contig1', 42, True)
+        hits.add(1, 'contig2', 11, False)
+        hits.add(0, 'contig1', 0, False)
+        self.assertEqual(3, len(hits))
+        self.assertEqual(['contig1', 'contig2'], hits.contig_names)
+        primer_ids, contig_ids, starts, is_reverse = hits.columns()
+        self.assertEqual([3, 1, 0], primer_ids.tolist())
+        self.assertEqual([0, 1, 0], contig_ids.tolist())
+        self.assertEqual([42, 11, 0], starts.tolist())
+        self.assertEqual([True, False, False], is_reverse.tolist())
+
+
+    def test_add_columns(self):
+        '''test add_columns'''
+        hits = hit_table.HitTable()
+        hits.add(0, 'contig1', 1, False)
+        hits.add_columns([1, 2], [2, 0], [5, 6], [True, False], ['contig3', 'contig4', 'contig1'])
+        expected = hit_table.HitTable()
+        expected.add(0, 'contig1', 1, False)
+        expected.add(1, 'contig1', 5, True)
+        expected.add(2, 'contig3', 6, False)
+        self.assertEqual(expected, hits)
+
+
+    def test_capped(self):
+        '''test capped'''
+        hits = hit_table.HitTable()
+        for primer_id, contig, start in [(3, 'c1', 10), (1, 'c1', 20), (3, 'c2', 30), (0, 'c1', 40), (3, 'c1', 50), (1, 'c2', 60)]:
+            hits.add(primer_id, contig, start, False)
+
+        expected = hit_table.HitTable()
+        for primer_id, contig, start in [(3, 'c1', 10), (1, 'c1', 20), (3, 'c2', 30), (0, 'c1', 40), (1, 'c2', 60)]:
+            expected.add(primer_id, contig, start, False)
+        got_hits, got_ids = hits.capped(2)
+        self.assertEqual(expected, got_hits)
+        self.assertEqual([3], got_ids.tolist())
+
+        got_hits, got_ids = hits.capped(1)
+        self.assertEqual([3, 1, 0], got_hits.columns()[0].tolist())
+        self.assertEqual([10, 20, 40], got_hits.columns()[2].tolist())
+        self.assertEqual([1, 3], got_ids.tolist())
+
+        got_hits, got_ids = hits.capped(3)
+        self.assertEqual(hits, got_hits)
+        self.assertEqual([], got_ids.tolist())
+
+        got_hits, got_ids = hit_table.HitTable().capped(1)
+        self.assertEqual(hit_table.HitTable(), got_hits)
+        self.assertEqual([], got_ids.tolist())
+
+
+    def test_split_by_genome(self):
+        '''test split_by_genome'''
+        hits = hit_table.HitTable()
+        hits.add(0, 'genome1__contig1', 10, False)
+        hits.add(1, 'genome2__contig1', 20, True)
+        hits.add(2, 'genome1__contig__2', 30, False)
+        hits.add(3, 'genome1__contig1', 40, True)
+
+        genome1 = hit_table.HitTable()
+        genome1.add(0, 'contig1', 10, False)
+        genome1.add(2, 'contig__2', 30, False)
+        genome1.add(3, 'contig1', 40, True)
+        genome2 = hit_table.HitTable()
+        genome2.add(1, 'contig1', 20, True)
+        self.assertEqual({'genome1': genome1, 'genome2': genome2}, hits.split_by_genome())
+        self.assertEqual({}, hit_table.HitTable().split_by_genome())
+
+
+    def test_hit_file(self):
+        '''test HitFile'''
+        random.seed(42)
+        tables = []
+        for i in range(5):
+            hits = hit_table.HitTable()
+            for j in range(random.randint(0, 30)):
+                hits.add(random.randrange(20), 'contig' + str(random.randrange(4 + i)), random.randrange(1000), random.random() < 0.5)
+            tables.append(hits)
+
+        all_hits = hit_table.HitTable()
+        for hits in tables:
+            all_hits.add_columns(*hits.columns(), hits.contig_names)
+        primer_ids, contig_ids, starts, is_reverse = all_hits.columns()
+        rows = list(zip(primer_ids.tolist(), [all_hits.contig_names[x] for x in contig_ids.tolist()], starts.tolist(), is_reverse.tolist()))
+
+        prefix = 'tmp.test_hit_file'
+        # sorting a few hits at a time gives the same as sorting all at once
+        for batch_size in [1, 7, 1000]:
+            hit_file = hit_table.HitFile(prefix, 21, batch_size=batch_size)
+            for hits in tables:
+                hit_file.add(hits)
+            hit_file.close()
+            self.assertEqual(len(all_hits), len(hit_file))
+            self.assertEqual(numpy.bincount(primer_ids, minlength=21).tolist(), hit_file.hits_per_primer.tolist())
+
+            for wanted in [[], [3], [20], [5, 0, 19, 5], list(range(21))]:
+                expected = hit_table.HitTable()
+                for primer_id in sorted(set(wanted)):
+                    for row in rows:
+                        if row[0] == primer_id:
+                            expected.add(*row)
+                got = hit_file.hits_of_primers(numpy.array(wanted, dtype=numpy.int64))
+                self.assertEqual(expected, got)
+
+            hit_file.remove()
+            self.assertEqual([], [x for x in os.listdir('.') if x.startswith(prefix)])
+
+        hit_file = hit_table.HitFile(prefix, 3)
+        hit_file.close()
+        self.assertEqual(0, len(hit_file))
+        self.assertEqual(hit_table.HitTable(), hit_file.hits_of_primers(numpy.array([0, 1, 2])))
+        hit_file.remove()
+        self.assertEqual([], [x for x in os.listdir('.') if x.startswith(prefix)])
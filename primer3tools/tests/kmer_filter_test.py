@@ -0,0 +1,74 @@
+import unittest
+import os
+import random
+import numpy
+from primer3tools import kmer_filter
+
+modules_dir = os.path.dirname(os.path.abspath(kmer_filter.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestKmerFilter(unittest.TestCase):
+    def test_canonical_kmer_values(self):
+        '''test _canonical_kmer_values'''
+        sequence = numpy.frombuffer(b'ACGTTNAC', dtype=numpy.uint8)
+        values, valid = kmer_filter._canonical_kmer_values(sequence, 2)
+        # AC=1, CG=6, GT=11 (AC=1 is smaller), TT=15 (AA=0 is smaller), TN, NA, AC=1
+        self.assertEqual([1, 6, 1, 0, 1], values[valid].tolist())
+        self.assertEqual([True, True, True, True, False, False, True], valid.tolist())
+        values, valid = kmer_filter._canonical_kmer_values(sequence[:1], 2)
+        self.assertEqual([], values.tolist())
+
+
+    def test_build_and_contains(self):
+        '''test build and contains'''
+        random.seed(42)
+        complement = str.maketrans('ACGT', 'TGCA')
+        contigs = [''.join(random.choice('ACGT') for _ in range(5000)) for i in range(3)]
+        contigs[1] = contigs[1][:2000] + 'NNNNN' + contigs[1][2005:]
+        tmp_fasta = 'tmp.test_kmer_filter_build_and_contains.fa'
+        tmp_filter = 'tmp.test_kmer_filter_build_and_contains.npz'
+        with open(tmp_fasta, 'w') as f:
+            for i, contig in enumerate(contigs):
+                print('>contig' + str(i), contig.lower() if i == 2 else contig, sep='\n', file=f)
+
+        kmer_filter.build(tmp_fasta, tmp_filter, kmer_length=10)
+        os.unlink(tmp_fasta)
+        kfilter = kmer_filter.KmerFilter(tmp_filter)
+        os.unlink(tmp_filter)
+        self.assertEqual(10, kfilter.kmer_length)
+
+        in_genome = []
+        for i in range(1000):
+            contig = random.choice(contigs)
+            start = random.randint(0, len(contig) - 30)
+            seq = contig[start:start + random.randint(18, 30)]
+            if 'N' not in seq:
+                in_genome.append(seq if random.random() < 0.5 else seq.translate(complement)[::-1])
+        self.assertTrue(kfilter.contains(in_genome).all())
+
+        # sequences that are too short or have other bases than ACGT cannot be checked
+        self.assertEqual([True, True, True], kfilter.contains(['ACGT', 'A' * 10 + 'N' + 'C' * 10, '']).tolist())
+        self.assertEqual([], kfilter.contains([]).tolist())
+
+        # about 1% of random sequences should be found. They are long enough
+        # that they are not in the genome, so any found are false positives
+        not_in_genome = [''.join(random.choice('ACGT') for _ in range(20)) for i in range(1000)]
+        self.assertLess(kfilter.contains(not_in_genome).sum(), 50)
+
+
+    def test_build_fails(self):
+        '''test build fails with bad options'''
+        fasta_file = os.path.join(data_dir, 'exact_index_test.fa')
+        with self.assertRaises(kmer_filter.Error):
+            kmer_filter.build(fasta_file, 'tmp.kmer_filter_test.npz', kmer_length=33)
+        with self.assertRaises(kmer_filter.Error):
+            kmer_filter.build(fasta_file, 'tmp.kmer_filter_test.npz', bits_per_kmer=0)
+
+
+    def test_load_fails(self):
+        '''test KmerFilter fails on missing or bad file'''
+        with self.assertRaises(kmer_filter.Error):
+            kmer_filter.KmerFilter('not_a_file')
+        with self.assertRaises(kmer_filter.Error):
+            kmer_filter.KmerFilter(os.path.join(data_dir, 'exact_index_test.fa'))
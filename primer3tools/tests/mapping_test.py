@@ -0,0 +1,56 @@
+import unittest
+import os
+from primer3tools import mapping
+
+modules_dir = os.path.dirname(os.path.abspath(mapping.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestMapping(unittest.TestCase):
+    def test_combined_index_chunks(self):
+        '''test combined_index_chunks'''
+        names = ['g5', 'g1', 'g3', 'g2', 'g4']
+        expected = {
+            'combined.1': ['g1', 'g2'],
+            'combined.2': ['g3', 'g4'],
+            'combined.3': ['g5'],
+        }
+        self.assertEqual(expected, mapping.combined_index_chunks(names, 2))
+        self.assertEqual({'combined.1': sorted(names)}, mapping.combined_index_chunks(names, 10))
+
+
+    def test_write_and_load_combined_index_manifest(self):
+        '''test write_combined_index_manifest and load_combined_index_manifest'''
+        chunks = {
+            'combined.1': ['g1', 'g2'],
+            'combined.2': ['g3'],
+        }
+        tmpfile = 'tmp.test_write_and_load_combined_index_manifest.tsv'
+        mapping.write_combined_index_manifest(chunks, tmpfile)
+        self.assertEqual(chunks, mapping.load_combined_index_manifest(tmpfile))
+        os.unlink(tmpfile)
+
+
+    def test_split_combined_reference_name(self):
+        '''test split_combined_reference_name'''
+        self.assertEqual(('genome', 'contig'), mapping.split_combined_reference_name('genome__contig'))
+        self.assertEqual(('genome', 'contig__1'), mapping.split_combined_reference_name('genome__contig__1'))
+        with self.assertRaises(mapping.Error):
+            mapping.split_combined_reference_name('contig')
+
+
+    def test_stream_bowtie2_fails(self):
+        '''test stream_bowtie2 reports bowtie2 failing before writing a SAM header'''
+        # empty index files, so bowtie2 fails when it tries to load the index
+        reference = 'tmp.test_mapping_stream_bowtie2_fails'
+        for ext in mapping.bowtie2_index_extensions:
+            with open(reference + '.' + ext, 'w'):
+                pass
+
+        for output_format in ['sam', 'bam']:
+            with self.assertRaises(SystemExit):
+                with mapping.stream_bowtie2(['>read\nACGTACGTACGT\n'], reference, output_format=output_format) as sam_reader:
+                    list(sam_reader)
+
+        for ext in mapping.bowtie2_index_extensions:
+            os.unlink(reference + '.' + ext)
@@ -0,0 +1,66 @@
+import unittest
+import os
+from primer3tools import match_runs
+
+modules_dir = os.path.dirname(os.path.abspath(match_runs.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestMatchRuns(unittest.TestCase):
+    def test_number_of_matches(self):
+        '''test number_of_matches'''
+        self.assertEqual(0, match_runs.number_of_matches({}))
+        primer_hits = {
+            'p1': {'g1': {'c1': ['m1', 'm2'], 'c2': ['m3']}, 'g2': {'c1': ['m4']}},
+            'p2': {'g1': {'c1': ['m5']}},
+        }
+        self.assertEqual(5, match_runs.number_of_matches(primer_hits))
+
+
+    def test_write_run_and_merge(self):
+        '''test write_run and merge'''
+        left = (10, 20, False, 'ACGT')
+        right = (200, 20, True, 'TTTT')
+        other = (42, 21, True, 'GGGG')
+        runs = [
+            {
+                'p2': {'g3': {'c1': [(right, left), (left, right)]}},
+                'p1': {'g1': {'c2': [(left, right)]}},
+            },
+            {
+                'p3': {'g2': {'c1': [(left, other)]}},
+                'p1': {'g2': {'c1': [(other, right)], 'c10': [(left, right)]}},
+            },
+            {
+                'p1': {'g3': {'c1': [(left, right)]}},
+                'p2': {'g1': {'c1': [(left, right)]}},
+            },
+        ]
+        in_memory = {
+            'p0': {'g1': {'c1': [(left, right)]}},
+            'p2': {'g2': {'c1': [(other, other)]}},
+        }
+
+        expected = {}
+        for primer_hits in runs + [in_memory]:
+            for name, genome_hits in primer_hits.items():
+                expected.setdefault(name, {}).update(genome_hits)
+
+        filenames = ['tmp.test_match_runs_write_run_and_merge.' + str(i) + '.tsv' for i in range(len(runs))]
+        for primer_hits, filename in zip(runs, filenames):
+            match_runs.write_run(primer_hits, filename)
+
+        got = list(match_runs.merge(filenames, in_memory))
+        self.assertEqual(sorted(expected.items()), got)
+
+        # exclude only applies to the run files, so p0 is still there
+        got = list(match_runs.merge(filenames, in_memory, exclude={('p1', 'g2'), ('p3', 'g2'), ('p0', 'g1')}))
+        del expected['p1']['g2']
+        del expected['p3']
+        self.assertEqual(sorted(expected.items()), got)
+
+        self.assertEqual([], list(match_runs.merge([], {})))
+        self.assertEqual(sorted(in_memory.items()), list(match_runs.merge([], in_memory)))
+        match_runs.delete_runs(filenames)
+        for filename in filenames:
+            self.assertFalse(os.path.exists(filename))
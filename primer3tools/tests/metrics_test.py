@@ -0,0 +1,57 @@
+import unittest
+import os
+from primer3tools import common, metrics
+
+modules_dir = os.path.dirname(os.path.abspath(metrics.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestMetrics(unittest.TestCase):
+    def test_stage(self):
+        '''test Stage'''
+        with metrics.Stage('task', 'stage1', 'name1') as stage:
+            common.syscall('sleep 0.01')
+            with common.syscall_stream('cat', stdin_lines=['x\n'] * 1000) as f:
+                f.read()
+            stage.count('things')
+            stage.count('things', 2)
+
+        record = stage.record
+        self.assertEqual(('task', 'stage1', 'name1'), (record['task'], record['stage'], record['name']))
+        self.assertEqual({'things': 3}, record['counts'])
+        self.assertEqual(['sleep', 'cat'], [x['program'] for x in record['children']])
+        self.assertEqual('sleep 0.01', record['children'][0]['command'])
+        self.assertGreaterEqual(record['children'][0]['wall_seconds'], 0.01)
+        self.assertGreaterEqual(record['wall_seconds'], 0.01)
+        for x in [record] + record['children']:
+            self.assertGreater(x['peak_rss_bytes'], 0)
+        for key in ['cpu_seconds', 'read_bytes', 'write_bytes']:
+            self.assertGreaterEqual(record[key], 0)
+
+
+    def test_nested_stages(self):
+        '''test nested Stages'''
+        with metrics.Stage('task', 'outer') as outer:
+            common.syscall('true')
+            with metrics.Stage('task', 'inner') as inner:
+                big_list = [0] * 10000000
+                common.syscall('false', allow_fail=True)
+            del big_list
+
+        self.assertEqual(['false'], [x['program'] for x in inner.record['children']])
+        self.assertEqual(['true', 'false'], [x['program'] for x in outer.record['children']])
+        self.assertGreater(inner.record['peak_rss_bytes'], 80000000)
+        self.assertGreaterEqual(outer.record['peak_rss_bytes'], inner.record['peak_rss_bytes'])
+        self.assertGreaterEqual(outer.record['wall_seconds'], inner.record['wall_seconds'])
+
+
+    def test_write_and_load_records(self):
+        '''test write_records and load_records'''
+        tmp_file = 'tmp.metrics_test.jsonl'
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        records = [{'stage': 'a', 'counts': {'x': 1}}, {'stage': 'b', 'children': []}]
+        metrics.write_records(tmp_file, records[:1])
+        metrics.write_records(tmp_file, records[1:])
+        self.assertEqual(records, metrics.load_records(tmp_file))
+        os.unlink(tmp_file)
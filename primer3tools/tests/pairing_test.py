@@ -0,0 +1,60 @@
+import unittest
+import os
+import random
+from primer3tools import pairing
+
+modules_dir = os.path.dirname(os.path.abspath(pairing.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+def brute_force_good_pair_indexes(groups, starts, lengths, is_reverse, is_right, min_product_length, max_product_length):
+    left_indexes = []
+    right_indexes = []
+    for i in range(len(groups)):
+        for j in range(len(groups)):
+            if is_right[i] or not is_right[j] or groups[i] != groups[j] or is_reverse[i] == is_reverse[j]:
+                continue
+            if is_reverse[j]:
+                good = starts[i] < starts[j] and min_product_length <= starts[j] + lengths[j] - starts[i] <= max_product_length
+            else:
+                good = starts[j] < starts[i] and min_product_length <= starts[i] + lengths[i] - starts[j] <= max_product_length
+            if good:
+                left_indexes.append(i)
+                right_indexes.append(j)
+    return left_indexes, right_indexes
+
+
+class TestPairing(unittest.TestCase):
+    def test_good_pair_indexes(self):
+        '''test good_pair_indexes'''
+        groups =     [0,     0,     0,    0,    1,     1,    0]
+        starts =     [0,     30,    40,   35,   1000,  1040, 40]
+        lengths =    [10,    10,    10,   10,   10,    10,   10]
+        is_reverse = [False, False, True, True, False, True, True]
+        is_right =   [False, True,  True, True, False, True, False]
+        left, right = pairing.good_pair_indexes(groups, starts, lengths, is_reverse, is_right, 50, 200)
+        self.assertEqual([0, 4], left.tolist())
+        self.assertEqual([2, 5], right.tolist())
+
+        left, right = pairing.good_pair_indexes([], [], [], [], [], 50, 200)
+        self.assertEqual(([], []), (left.tolist(), right.tolist()))
+
+        with self.assertRaises(pairing.Error):
+            pairing.good_pair_indexes([0], [0, 1], [10], [True], [True], 50, 200)
+
+
+    def test_good_pair_indexes_matches_brute_force(self):
+        '''test good_pair_indexes gives same result as testing every pair of hits'''
+        random.seed(42)
+        for i in range(50):
+            hits = random.randint(0, 200)
+            groups = [random.randint(0, 5) for j in range(hits)]
+            starts = [random.randint(0, 600) for j in range(hits)]
+            lengths = [random.randint(15, 25) for j in range(hits)]
+            is_reverse = [random.random() < 0.5 for j in range(hits)]
+            is_right = [random.random() < 0.5 for j in range(hits)]
+            min_length = random.randint(1, 100)
+            max_length = random.randint(min_length, 400)
+            expected = brute_force_good_pair_indexes(groups, starts, lengths, is_reverse, is_right, min_length, max_length)
+            left, right = pairing.good_pair_indexes(groups, starts, lengths, is_reverse, is_right, min_length, max_length)
+            self.assertEqual(expected, (left.tolist(), right.tolist()))
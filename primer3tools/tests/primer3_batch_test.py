@@ -0,0 +1,167 @@
+import unittest
+import os
+import shutil
+from primer3tools import primer3_batch, artifacts, binary_catalog, exact_index, genome_set, mapping, metrics
+
+modules_dir = os.path.dirname(os.path.abspath(primer3_batch.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+def write_genomes_file(make_primers, filename):
+    with open(filename, 'w') as f:
+        for i in range(len(make_primers)):
+            print('g' + str(i + 1), os.path.join(data_dir, 'uniqueness_test_cat_all_genomes.genome' + str(i + 1) + '.fa'), make_primers[i], sep='\t', file=f)
+
+
+class TestPrimer3Batch(unittest.TestCase):
+    def test_artifact_exists(self):
+        '''test _artifact_exists'''
+        outdir = 'tmp.test_primer3_batch_artifact_exists'
+        os.mkdir(outdir)
+        batch = primer3_batch.Primer3Batch(os.path.join(data_dir, 'primer3_test_dummy.config'), 'genomes_file', outdir)
+        for name in ['g.1.primers', 'g.1.bowtie2_index', 'g.1.exact_index', 'g.1.kmer_filter']:
+            self.assertFalse(batch._artifact_exists(name))
+        with self.assertRaises(primer3_batch.Error):
+            batch._artifact_exists('g.1.not_an_artifact')
+
+        outprefix = os.path.join(outdir, 'g.1')
+        for suffix in ['.primers.fasta.gz', '.primer3_core.out.gz']:
+            with open(outprefix + suffix, 'w'):
+                pass
+        # primer3 output made before the binary catalog was added is not complete
+        self.assertFalse(batch._artifact_exists('g.1.primers'))
+        binary_catalog.Writer(outprefix + '.primer_catalog', 'g.1').close()
+        self.assertTrue(batch._artifact_exists('g.1.primers'))
+        os.unlink(outprefix + '.primer3_core.out.gz')
+        self.assertFalse(batch._artifact_exists('g.1.primers'))
+
+        exact_index.build(os.path.join(data_dir, 'exact_index_test.fa'), outprefix + '.exact_index')
+        self.assertTrue(batch._artifact_exists('g.1.exact_index'))
+        with open(primer3_batch.kmer_filter_file(outprefix), 'w'):
+            pass
+        self.assertTrue(batch._artifact_exists('g.1.kmer_filter'))
+        shutil.rmtree(outdir)
+
+
+    def test_update_combined_index_manifest(self):
+        '''test _update_combined_index_manifest'''
+        outdir = 'tmp.test_primer3_batch_update_combined_index_manifest'
+        genomes_file = outdir + '.genomes'
+        os.mkdir(outdir)
+        manifest = os.path.join(outdir, mapping.combined_index_manifest)
+        write_genomes_file([1, 0, 0], genomes_file)
+        batch = primer3_batch.Primer3Batch(os.path.join(data_dir, 'primer3_test_dummy.config'), genomes_file, outdir, combined_index_size=2)
+        chunks = {'combined.1': ['g1', 'g2'], 'combined.2': ['g3']}
+        self.assertEqual(chunks, batch._update_combined_index_manifest(genome_set.GenomeSet(genomes_file)))
+        self.assertEqual(chunks, mapping.load_combined_index_manifest(manifest))
+        os.mkdir(os.path.join(outdir, 'combined.2.bowtie2_index'))
+
+        # bad genome names are found before the old manifest is changed
+        for bad_name in ['g__3', 'combined.2']:
+            with open(genomes_file, 'a') as f:
+                print(bad_name, os.path.join(data_dir, 'uniqueness_test_cat_all_genomes.genome1.fa'), 0, sep='\t', file=f)
+            with self.assertRaises(primer3_batch.Error):
+                batch._update_combined_index_manifest(genome_set.GenomeSet(genomes_file))
+            self.assertEqual(chunks, mapping.load_combined_index_manifest(manifest))
+            self.assertTrue(os.path.exists(os.path.join(outdir, 'combined.2.bowtie2_index')))
+            write_genomes_file([1, 0, 0], genomes_file)
+
+        os.unlink(genomes_file)
+        shutil.rmtree(outdir)
+
+
+    def test_to_make(self):
+        '''test _to_make'''
+        outdir = 'tmp.test_primer3_batch_to_make'
+        os.mkdir(outdir)
+        batch = primer3_batch.Primer3Batch(os.path.join(data_dir, 'primer3_test_dummy.config'), 'genomes_file', outdir)
+        manifest = artifacts.ArtifactManifest(os.path.join(outdir, artifacts.manifest_name))
+        for name in ['g1', 'g2', 'g3']:
+            with open(primer3_batch.kmer_filter_file(os.path.join(outdir, name)), 'w'):
+                pass
+        manifest.set('g1.kmer_filter', 'key1')
+        manifest.set('g2.kmer_filter', 'old_key2')
+        manifest.set('g4.kmer_filter', 'key4')
+        keys = {'g1.kmer_filter': 'key1', 'g2.kmer_filter': 'key2', 'g3.kmer_filter': 'key3', 'g4.kmer_filter': 'key4'}
+        self.assertEqual({'g2.kmer_filter', 'g3.kmer_filter', 'g4.kmer_filter'}, batch._to_make(keys, manifest))
+        shutil.rmtree(outdir)
+
+
+    def test_jobs(self):
+        '''test _jobs'''
+        genomes_file = 'tmp.test_primer3_batch_jobs.genomes'
+        write_genomes_file([1, 1, 0], genomes_file)
+        genomes = genome_set.GenomeSet(genomes_file)
+        outdir = os.path.abspath('tmp.test_primer3_batch_jobs.out')
+        batch = primer3_batch.Primer3Batch(os.path.join(data_dir, 'primer3_test_dummy.config'), genomes_file, outdir, threads=8, index_type='both', primer3_threads=3, kmer_filter=True)
+
+        def job_threads(jobs):
+            return {x.name: x.threads for x in jobs}
+
+        # nothing made yet: every artifact has a job. The 8 threads are shared
+        # between the 6 index jobs, and each primer3 job uses primer3_threads
+        manifest = artifacts.ArtifactManifest(os.path.join(outdir, artifacts.manifest_name))
+        to_make = batch._to_make({x: 'key' for x in ['g1.primers', 'g2.primers'] + [y + '.' + z for y in genomes for z in ['bowtie2_index', 'exact_index', 'kmer_filter']]}, manifest)
+        jobs = batch._jobs(genomes, {}, to_make)
+        expected = {
+            'g1.primers': 3, 'g2.primers': 3,
+            'g1.bowtie2_index': 1, 'g2.bowtie2_index': 1, 'g3.bowtie2_index': 1,
+            'g1.exact_index': 1, 'g2.exact_index': 1, 'g3.exact_index': 1,
+            'g1.kmer_filter': 1, 'g2.kmer_filter': 1, 'g3.kmer_filter': 1,
+        }
+        self.assertEqual(expected, job_threads(jobs))
+        job = [x for x in jobs if x.name == 'g1.primers'][0]
+        self.assertEqual(primer3_batch._run_primer3, job.function)
+        self.assertEqual(('g1', genomes['g1'], batch.primer3_config, dict(batch.primer3_options, threads=3), os.path.join(outdir, 'g1')), job.args)
+        self.assertEqual(os.path.getsize(genomes['g1'].fasta_file), job.size)
+
+        # only artifacts that are not current get a job, and fewer index jobs get more threads each
+        jobs = batch._jobs(genomes, {}, {'g2.primers', 'g1.exact_index', 'g3.bowtie2_index'})
+        self.assertEqual({'g2.primers': 3, 'g1.exact_index': 4, 'g3.bowtie2_index': 4}, job_threads(jobs))
+        job = [x for x in jobs if x.name == 'g1.exact_index'][0]
+        self.assertEqual(primer3_batch._make_genome_index, job.function)
+        self.assertEqual(('g1', genomes['g1'].fasta_file, os.path.join(outdir, 'g1'), 'exact', 4), job.args)
+        self.assertEqual([], batch._jobs(genomes, {}, set()))
+
+        # combined indexes: one job per chunk, which has all the threads when it is the only index job
+        chunks = {'combined.1': ['g1', 'g2'], 'combined.2': ['g3']}
+        jobs = batch._jobs(genomes, chunks, {'combined.1.bowtie2_index', 'g1.kmer_filter'})
+        self.assertEqual({'combined.1.bowtie2_index': 8, 'g1.kmer_filter': 1}, job_threads(jobs))
+        job = [x for x in jobs if x.name == 'combined.1.bowtie2_index'][0]
+        self.assertEqual(primer3_batch._make_combined_index, job.function)
+        self.assertEqual(('combined.1', {'g1': genomes['g1'], 'g2': genomes['g2']}, os.path.join(outdir, 'combined.1'), 'bowtie2', 8), job.args)
+        self.assertEqual(sum([os.path.getsize(genomes[x].fasta_file) for x in ['g1', 'g2']]), job.size)
+
+        # primer3 never uses more threads than the whole batch has
+        batch = primer3_batch.Primer3Batch(os.path.join(data_dir, 'primer3_test_dummy.config'), genomes_file, outdir, threads=2, primer3_threads=3)
+        self.assertEqual({'g1.primers': 2, 'g1.bowtie2_index': 2}, job_threads(batch._jobs(genomes, {}, {'g1.primers', 'g1.bowtie2_index'})))
+        os.unlink(genomes_file)
+
+
+    def test_run_remakes_deleted_artifacts(self):
+        '''test run remakes artifacts whose files were deleted'''
+        genomes_file = 'tmp.test_primer3_batch_run_remakes_deleted_artifacts.genomes'
+        outdir = 'tmp.test_primer3_batch_run_remakes_deleted_artifacts.out'
+        write_genomes_file([0, 0, 0], genomes_file)
+        batch = primer3_batch.Primer3Batch(os.path.join(data_dir, 'primer3_test_dummy.config'), genomes_file, outdir, index_type='exact', kmer_filter=True)
+        metrics_file = os.path.join(outdir, primer3_batch.metrics_name)
+
+        def jobs_run():
+            return sorted([x['stage'] + ' ' + x['name'] for x in metrics.load_records(metrics_file) if x['stage'] != 'total'])
+
+        batch.run()
+        self.assertEqual(['exact_index g1', 'exact_index g2', 'exact_index g3', 'kmer_filter g1', 'kmer_filter g2', 'kmer_filter g3'], jobs_run())
+        batch.run()
+        self.assertEqual([], jobs_run())
+
+        shutil.rmtree(os.path.join(outdir, 'g2.exact_index'))
+        os.unlink(primer3_batch.kmer_filter_file(os.path.join(outdir, 'g3')))
+        batch.run()
+        self.assertEqual(['exact_index g2', 'kmer_filter g3'], jobs_run())
+        self.assertTrue(exact_index.is_exact_indexed(os.path.join(outdir, 'g2.exact_index')))
+        self.assertTrue(os.path.exists(primer3_batch.kmer_filter_file(os.path.join(outdir, 'g3'))))
+        batch.run()
+        self.assertEqual([], jobs_run())
+
+        shutil.rmtree(outdir)
+        os.unlink(genomes_file)
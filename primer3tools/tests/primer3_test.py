@@ -1,10 +1,11 @@
 import unittest
 import pyfastaq
+import gzip
 import shutil
 import filecmp
 from unittest.mock import patch
 import os
-from primer3tools import primer3, primer_pair
+from primer3tools import binary_catalog, primer3, primer_pair
 
 modules_dir = os.path.dirname(os.path.abspath(primer3.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data')
@@ -57,6 +58,27 @@ class TestPrimer3(unittest.TestCase):
                 self.p3._get_next_primer3_sequence_results(f)
 
 
+    def test_primer3_records(self):
+        '''test _primer3_records'''
+        infile = os.path.join(data_dir, 'primer3_test_load_primer_pairs.infile')
+        with open(infile) as f:
+            expected = []
+            while 1:
+                results = self.p3._get_next_primer3_sequence_results(f)
+                if results is None:
+                    break
+                expected.append(results)
+
+        for block_size in [1, 7, 1048576]:
+            with open(infile) as f:
+                self.assertEqual(expected, list(self.p3._primer3_records(f, block_size=block_size)))
+
+        infile = os.path.join(data_dir, 'primer3_test_get_next_primer3_sequence_results.infile_bad')
+        with open(infile) as f:
+            with self.assertRaises(primer3.Error):
+                list(self.p3._primer3_records(f, block_size=5))
+
+
     def test_primer3_sequence_results_to_list(self):
         '''test _primer3_sequence_results_to_list'''
         pair1_dict = {
@@ -169,6 +191,15 @@ class TestPrimer3(unittest.TestCase):
         }
 
         self.assertEqual(expected, got)
+        self.assertEqual(list(expected.items()), list(self.p3._primer_pairs_from_file(infile)))
+
+        tmpfile = 'tmp.test_load_primer_pairs.infile'
+        with open(infile) as f_in, open(tmpfile, 'w') as f_out:
+            contents = f_in.read()
+            print(contents + contents, end='', file=f_out)
+        with self.assertRaises(primer3.Error):
+            self.p3._load_primer_pairs(tmpfile)
+        os.unlink(tmpfile)
 
 
     def test_write_primers_fasta(self):
@@ -212,6 +243,183 @@ class TestPrimer3(unittest.TestCase):
         os.unlink(outfile)
 
 
+    def test_sorted_by_sequence_id(self):
+        '''test _sorted_by_sequence_id'''
+        data_dict = {
+            'SEQUENCE_ID': 'seq',
+            'PRIMER_LEFT_0': '42,4',
+            'PRIMER_RIGHT_0': '100,3',
+            'PRIMER_LEFT_0_SEQUENCE': 'AAAA',
+            'PRIMER_RIGHT_0_SEQUENCE': 'CCC',
+        }
+        primer_pairs = [(x, [primer_pair.PrimerPair(dict(data_dict, SEQUENCE_ID=x), 0, 'genome')] * len(x)) for x in ['seq10', 'seq2', 'seq', 'seq1']]
+        tmp_file = 'tmp.test_sorted_by_sequence_id.pickle'
+        got = list(primer3.Primer3._sorted_by_sequence_id(iter(primer_pairs), tmp_file))
+        self.assertEqual(['seq', 'seq1', 'seq10', 'seq2'], [x[0] for x in got])
+        self.assertEqual(sorted([(x, [y.name for y in pairs]) for x, pairs in primer_pairs]), [(x, [y.name for y in pairs]) for x, pairs in got])
+        self.assertFalse(os.path.exists(tmp_file))
+        self.assertEqual([], list(primer3.Primer3._sorted_by_sequence_id(iter([]), tmp_file)))
+
+
+    def test_max_product_size(self):
+        '''test _max_product_size'''
+        self.assertEqual(300, primer3.Primer3._max_product_size(os.path.join(data_dir, 'primer3_test_dummy.config')))
+        tmpfile = 'tmp.test_max_product_size.config'
+        with open(tmpfile, 'w') as f:
+            print('PRIMER_TASK=generic', 'PRIMER_PRODUCT_SIZE_RANGE=150-250 100-300 301-400', 'PRIMER_NUM_RETURN=5', sep='\n', file=f)
+        self.assertEqual(400, primer3.Primer3._max_product_size(tmpfile))
+        os.unlink(tmpfile)
+
+
+    def test_primer3_jobs(self):
+        '''test _primer3_jobs'''
+        tmpfile = 'tmp.test_primer3_jobs.fa'
+        with open(tmpfile, 'w') as f:
+            print('>seq1 description', 'ACGTACGTAC', '>seq2', 'A', sep='\n', file=f)
+
+        expected = [(0, 'seq1 description', 0, 'ACGTACGTAC'), (1, 'seq2', 0, 'A')]
+        self.assertEqual(expected, primer3.Primer3._primer3_jobs(tmpfile, 0, 2))
+        self.assertEqual(expected, primer3.Primer3._primer3_jobs(tmpfile, 10, 2))
+        expected = [
+            (0, 'seq1 description', 0, 'ACGTA'),
+            (0, 'seq1 description', 3, 'TACGT'),
+            (0, 'seq1 description', 6, 'GTAC'),
+            (1, 'seq2', 0, 'A'),
+        ]
+        self.assertEqual(expected, primer3.Primer3._primer3_jobs(tmpfile, 5, 2))
+        os.unlink(tmpfile)
+
+
+    def test_group_primer3_jobs(self):
+        '''test _group_primer3_jobs'''
+        jobs = [(0, 'seq1', 0, 'A' * 10), (1, 'seq2', 0, 'A' * 3), (1, 'seq2', 2, 'A' * 4), (2, 'seq3', 0, 'A' * 5)]
+        expected = [[jobs[0]], [jobs[1], jobs[2], jobs[3]]]
+        self.assertEqual(expected, primer3.Primer3._group_primer3_jobs(jobs, 2))
+        expected = [[jobs[0]], [jobs[3]], [jobs[1], jobs[2]]]
+        self.assertEqual(expected, primer3.Primer3._group_primer3_jobs(jobs, 3))
+        self.assertEqual([[x] for x in jobs], sorted(primer3.Primer3._group_primer3_jobs(jobs, 10), key=lambda x: (x[0][0], x[0][2])))
+
+
+    def test_merge_window_results(self):
+        '''test _merge_window_results'''
+        window1 = {
+            'SEQUENCE_ID': 'seq1',
+            'SEQUENCE_TEMPLATE': 'ACGT',
+            'PRIMER_LEFT_EXPLAIN': 'considered 1',
+            'PRIMER_LEFT_NUM_RETURNED': '2',
+            'PRIMER_RIGHT_NUM_RETURNED': '2',
+            'PRIMER_PAIR_NUM_RETURNED': '2',
+            'PRIMER_PAIR_0_PENALTY': '0.5',
+            'PRIMER_LEFT_0_SEQUENCE': 'AAAA',
+            'PRIMER_RIGHT_0_SEQUENCE': 'CCCC',
+            'PRIMER_LEFT_0': '42,4',
+            'PRIMER_RIGHT_0': '100,4',
+            'PRIMER_PAIR_1_PENALTY': '0.7',
+            'PRIMER_LEFT_1_SEQUENCE': 'GGG',
+            'PRIMER_RIGHT_1_SEQUENCE': 'TTT',
+            'PRIMER_LEFT_1': '110,3',
+            'PRIMER_RIGHT_1': '200,3',
+        }
+        window2 = {
+            'SEQUENCE_ID': 'seq1',
+            'PRIMER_LEFT_NUM_RETURNED': '2',
+            'PRIMER_RIGHT_NUM_RETURNED': '2',
+            'PRIMER_PAIR_NUM_RETURNED': '2',
+            'PRIMER_PAIR_0_PENALTY': '0.1',
+            'PRIMER_LEFT_0_SEQUENCE': 'ACGT',
+            'PRIMER_RIGHT_0_SEQUENCE': 'TGCA',
+            'PRIMER_LEFT_0': '60,4',
+            'PRIMER_RIGHT_0': '150,4',
+            'PRIMER_PAIR_1_PENALTY': '0.7',
+            'PRIMER_LEFT_1_SEQUENCE': 'GGG',
+            'PRIMER_RIGHT_1_SEQUENCE': 'TTT',
+            'PRIMER_LEFT_1': '10,3',
+            'PRIMER_RIGHT_1': '100,3',
+        }
+        window3 = {'SEQUENCE_ID': 'seq1', 'PRIMER_ERROR': 'SEQUENCE_INCLUDED_REGION length < min PRIMER_PRODUCT_SIZE_RANGE'}
+        expected = {
+            'SEQUENCE_ID': 'seq1',
+            'PRIMER_LEFT_NUM_RETURNED': '3',
+            'PRIMER_RIGHT_NUM_RETURNED': '3',
+            'PRIMER_PAIR_0_PENALTY': '0.1',
+            'PRIMER_LEFT_0_SEQUENCE': 'ACGT',
+            'PRIMER_RIGHT_0_SEQUENCE': 'TGCA',
+            'PRIMER_LEFT_0': '160,4',
+            'PRIMER_RIGHT_0': '250,4',
+            'PRIMER_PAIR_1_PENALTY': '0.5',
+            'PRIMER_LEFT_1_SEQUENCE': 'AAAA',
+            'PRIMER_RIGHT_1_SEQUENCE': 'CCCC',
+            'PRIMER_LEFT_1': '42,4',
+            'PRIMER_RIGHT_1': '100,4',
+            'PRIMER_PAIR_2_PENALTY': '0.7',
+            'PRIMER_LEFT_2_SEQUENCE': 'GGG',
+            'PRIMER_RIGHT_2_SEQUENCE': 'TTT',
+            'PRIMER_LEFT_2': '110,3',
+            'PRIMER_RIGHT_2': '200,3',
+            'PRIMER_PAIR_NUM_RETURNED': '3',
+        }
+        got = primer3.Primer3._merge_window_results('seq1', [(0, window1), (100, window2), (200, window3)])
+        self.assertEqual(expected, got)
+        got_pairs = self.p3._primer3_sequence_results_to_list(got)
+        self.assertEqual([160, 42, 110], [x.left_start for x in got_pairs])
+
+        expected = {'SEQUENCE_ID': 'seq1', 'PRIMER_LEFT_NUM_RETURNED': '0', 'PRIMER_RIGHT_NUM_RETURNED': '0', 'PRIMER_PAIR_NUM_RETURNED': '0'}
+        got = primer3.Primer3._merge_window_results('seq1', [(0, window3), (200, window3)])
+        self.assertEqual(expected, got)
+        self.assertTrue(self.p3._primer3_found_no_primers(got))
+
+
+    def test_load_bindings_global_args(self):
+        '''test _load_bindings_global_args'''
+        tmpfile = 'tmp.test_load_bindings_global_args.config'
+        with open(tmpfile, 'w') as f:
+            print('Primer3 File - http://primer3.sourceforge.net', 'P3_FILE_TYPE=settings', '', 'PRIMER_THERMODYNAMIC_PARAMETERS_PATH=/path/', 'PRIMER_TASK=generic', 'PRIMER_MIN_SIZE=18', 'PRIMER_MIN_TM=57.0', 'PRIMER_PRODUCT_SIZE_RANGE=150-250 100-300', '=', sep='\n', file=f)
+        expected = {
+            'PRIMER_TASK': 'generic',
+            'PRIMER_MIN_SIZE': 18,
+            'PRIMER_MIN_TM': 57.0,
+            'PRIMER_PRODUCT_SIZE_RANGE': [[150, 250], [100, 300]],
+        }
+        self.assertEqual(expected, primer3.Primer3._load_bindings_global_args(tmpfile))
+        os.unlink(tmpfile)
+
+
+    @unittest.skipIf(primer3.primer3_bindings is None, 'primer3-py not installed')
+    def test_run_bindings(self):
+        '''test run with bindings engine'''
+        tmp_fasta = 'tmp.test_run_bindings.fa'
+        tmp_config = 'tmp.test_run_bindings.config'
+        outprefix = 'tmp.test_run_bindings'
+        with open(tmp_fasta, 'w') as f:
+            print('>seq1 description', 'CTGACTGATGCTGTATCGATCGGACTAGCTAGCTAGCTGACAGATGTACGTAGCTGATGCATGCATGCTAGCTGATCGGCGATTCACTGATCGTAGCTAGCATGCGGTCAGCTAGCATCGATCGTACGATCGTTAACGTCGATCGTCAGCTGTCATTACCTATCAAGCGACTAGGTCATCGGCTAGCGCTATGGCTCTACGGATCGATC', '>seq2', 'ACGT', sep='\n', file=f)
+        with open(tmp_config, 'w') as f:
+            print('PRIMER_PRODUCT_SIZE_RANGE=100-180', 'PRIMER_NUM_RETURN=2', 'PRIMER_MIN_TM=50.0', 'PRIMER_MAX_TM=70.0', 'PRIMER_MIN_GC=20.0', 'PRIMER_MAX_GC=80.0', sep='\n', file=f)
+
+        p3 = primer3.Primer3(tmp_fasta, tmp_config, 'genome_name', engine='bindings')
+        p3.run(outprefix)
+        self.assertEqual(['seq1'], list(p3.primer_pairs.keys()))
+        self.assertEqual(2, len(p3.primer_pairs['seq1']))
+        self.assertEqual(p3.primer_pairs, p3._load_primer_pairs(outprefix + '.primer3_core.out.gz'))
+        got_seqs = {}
+        pyfastaq.tasks.file_to_dict(outprefix + '.primers.fasta.gz', got_seqs)
+        self.assertEqual(4, len(got_seqs))
+        catalog = binary_catalog.BinaryCatalog(outprefix + '.primer_catalog')
+        self.assertEqual([x.name for x in p3.primer_pairs['seq1']], catalog.names())
+
+        p3 = primer3.Primer3(tmp_fasta, tmp_config, 'genome_name', engine='bindings', window_size=190)
+        p3.run(outprefix)
+        self.assertTrue(len(p3.primer_pairs['seq1']) >= 2)
+        self.assertEqual(p3.primer_pairs, p3._load_primer_pairs(outprefix + '.primer3_core.out.gz'))
+        with open(tmp_fasta) as f:
+            fasta_contents = f.read()
+        for pair in p3.primer_pairs['seq1']:
+            self.assertIn(pair.left_fasta.seq, fasta_contents)
+
+        for filename in [tmp_fasta, tmp_config, outprefix + '.primer3_core.out.gz', outprefix + '.primers.fasta.gz']:
+            os.unlink(filename)
+        shutil.rmtree(outprefix + '.primer_catalog')
+
+
     @patch('primer3tools.primer3.Primer3._run_primer3_core')
     def test_run(self, primer3_mock):
         '''test run'''
@@ -223,10 +431,39 @@ class TestPrimer3(unittest.TestCase):
         expected_outfile = os.path.join(data_dir, 'primer3_test_run.expected.out.fa.gz')
         expected_seqs = {}
         pyfastaq.tasks.file_to_dict(expected_outfile, expected_seqs)
-        self.p3.run(primer3_outprefix)
+        self.assertEqual(len(expected_seqs) // 2, self.p3.run(primer3_outprefix))
         got_seqs = {}
         pyfastaq.tasks.file_to_dict(fasta_outfile, got_seqs)
         self.assertEqual(got_seqs, expected_seqs)
+        self.assertEqual(self.p3.primer_pairs, self.p3._load_primer_pairs(primer3_outfile))
+        catalog = binary_catalog.BinaryCatalog(primer3_outprefix + '.primer_catalog')
+        with pyfastaq.utils.open_file_read(fasta_outfile) as f:
+            self.assertEqual(f.read(), ''.join(catalog.fasta_lines()))
         os.unlink(fasta_outfile)
+
+        self.assertEqual(len(expected_seqs) // 2, self.p3.run(primer3_outprefix, keep_primer_pairs=False))
+        self.assertIsNone(self.p3.primer_pairs)
+        got_seqs = {}
+        pyfastaq.tasks.file_to_dict(fasta_outfile, got_seqs)
+        self.assertEqual(got_seqs, expected_seqs)
+        self.assertEqual(len(expected_seqs) // 2, len(binary_catalog.BinaryCatalog(primer3_outprefix + '.primer_catalog')))
+        os.unlink(fasta_outfile)
+
+        # the primers are sorted by sequence ID, whatever the order of the primer3_core output
+        with gzip.open(original_primer3_outfile, 'rt') as f:
+            records = [x + '=\n' for x in f.read().split('=\n') if x != '']
+        with gzip.open(primer3_outfile, 'wt') as f:
+            f.write(''.join(records[::-1]))
+        primer_pairs = self.p3._load_primer_pairs(original_primer3_outfile)
+        expected_fasta = ''.join([str(x) + '\n' for seq_id in sorted(primer_pairs) for pair in primer_pairs[seq_id] for x in [pair.left_fasta, pair.right_fasta]])
+        for keep_primer_pairs in [True, False]:
+            self.p3.run(primer3_outprefix, keep_primer_pairs=keep_primer_pairs)
+            with gzip.open(fasta_outfile, 'rt') as f:
+                self.assertEqual(expected_fasta, f.read())
+            catalog = binary_catalog.BinaryCatalog(primer3_outprefix + '.primer_catalog')
+            self.assertEqual(expected_fasta, ''.join(catalog.fasta_lines()))
+            os.unlink(fasta_outfile)
+        self.assertFalse(os.path.exists(primer3_outprefix + '.tmp.primer_pairs.pickle'))
         os.unlink(primer3_outfile)
+        shutil.rmtree(primer3_outprefix + '.primer_catalog')
 
@@ -0,0 +1,250 @@
+import unittest
+import os
+import random
+import shutil
+import numpy
+from unittest.mock import patch
+from primer3tools import binary_catalog, primer_catalog, primer_pair, hit_table
+
+modules_dir = os.path.dirname(os.path.abspath(primer_catalog.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestPrimerCatalog(unittest.TestCase):
+    def test_init(self):
+        '''test PrimerCatalog __init__'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa'))
+        self.assertEqual(['primer1', 'primer2'], catalog.names)
+        self.assertEqual({'primer1': 0, 'primer2': 1}, catalog.name_to_id)
+        self.assertEqual(['AGTAATTAATAAC', 'AAAAAAAAAAAAAA', 'AGTAATTAATAAC', 'TCGCTCCAGGTACG'], catalog.sequences)
+        self.assertEqual([13, 14, 13, 14], catalog.lengths.tolist())
+        self.assertEqual(2, len(catalog))
+
+
+    def test_init_fails(self):
+        '''test PrimerCatalog __init__ fails on bad input'''
+        bad_names = [
+            ['p1'],
+            ['p1/1'],
+            ['p1/2', 'p1/1'],
+            ['p1/1', 'p2/2'],
+            ['p1/1', 'p1/2', 'p1/1', 'p1/2'],
+        ]
+        tmpfile = 'tmp.test_primer_catalog_init_fails.fa'
+        for names in bad_names:
+            with open(tmpfile, 'w') as f:
+                for name in names:
+                    print('>' + name, 'ACGT', sep='\n', file=f)
+            with self.assertRaises(primer_catalog.Error):
+                primer_catalog.PrimerCatalog(tmpfile)
+        os.unlink(tmpfile)
+
+
+    def test_primer_id(self):
+        '''test primer_id'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa'))
+        self.assertEqual(0, catalog.primer_id('primer1/1'))
+        self.assertEqual(1, catalog.primer_id('primer1/2'))
+        self.assertEqual(2, catalog.primer_id('primer2/1'))
+        self.assertEqual(3, catalog.primer_id('primer2/2'))
+        for name in ['primer1', 'primer3/1', 'primer2/3']:
+            with self.assertRaises(primer_catalog.Error):
+                catalog.primer_id(name)
+
+
+    def test_pair_keys_and_content_hash(self):
+        '''test pair_keys and content_hash'''
+        catalog1 = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa'))
+        catalog2 = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_matches_from_hit_table.primers.fa'))
+        keys1 = catalog1.pair_keys().tolist()
+        keys2 = catalog2.pair_keys().tolist()
+        self.assertEqual(2, len(keys1))
+        self.assertEqual(3, len(keys2))
+        self.assertEqual(keys1[1], keys2[1])
+        self.assertEqual(4, len(set(keys1 + keys2)))
+        self.assertNotEqual(catalog1.content_hash(), catalog2.content_hash())
+        self.assertEqual(catalog1.content_hash(), primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa')).content_hash())
+
+
+    def test_fasta_lines(self):
+        '''test fasta_lines'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa'))
+        expected = '>primer2/1\nAGTAATTAATAAC\n>primer2/2\nTCGCTCCAGGTACG\n'
+        self.assertEqual(expected, ''.join(catalog.fasta_lines([1])))
+        with open(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa')) as f:
+            self.assertEqual(f.read(), ''.join(catalog.fasta_lines([0, 1])))
+
+
+    def test_from_binary_catalogs(self):
+        '''test from_binary_catalogs'''
+        data_dict = {
+            'SEQUENCE_ID': 'seq1',
+            'PRIMER_LEFT_0': '42,4',
+            'PRIMER_RIGHT_0': '100,3',
+            'PRIMER_LEFT_0_SEQUENCE': 'AAcg',
+            'PRIMER_RIGHT_0_SEQUENCE': 'CNC',
+            'PRIMER_LEFT_1': '142,2',
+            'PRIMER_RIGHT_1': '200,2',
+            'PRIMER_LEFT_1_SEQUENCE': 'GA',
+            'PRIMER_RIGHT_1_SEQUENCE': 'TT',
+        }
+        catalog_dirs = ['tmp.test_primer_catalog_from_binary_catalogs.' + str(i) for i in range(2)]
+        tmp_fasta = 'tmp.test_primer_catalog_from_binary_catalogs.fa'
+        with open(tmp_fasta, 'w') as f:
+            for i, catalog_dir in enumerate(catalog_dirs):
+                writer = binary_catalog.Writer(catalog_dir, 'genome' + str(i))
+                for index in range(2):
+                    pair = primer_pair.PrimerPair(data_dict, index, 'genome' + str(i))
+                    writer.add(pair)
+                    print(pair.left_fasta, pair.right_fasta, sep='\n', file=f)
+                writer.close()
+
+        binary_catalogs = [binary_catalog.BinaryCatalog(x) for x in catalog_dirs]
+        catalog = primer_catalog.from_binary_catalogs(binary_catalogs)
+        self.assertEqual(primer_catalog.PrimerCatalog(tmp_fasta), catalog)
+        self.assertEqual(['AACG', 'CNC', 'GA', 'TT'] * 2, catalog.sequences)
+        self.assertEqual([4, 3, 2, 2] * 2, catalog.lengths.tolist())
+        self.assertEqual(3, catalog.name_to_id['genome1__seq1__1__142__199'])
+        with self.assertRaises(primer_catalog.Error):
+            primer_catalog.from_binary_catalogs(binary_catalogs[:1] * 2)
+
+        os.unlink(tmp_fasta)
+        for catalog_dir in catalog_dirs:
+            shutil.rmtree(catalog_dir)
+
+
+    def test_from_binary_catalogs_lookups(self):
+        '''test from_binary_catalogs looks up primers in the memory mapped catalogs'''
+        catalog_dirs = ['tmp.test_primer_catalog_from_binary_catalogs_lookups.' + str(i) for i in range(3)]
+        tmp_fasta = 'tmp.test_primer_catalog_from_binary_catalogs_lookups.fa'
+        with open(tmp_fasta, 'w') as f:
+            for i, catalog_dir in enumerate(catalog_dirs):
+                writer = binary_catalog.Writer(catalog_dir, 'genome' + str(i))
+                # the second genome has no primers
+                for index in range(3 * (i != 1)):
+                    data_dict = {
+                        'SEQUENCE_ID': 'seq1',
+                        'PRIMER_LEFT_' + str(index): str(10 * index) + ',5',
+                        'PRIMER_RIGHT_' + str(index): str(10 * index + 100) + ',4',
+                        'PRIMER_LEFT_' + str(index) + '_SEQUENCE': 'ACgt' + 'ACGT'[index],
+                        'PRIMER_RIGHT_' + str(index) + '_SEQUENCE': 'TTT' + 'acgt'[i],
+                    }
+                    pair = primer_pair.PrimerPair(data_dict, index, 'genome' + str(i))
+                    writer.add(pair)
+                    print('>' + pair.name + '/1', pair.left_seq.upper(), '>' + pair.name + '/2', pair.right_seq.upper(), sep='\n', file=f)
+                writer.close()
+
+        binary_catalogs = [binary_catalog.BinaryCatalog(x) for x in catalog_dirs]
+        catalog = primer_catalog.from_binary_catalogs(binary_catalogs)
+        expected = primer_catalog.PrimerCatalog(tmp_fasta)
+        self.assertNotIsInstance(catalog.names, list)
+        self.assertNotIsInstance(catalog.sequences, list)
+        self.assertIsInstance(binary_catalogs[2].packed_sequences, numpy.memmap)
+        self.assertEqual(expected.lengths.tolist(), catalog.lengths.tolist())
+        self.assertIsNone(catalog._name_to_id)
+
+        with patch.object(binary_catalogs[2], 'sequence', wraps=binary_catalogs[2].sequence) as sequence_mock, \
+          patch.object(binary_catalogs[2], 'name', wraps=binary_catalogs[2].name) as name_mock:
+            self.assertEqual(expected.sequences[9], catalog.sequences[9])
+            self.assertEqual(expected.sequences[-1], catalog.sequences[-1])
+            self.assertEqual(expected.names[4], catalog.names[4])
+            self.assertEqual([((3,), {'upper': True}), ((5,), {'upper': True})], sequence_mock.call_args_list)
+            name_mock.assert_called_once_with(1)
+        self.assertEqual(expected.sequences[2:5], catalog.sequences[2:5])
+        self.assertEqual(expected.names, list(catalog.names))
+        self.assertEqual(expected.sequences, list(catalog.sequences))
+        self.assertEqual(expected.pair_keys().tolist(), catalog.pair_keys().tolist())
+        with self.assertRaises(IndexError):
+            catalog.sequences[12]
+
+        self.assertIsNone(catalog._name_to_id)
+        self.assertEqual(expected.name_to_id, catalog.name_to_id)
+        self.assertEqual(9, catalog.primer_id(expected.names[4] + '/2'))
+        os.unlink(tmp_fasta)
+        for catalog_dir in catalog_dirs:
+            shutil.rmtree(catalog_dir)
+
+
+    def test_unique_primers(self):
+        '''test UniquePrimers'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_matches_from_hit_table.primers.fa'))
+        unique = primer_catalog.UniquePrimers(catalog)
+        self.assertEqual(6, unique.number_of_primers)
+        self.assertEqual(4, unique.number_of_sequences)
+        self.assertEqual(1.5, unique.dedup_ratio())
+        self.assertEqual(['ACGTACGTAC_CATGCATGCA', 'AGTAATTAATAAC_TCGCTCCAGGTACG'], unique.catalog.names)
+        self.assertEqual([0, 1, 2, 3, 0, 1], unique.query_ids.tolist())
+        self.assertEqual([10, 10, 13, 14], unique.catalog.lengths.tolist())
+
+        query_hits = hit_table.HitTable()
+        query_hits.add(1, 'ctg1', 42, True)
+        query_hits.add(0, 'ctg1', 10, False)
+        query_hits.add(0, 'ctg2', 5, True)
+        query_hits.add(2, 'ctg2', 1, False)
+        expected = hit_table.HitTable()
+        expected.add(0, 'ctg1', 10, False)
+        expected.add(0, 'ctg2', 5, True)
+        expected.add(1, 'ctg1', 42, True)
+        expected.add(2, 'ctg2', 1, False)
+        expected.add(4, 'ctg1', 10, False)
+        expected.add(4, 'ctg2', 5, True)
+        expected.add(5, 'ctg1', 42, True)
+        self.assertEqual(expected, unique.expand_hits(query_hits))
+
+
+    def test_expand_hits_in_batches(self):
+        '''test expand_hits_in_batches'''
+        random.seed(42)
+        sequences = [''.join(random.choice('ACGT') for _ in range(20)) for i in range(30)]
+        catalog = primer_catalog.PrimerCatalog()
+        for i in range(200):
+            catalog._add_pair('pair' + str(i), random.choice(sequences), random.choice(sequences))
+        catalog._set_lengths()
+        unique = primer_catalog.UniquePrimers(catalog)
+        query_hits = hit_table.HitTable()
+        for i in range(100):
+            query_hits.add(random.randrange(unique.number_of_sequences), 'ctg' + str(random.randrange(3)), random.randrange(1000), random.random() < 0.5)
+        expected = unique.expand_hits(query_hits)
+        expected_columns = expected.columns()
+
+        for batch_size in [1, 50, 1000, 1000000]:
+            got_rows = []
+            batches = list(unique.expand_hits_in_batches(query_hits, batch_size))
+            for batch in batches:
+                primer_ids, contig_ids, starts, is_reverse = batch.columns()
+                # each batch has all the hits of its primer pairs, and is not much bigger than the batch size
+                pair_ids = sorted(set((primer_ids // 2).tolist()))
+                self.assertEqual(numpy.isin(expected_columns[0] // 2, pair_ids).sum(), len(batch))
+                self.assertTrue(len(pair_ids) == 1 or len(batch) < batch_size + 2 * len(query_hits))
+                got_rows.extend(zip(primer_ids.tolist(), [batch.contig_names[x] for x in contig_ids.tolist()], starts.tolist(), is_reverse.tolist()))
+            self.assertEqual(list(zip(expected_columns[0].tolist(), [expected.contig_names[x] for x in expected_columns[1].tolist()], expected_columns[2].tolist(), expected_columns[3].tolist())), got_rows)
+            if batch_size == 1000000:
+                self.assertEqual(1, len(batches))
+            elif batch_size == 1:
+                self.assertEqual(len(set((expected_columns[0] // 2).tolist())), len(batches))
+
+        self.assertEqual([], list(unique.expand_hits_in_batches(hit_table.HitTable(), 10)))
+
+        # the same batches from a HitFile
+        hit_file = hit_table.HitFile('tmp.test_expand_hits_in_batches.hits', len(unique.catalog.sequences), batch_size=7)
+        for start in range(0, len(query_hits), 30):
+            hits = hit_table.HitTable()
+            hits.add_columns(*[x[start:start + 30] for x in query_hits.columns()], query_hits.contig_names)
+            hit_file.add(hits)
+        hit_file.close()
+        for batch_size in [1, 50, 1000000]:
+            self.assertEqual(list(unique.expand_hits_in_batches(query_hits, batch_size)), list(unique.expand_hit_file_in_batches(hit_file, batch_size)))
+        hit_file.remove()
+
+
+    def test_unique_primers_odd_number(self):
+        '''test UniquePrimers with an odd number of distinct sequences'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa'))
+        unique = primer_catalog.UniquePrimers(catalog)
+        self.assertEqual(3, unique.number_of_sequences)
+        self.assertEqual(['AGTAATTAATAAC', 'AAAAAAAAAAAAAA', 'TCGCTCCAGGTACG', 'TCGCTCCAGGTACG'], unique.catalog.sequences)
+        self.assertEqual([0, 1, 0, 2], unique.query_ids.tolist())
+        tmpfile = 'tmp.test_unique_primers_odd_number.fa'
+        unique.catalog.write_fasta(tmpfile)
+        self.assertEqual(unique.catalog, primer_catalog.PrimerCatalog(tmpfile))
+        os.unlink(tmpfile)
@@ -45,4 +45,25 @@ class TestPrimer3(unittest.TestCase):
         pair = primer_pair.PrimerPair(input_dict, 0, 'genome_name')
         self.assertEqual(pair.left_fasta, left_fasta)
         self.assertEqual(pair.right_fasta, right_fasta)
+        self.assertEqual('genome_name__seq_name__0__42__97', pair.name)
+        self.assertEqual('seq_name\t0\t42\t97\tAAAA\tAGGT', str(pair))
+        self.assertFalse(hasattr(pair, '__dict__'))
+
+
+    def test_primer_pair_eq(self):
+        '''test PrimerPair __eq__'''
+        input_dict = {
+            'SEQUENCE_ID': 'seq_name',
+            'PRIMER_LEFT_0': '42,4',
+            'PRIMER_RIGHT_0': '100,4',
+            'PRIMER_LEFT_0_SEQUENCE': 'AAAA',
+            'PRIMER_RIGHT_0_SEQUENCE': 'AGGT',
+        }
+        pair1 = primer_pair.PrimerPair(input_dict, 0, 'genome_name')
+        pair2 = primer_pair.PrimerPair(input_dict, 0, 'genome_name')
+        self.assertEqual(pair1, pair2)
+        pair2.hits_to_genomes['genome_name'] = 1
+        self.assertNotEqual(pair1, pair2)
+        pair3 = primer_pair.PrimerPair(input_dict, 0, 'other_genome_name')
+        self.assertNotEqual(pair1, pair3)
 
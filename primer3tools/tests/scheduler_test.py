@@ -0,0 +1,57 @@
+import unittest
+import os
+from primer3tools import scheduler
+
+modules_dir = os.path.dirname(os.path.abspath(scheduler.__file__))
+data_dir = os.path.join(modules_dir, 'tests', 'data')
+
+
+class TestScheduler(unittest.TestCase):
+    def test_init_fails(self):
+        '''test Scheduler __init__ fails on bad input'''
+        with self.assertRaises(scheduler.Error):
+            scheduler.Scheduler(threads=0)
+        with self.assertRaises(scheduler.Error):
+            scheduler.Scheduler(max_memory=-1)
+
+
+    def test_sort_jobs(self):
+        '''test _sort_jobs'''
+        jobs = [scheduler.Job(name, pow, (2, 2), size=size) for name, size in [('a', 1), ('b', 10), ('c', 5), ('d', 10)]]
+        self.assertEqual(['b', 'd', 'c', 'a'], [x.name for x in scheduler.Scheduler._sort_jobs(jobs)])
+
+
+    def test_job_resources(self):
+        '''test _job_resources'''
+        s = scheduler.Scheduler(threads=4, max_memory=100)
+        self.assertEqual((2, 50), s._job_resources(scheduler.Job('a', pow, (2, 2), threads=2, memory=50)))
+        self.assertEqual((4, 100), s._job_resources(scheduler.Job('a', pow, (2, 2), threads=8, memory=200)))
+        s = scheduler.Scheduler(threads=4)
+        self.assertEqual((1, 200), s._job_resources(scheduler.Job('a', pow, (2, 2), threads=0, memory=200)))
+
+
+    def test_number_to_start(self):
+        '''test _number_to_start'''
+        jobs = [scheduler.Job(name, pow, (2, 2), threads=threads, memory=memory) for name, threads, memory in [('a', 2, 60), ('b', 1, 30), ('c', 1, 10)]]
+        s = scheduler.Scheduler(threads=4, max_memory=100)
+        self.assertEqual(3, s._number_to_start(jobs, 4, 100))
+        self.assertEqual(2, s._number_to_start(jobs, 3, 100))
+        self.assertEqual(2, s._number_to_start(jobs, 4, 95))
+        self.assertEqual(0, s._number_to_start(jobs, 1, 100))
+        self.assertEqual(0, s._number_to_start(jobs, 4, 50))
+        # memory is not checked when there is no limit
+        s = scheduler.Scheduler(threads=4)
+        self.assertEqual(3, s._number_to_start(jobs, 4, 0))
+
+
+    def test_run(self):
+        '''test run'''
+        jobs = [scheduler.Job(str(i), pow, (2, i), size=i, threads=1 + i % 3, memory=10 * i) for i in range(10)]
+        for threads, max_memory in [(1, 0), (3, 0), (4, 50)]:
+            s = scheduler.Scheduler(threads=threads, max_memory=max_memory)
+            got = {job.name: result for job, result in s.run(jobs)}
+            self.assertEqual({str(i): 2**i for i in range(10)}, got)
+
+        s = scheduler.Scheduler(threads=1)
+        self.assertEqual(['9', '8', '7', '6', '5', '4', '3', '2', '1', '0'], [x[0].name for x in s.run(jobs)])
+        self.assertEqual([], list(s.run([])))
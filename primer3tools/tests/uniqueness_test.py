@@ -1,11 +1,18 @@
 import unittest
 import pysam
 import filecmp
+import multiprocessing
 import os
-from primer3tools import uniqueness, genome_set
+import gzip
+import random
+import shutil
+import numpy
+from unittest.mock import patch
+from primer3tools import uniqueness, checkpoint, genome_set, mapping, hit_store, hit_table, kmer_filter, primer3_batch, primer_catalog, primer_pair, binary_catalog
 
 modules_dir = os.path.dirname(os.path.abspath(uniqueness.__file__))
 data_dir = os.path.join(modules_dir, 'tests', 'data')
+stand_ins_dir = os.path.join(os.path.dirname(modules_dir), 'benchmarks', 'stand_ins')
 
 
 def write_fake_genomes_file(names, genomes, make_primers, filename):
@@ -15,6 +22,71 @@ def write_fake_genomes_file(names, genomes, make_primers, filename):
             print(names[i], genomes[i], make_primers[i], sep='\t', file=f)
 
 
+# Writes a genome and primer pairs that match it to files called tmp_prefix.*, and
+# indexes the genome with bowtie2. Some primer sequences are in more than one pair,
+# and some have several hits. Returns the environment variables needed to run
+# bowtie2 (using the stand-ins used by the benchmarks if it is not installed), or
+# None if bowtie2 is not found
+def make_mapping_job_files(tmp_prefix):
+    path = os.environ['PATH']
+    if shutil.which('bowtie2') is None or shutil.which('bowtie2-build') is None:
+        if not os.path.exists(stand_ins_dir):
+            return None
+        path = stand_ins_dir + os.pathsep + path
+    env = {'PATH': path, 'PYTHONPATH': os.path.dirname(modules_dir) + os.pathsep + os.environ.get('PYTHONPATH', '')}
+
+    random.seed(42)
+    complement = str.maketrans('ACGT', 'TGCA')
+    contigs = [''.join(random.choices('ACGT', k=2000)) for i in range(3)]
+    pairs = []
+    for i in range(40):
+        contig = random.choice(contigs)
+        start = random.randint(0, len(contig) - 200)
+        pairs.append([contig[start:start + 20], contig[start + 150:start + 170].translate(complement)[::-1]])
+    for i in range(30, 40):
+        pairs[i][0] = pairs[i - 30][0]
+    # more copies of some products
+    contigs = [x + 'N'.join([contigs[0][:200]] * 3) for x in contigs]
+
+    with open(tmp_prefix + '.genome.fa', 'w') as f:
+        for i, seq in enumerate(contigs):
+            print('>contig' + str(i), seq, sep='\n', file=f)
+    with open(tmp_prefix + '.primers.fa', 'w') as f:
+        for i, (left, right) in enumerate(pairs):
+            print('>pair' + str(i) + '/1', left, '>pair' + str(i) + '/2', right, sep='\n', file=f)
+    with patch.dict(os.environ, env):
+        mapping.bowtie2_index(tmp_prefix + '.genome.fa', tmp_prefix + '.bowtie2')
+    return env
+
+
+# Context manager that records the size of the largest HitTable made while it is used
+class LargestHitTable:
+    def __init__(self):
+        self.size = 0
+
+
+    def __enter__(self):
+        original_add, original_add_columns = hit_table.HitTable.add, hit_table.HitTable.add_columns
+
+        def add(hits, *args):
+            original_add(hits, *args)
+            self.size = max(self.size, len(hits))
+
+        def add_columns(hits, *args):
+            original_add_columns(hits, *args)
+            self.size = max(self.size, len(hits))
+
+        self.patches = [patch.object(hit_table.HitTable, 'add', add), patch.object(hit_table.HitTable, 'add_columns', add_columns)]
+        for x in self.patches:
+            x.start()
+        return self
+
+
+    def __exit__(self, *args):
+        for x in self.patches:
+            x.stop()
+
+
 class TestPrimer3(unittest.TestCase):
     def test_cat_primer_fastas(self):
         '''test _cat_primer_fastas'''
@@ -34,10 +106,62 @@ class TestPrimer3(unittest.TestCase):
         uniq._cat_primer_fastas(genomes, catted_fasta)
         expected = os.path.join(data_dir, 'uniqueness_test_cat_primer_fastas.out.fa')
         self.assertTrue(filecmp.cmp(expected, catted_fasta, shallow=False))
+        os.unlink(catted_fasta)
+
+        # primers files made with primer3tools batch --compression none are not gzipped
+        tmp_primer3_dir = 'tmp.test.uniqueness_cat_primer_fastas.primer3_dir'
+        os.mkdir(tmp_primer3_dir)
+        for filename in os.listdir(primer3_dir):
+            with gzip.open(os.path.join(primer3_dir, filename), 'rb') as f_in, open(os.path.join(tmp_primer3_dir, filename), 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        uniq = uniqueness.PrimerUniqueness(genomes_file, tmp_primer3_dir, 'outprefix')
+        uniq._cat_primer_fastas(genomes, catted_fasta)
+        self.assertTrue(filecmp.cmp(expected, catted_fasta, shallow=False))
+        shutil.rmtree(tmp_primer3_dir)
         os.unlink(genomes_file)
         os.unlink(catted_fasta)
 
 
+    def test_load_primer_catalog(self):
+        '''test _load_primer_catalog'''
+        primer3_dir = 'tmp.test.uniqueness_load_primer_catalog.primer3_dir'
+        os.mkdir(primer3_dir)
+        names = ['genome1', 'genome2', 'genome3']
+        genome_files = [os.path.join(data_dir, 'uniqueness_test_cat_primer_fastas.genome' + str(i) + '.fa') for i in range(1, 4)]
+        genomes_file = 'tmp.test.uniqueness_load_primer_catalog.genomes_file'
+        write_fake_genomes_file(names, genome_files, [1, 1, 0], genomes_file)
+        genomes = genome_set.GenomeSet(genomes_file)
+        data_dict = {
+            'SEQUENCE_ID': 'seq1',
+            'PRIMER_LEFT_0': '42,4',
+            'PRIMER_RIGHT_0': '100,3',
+            'PRIMER_LEFT_0_SEQUENCE': 'AAcg',
+            'PRIMER_RIGHT_0_SEQUENCE': 'CNC',
+        }
+        for name in names[:2]:
+            pair = primer_pair.PrimerPair(data_dict, 0, name)
+            with gzip.open(os.path.join(primer3_dir, name + '.primers.fasta.gz'), 'wt') as f:
+                print(pair.left_fasta, pair.right_fasta, sep='\n', file=f)
+            writer = binary_catalog.Writer(os.path.join(primer3_dir, name + '.primer_catalog'), name)
+            writer.add(pair)
+            writer.close()
+
+        uniq = uniqueness.PrimerUniqueness(genomes_file, primer3_dir, 'outprefix')
+        from_binary = 'tmp.test.uniqueness_load_primer_catalog.binary.fa'
+        catalog = uniq._load_primer_catalog(genomes, from_binary)
+        self.assertEqual(['genome1__seq1__0__42__98', 'genome2__seq1__0__42__98'], catalog.names)
+
+        # without a binary catalog for every genome, the FASTA files are used instead
+        shutil.rmtree(os.path.join(primer3_dir, 'genome2.primer_catalog'))
+        from_fasta = 'tmp.test.uniqueness_load_primer_catalog.fasta.fa'
+        self.assertEqual(catalog, uniq._load_primer_catalog(genomes, from_fasta))
+        self.assertTrue(filecmp.cmp(from_binary, from_fasta, shallow=False))
+
+        shutil.rmtree(primer3_dir)
+        for filename in [genomes_file, from_binary, from_fasta]:
+            os.unlink(filename)
+
+
     def test_cat_all_genomes(self):
         '''test _cat_all_genomes'''
         names = ['genome1', 'genome2', 'genome3']
@@ -71,43 +195,339 @@ class TestPrimer3(unittest.TestCase):
             uniqueness.PrimerUniqueness._is_perfect_hit(sam_records[3])
 
 
-    def test_sam_to_read_sequence(self):
-        '''test _sam_to_read_sequence'''
-        expected = ['AATGTGTATAGCGT', 'ATATTCGGCCACGG']
-        sam_file = os.path.join(data_dir, 'uniqueness_test_sam_to_read_sequence.sam')
-        sam_reader = pysam.Samfile(sam_file, "r")
-        sam_records = [record for record in sam_reader.fetch(until_eof=True)]
-        assert len(sam_records) == len(expected)
-        for i in range(len(sam_records)):
-            self.assertEqual(expected[i], uniqueness.PrimerUniqueness._sam_to_read_sequence(sam_records[i]))
+    def test_mapping_jobs(self):
+        '''test _mapping_jobs'''
+        names = ['genome1', 'genome2', 'genome3']
+        genome_files = [os.path.join(data_dir, 'uniqueness_test_cat_all_genomes.' + x + '.fa') for x in names]
+        genomes_file = 'tmp.test.uniqueness_mapping_jobs.genomes_file'
+        write_fake_genomes_file(names, genome_files, [1, 1, 0], genomes_file)
+        genomes = genome_set.GenomeSet(genomes_file)
+        primer3_dir = 'tmp.test.uniqueness_mapping_jobs.primer3_dir'
+        os.mkdir(primer3_dir)
+        uniq = uniqueness.PrimerUniqueness(genomes_file, primer3_dir, 'outprefix')
+        expected = [(x, os.path.join(uniq.primer3_outdir, x + '.bowtie2_index', 'index'), [x], False) for x in names]
+        self.assertEqual(expected, uniq._mapping_jobs(genomes))
+
+        manifest = os.path.join(primer3_dir, mapping.combined_index_manifest)
+        mapping.write_combined_index_manifest({'combined.1': ['genome1', 'genome2']}, manifest)
+        with self.assertRaises(uniqueness.Error):
+            uniq._mapping_jobs(genomes)
+
+        mapping.write_combined_index_manifest({'combined.1': ['genome1', 'genome2'], 'combined.2': ['genome3', 'genome4']}, manifest)
+        expected = [
+            ('combined.1', os.path.join(uniq.primer3_outdir, 'combined.1.bowtie2_index', 'index'), ['genome1', 'genome2'], True),
+            ('combined.2', os.path.join(uniq.primer3_outdir, 'combined.2.bowtie2_index', 'index'), ['genome3'], True),
+        ]
+        self.assertEqual(expected, uniq._mapping_jobs(genomes))
+
+        uniq = uniqueness.PrimerUniqueness(genomes_file, primer3_dir, 'outprefix', mapper='exact')
+        expected = [
+            ('combined.1', os.path.join(uniq.primer3_outdir, 'combined.1.exact_index'), ['genome1', 'genome2'], True),
+            ('combined.2', os.path.join(uniq.primer3_outdir, 'combined.2.exact_index'), ['genome3'], True),
+        ]
+        self.assertEqual(expected, uniq._mapping_jobs(genomes))
+        os.unlink(manifest)
+        os.rmdir(primer3_dir)
+        os.unlink(genomes_file)
 
 
-    def test_filter_pairs_dict(self):
-        '''test _filter_pairs_dict'''
-        test_dict = {
-            'primer1': {'left': {}, 'right': {'contig1': ['hit1']}},
-            'primer2': {'right': {}, 'left': {'contig1': ['hit1']}},
-            'primer3': {'left': {'contig2': ['hit1']}, 'right': {'contig1': ['hit1']}},
+    def test_map_sequences_with_checkpoint(self):
+        '''test _map_sequences_with_checkpoint reuses hits of sequences after adding a primer genome'''
+        random.seed(42)
+        genome = ''.join(random.choice('ACGT') for _ in range(5000))
+        genome_fasta = 'tmp.test.uniqueness_map_sequences_with_checkpoint.fa'
+        with open(genome_fasta, 'w') as f:
+            print('>ctg1', genome, sep='\n', file=f)
+
+        def random_primer():
+            if random.random() < 0.5:
+                start = random.randrange(len(genome) - 20)
+                return genome[start:start + 20]
+            return ''.join(random.choice('ACGT') for _ in range(20))
+
+        def make_catalog(pairs):
+            catalog = primer_catalog.PrimerCatalog()
+            for name, left, right in pairs:
+                catalog._add_pair(name, left, right)
+            catalog._set_lengths()
+            return catalog
+
+        sequences = [random_primer() for i in range(30)]
+        pairs = [('g1__pair' + str(i), random.choice(sequences), random.choice(sequences)) for i in range(40)]
+        new_sequences = [random_primer() for i in range(5)]
+        # a new primer genome whose name sorts in the middle, so its primers are not at the end
+        new_pairs = [('g2__pair' + str(i), random.choice(new_sequences), random.choice(sequences + new_sequences)) for i in range(10)]
+        unique1 = primer_catalog.UniquePrimers(make_catalog(pairs))
+        unique2 = primer_catalog.UniquePrimers(make_catalog(pairs[:20] + new_pairs + pairs[20:]))
+        number_of_new = len(set(new_sequences).intersection([x for pair in new_pairs for x in pair[1:]]))
+
+        checkpoint_dir = 'tmp.test.uniqueness_map_sequences_with_checkpoint.checkpoints'
+        os.mkdir(checkpoint_dir)
+        uniq = uniqueness.PrimerUniqueness('genomes_file', 'primer3_dir', 'outprefix', mapper='scan', checkpoint_dir=checkpoint_dir)
+
+        def hit_set(hits, unique):
+            primer_ids, contig_ids, starts, is_reverse = hits.columns()
+            return {(unique.catalog.sequences[p], hits.contig_names[c], s, r) for p, c, s, r in zip(primer_ids.tolist(), contig_ids.tolist(), starts.tolist(), is_reverse.tolist())}
+
+        def map_sequences(unique):
+            hits = hit_table.HitTable()
+            for new_hits in uniq._map_sequences_with_checkpoint(None, unique, genome_fasta, 'job', 1):
+                hits.add_columns(*new_hits.columns(), new_hits.contig_names)
+            return hits
+
+        mapped = []
+        original_map_primers = uniq._map_primers
+        def map_primers(primers_fasta, catalog, pair_ids, *args, **kwargs):
+            mapped.extend(catalog.sequences if pair_ids is None else [catalog.sequences[2 * x + y] for x in pair_ids for y in (0, 1)])
+            yield from original_map_primers(primers_fasta, catalog, pair_ids, *args, **kwargs)
+        uniq._map_primers = map_primers
+
+        hits1 = map_sequences(unique1)
+        self.assertEqual(unique1.number_of_sequences, len(set(mapped)))
+        self.assertTrue(len(hits1) > 0)
+        expected1 = hit_set(next(original_map_primers(None, unique1.catalog, list(range(len(unique1.catalog))), genome_fasta, 'job', 1)), unique1)
+        self.assertEqual(expected1, hit_set(hits1, unique1))
+
+        # only the new sequences are mapped, however the sequences are now paired up
+        mapped.clear()
+        hits2 = map_sequences(unique2)
+        self.assertEqual(number_of_new, len(set(mapped)))
+        self.assertTrue(set(mapped).issubset(new_sequences))
+        expected2 = hit_set(next(original_map_primers(None, unique2.catalog, list(range(len(unique2.catalog))), genome_fasta, 'job', 1)), unique2)
+        self.assertEqual(expected2, hit_set(hits2, unique2))
+
+        # nothing is mapped when run again
+        mapped.clear()
+        hits3 = map_sequences(unique2)
+        self.assertEqual([], mapped)
+        self.assertEqual(expected2, hit_set(hits3, unique2))
+
+        shutil.rmtree(checkpoint_dir)
+        os.unlink(genome_fasta)
+
+
+    def test_run_mapping_job_hit_batches(self):
+        '''test _run_mapping_job only has about one batch of hits in memory at once, with and without dedup and checkpoints'''
+        tmp_prefix = 'tmp.test_run_mapping_job_hit_batches'
+        env = make_mapping_job_files(tmp_prefix)
+        if env is None:
+            self.skipTest('bowtie2 not found in path')
+        catalog = primer_catalog.PrimerCatalog(tmp_prefix + '.primers.fa')
+        unique_primers = primer_catalog.UniquePrimers(catalog)
+        unique_primers.catalog.write_fasta(tmp_prefix + '.unique_primers.fa')
+        job = ('job', tmp_prefix + '.bowtie2', ['genome1'], False)
+        hit_batch_size = 10
+
+        checkpoint_dir = tmp_prefix + '.checkpoints'
+        os.mkdir(checkpoint_dir)
+        with patch.dict(os.environ, env):
+            uniq = uniqueness.PrimerUniqueness('genomes_file', 'primer3_dir', tmp_prefix, dedup_primers=False)
+            expected = uniq._run_mapping_job(tmp_prefix + '.primers.fa', catalog, job, 1)
+            all_hits = next(uniq._map_primers(tmp_prefix + '.unique_primers.fa', unique_primers.catalog, None, job[1], 'job', 1))
+            # default options apart from the batch size, then with checkpoints, which
+            # are made on the first run and used on the second
+            got = {}
+            for dedup_primers, use_checkpoint, run in [(True, False, 0), (True, True, 0), (True, True, 1), (False, True, 0), (False, True, 1)]:
+                uniq = uniqueness.PrimerUniqueness('genomes_file', 'primer3_dir', tmp_prefix, hit_batch_size=hit_batch_size, dedup_primers=dedup_primers, checkpoint_dir=checkpoint_dir if use_checkpoint else None)
+                with LargestHitTable() as largest:
+                    if dedup_primers:
+                        result = uniq._run_mapping_job(tmp_prefix + '.unique_primers.fa', catalog, job, 1, unique_primers=unique_primers)
+                    else:
+                        result = uniq._run_mapping_job(tmp_prefix + '.primers.fa', catalog, job, 1)
+                got[(dedup_primers, use_checkpoint, run)] = result, largest.size
+
+        self.assertTrue(len(expected[1]) > 0)
+        # a batch can go over the batch size by the hits of one primer pair, of either the
+        # distinct sequences or the original primers
+        hits_per_sequence = numpy.bincount(all_hits.columns()[0], minlength=len(unique_primers.catalog.sequences))
+        most_pair_hits = max(hits_per_sequence.reshape(-1, 2).sum(axis=1).max(), hits_per_sequence[unique_primers.query_ids].reshape(-1, 2).sum(axis=1).max())
+        self.assertTrue(len(all_hits) > hit_batch_size + most_pair_hits)
+        for (dedup_primers, use_checkpoint, run), (result, largest_size) in got.items():
+            self.assertEqual(expected[:5], result[:5])
+            # with dedup, only the hits of distinct sequences are counted
+            self.assertEqual(len(all_hits) if dedup_primers else expected[5]['counts']['hits'], result[5]['counts']['hits'])
+            self.assertEqual({k: v for k, v in expected[5]['counts'].items() if k != 'hits'}, {k: v for k, v in result[5]['counts'].items() if k != 'hits'})
+            self.assertTrue(0 < largest_size <= hit_batch_size + most_pair_hits)
+
+        # the checkpoints have the hits in more than one part
+        for filename in ['job.bowtie2.sequences.npz', 'job.bowtie2.npz']:
+            self.assertTrue(len(checkpoint.load(os.path.join(checkpoint_dir, filename)).part_suffixes) > 1)
+        self.assertEqual([], [x for x in os.listdir('.') if x.startswith(tmp_prefix + '.tmp')])
+        self.assertEqual([], [x for x in os.listdir(checkpoint_dir) if '.tmp' in x])
+
+        shutil.rmtree(checkpoint_dir)
+        for filename in os.listdir('.'):
+            if filename.startswith(tmp_prefix):
+                os.unlink(filename)
+
+
+    def test_primer_scanner(self):
+        '''test _primer_scanner'''
+        catalog1 = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'exact_index_test.primers.fa'))
+        catalog2 = primer_catalog.sequence_pairs_catalog(['GGGTTTACGT', 'CCCGG'])
+        genome_fasta = os.path.join(data_dir, 'exact_index_test.fa')
+        uniq = uniqueness.PrimerUniqueness('genomes_file', 'primer3_dir', 'outprefix', mapper='scan')
+
+        scanner1 = uniq._primer_scanner(catalog1, None)
+        self.assertIs(scanner1, uniq._primer_scanner(catalog1, None))
+        self.assertIsNot(scanner1, uniq._primer_scanner(catalog1, [0, 1, 2]))
+        # a different catalog must not use the scanner of the first one
+        scanner2 = uniq._primer_scanner(catalog2, None)
+        self.assertIsNot(scanner1, scanner2)
+        self.assertEqual({0, 1}, set(scanner2.hit_table(genome_fasta).columns()[0].tolist()))
+        self.assertIs(scanner2, uniq._primer_scanner(catalog2, None))
+        # another PrimerUniqueness does not share scanners
+        self.assertIsNot(scanner2, uniqueness.PrimerUniqueness('genomes_file', 'primer3_dir', 'outprefix', mapper='scan')._primer_scanner(catalog2, None))
+
+
+    def test_kmer_filter_pair_ids(self):
+        '''test _kmer_filter_pair_ids'''
+        random.seed(42)
+        primer3_dir = 'tmp.test.uniqueness_kmer_filter_pair_ids.primer3_dir'
+        if os.path.exists(primer3_dir):
+            shutil.rmtree(primer3_dir)
+        os.mkdir(primer3_dir)
+        genomes = {x: ''.join(random.choice('ACGT') for _ in range(300)) for x in ['genome1', 'genome2']}
+        for name, seq in genomes.items():
+            fasta_file = os.path.join(primer3_dir, name + '.fa')
+            with open(fasta_file, 'w') as f:
+                print('>contig', seq, sep='\n', file=f)
+            kmer_filter.build(fasta_file, primer3_batch.kmer_filter_file(os.path.join(primer3_dir, name)))
+
+        # pair1 and pair3 can match genome1 and genome2. pair2 has one primer in each
+        # genome, so cannot match either. pair4 has a primer that is in neither genome
+        not_in_genomes = ''.join(random.choice('ACGT') for _ in range(20))
+        primers = [
+            genomes['genome1'][10:30], genomes['genome1'][200:220],
+            genomes['genome1'][50:70], genomes['genome2'][50:70],
+            genomes['genome2'][10:30], genomes['genome2'][200:220],
+            genomes['genome1'][10:30], not_in_genomes,
+        ]
+        primers_fasta = os.path.join(primer3_dir, 'primers.fa')
+        with open(primers_fasta, 'w') as f:
+            for i, seq in enumerate(primers):
+                print('>pair' + str(i // 2 + 1) + '/' + str(i % 2 + 1), seq, sep='\n', file=f)
+        catalog = primer_catalog.PrimerCatalog(primers_fasta)
+        unique_primers = primer_catalog.UniquePrimers(catalog)
+
+        uniq = uniqueness.PrimerUniqueness('genomes_file', primer3_dir, 'outprefix', kmer_filter=True)
+        self.assertEqual(([0], 3), uniq._kmer_filter_pair_ids(catalog, ['genome1']))
+        self.assertEqual(([2], 3), uniq._kmer_filter_pair_ids(catalog, ['genome2']))
+        self.assertEqual(([0, 2], 2), uniq._kmer_filter_pair_ids(catalog, ['genome1', 'genome2']))
+        # the left primer of pair4 is the same as pair1, so the pairs of unique
+        # sequences are the same as the first three primer pairs
+        self.assertEqual(([0], 3), uniq._kmer_filter_pair_ids(catalog, ['genome1'], unique_primers=unique_primers))
+        self.assertEqual(([0, 2], 2), uniq._kmer_filter_pair_ids(catalog, ['genome1', 'genome2'], unique_primers=unique_primers))
+        shutil.rmtree(primer3_dir)
+
+
+    def test_sort_mapping_jobs_by_size(self):
+        '''test _sort_mapping_jobs_by_size'''
+        names = ['genome1', 'genome2', 'genome3']
+        genome_files = [os.path.join(data_dir, 'uniqueness_test_cat_all_genomes.' + x + '.fa') for x in names]
+        genomes_file = 'tmp.test.uniqueness_sort_mapping_jobs_by_size.genomes_file'
+        write_fake_genomes_file(names, genome_files, [1, 1, 0], genomes_file)
+        genomes = genome_set.GenomeSet(genomes_file)
+        sizes = {x: os.path.getsize(genomes[x].fasta_file) for x in names}
+        jobs = [(x, 'index', [x], False) for x in names]
+        expected = sorted(jobs, key=lambda x: (-sizes[x[0]], x[0]))
+        self.assertEqual(expected, uniqueness.PrimerUniqueness._sort_mapping_jobs_by_size(jobs, genomes))
+        os.unlink(genomes_file)
+
+
+    def test_split_threads(self):
+        '''test _split_threads'''
+        tests = [
+            (1, 1, (1, [1])),
+            (1, 10, (1, [1])),
+            (4, 10, (4, [1, 1, 1, 1])),
+            (4, 2, (2, [2, 2])),
+            (5, 2, (2, [3, 2])),
+            (7, 2, (2, [4, 3])),
+            (64, 3, (3, [22, 21, 21])),
+            (4, 0, (1, [4])),
+        ]
+
+        for threads, jobs, expected in tests:
+            self.assertEqual(expected, uniqueness.PrimerUniqueness._split_threads(threads, jobs))
+
+
+    def test_init_mapping_worker(self):
+        '''test _init_mapping_worker gives each worker its share of the threads'''
+        processes, worker_threads = uniqueness.PrimerUniqueness._split_threads(7, 2)
+        worker_counter = multiprocessing.Value('i', 0)
+        threads = []
+        for i in range(processes):
+            uniqueness._init_mapping_worker('uniqueness', 'primers.fa', 'catalog', None, worker_threads, worker_counter)
+            threads.append(uniqueness._mapping_worker[-1])
+        self.assertEqual([4, 3], threads)
+        uniqueness._init_mapping_worker('uniqueness', 'primers.fa', 'catalog')
+        self.assertEqual(('uniqueness', 'primers.fa', 'catalog', None, 1), uniqueness._mapping_worker)
+        uniqueness._mapping_worker = None
+
+
+    def test_merge_primer_hits(self):
+        '''test _merge_primer_hits'''
+        primer_hits = {'primer1': {'genome1': 'matches1'}}
+        job_primer_hits = {
+            'primer1': {'genome2': 'matches2'},
+            'primer2': {'genome2': 'matches3', 'genome3': 'matches4'},
         }
         expected = {
-            'primer3': {'left': {'contig2': ['hit1']}, 'right': {'contig1': ['hit1']}},
+            'primer1': {'genome1': 'matches1', 'genome2': 'matches2'},
+            'primer2': {'genome2': 'matches3', 'genome3': 'matches4'},
         }
-
-        uniqueness.PrimerUniqueness._filter_pairs_dict(test_dict)
-        self.assertEqual(test_dict, expected)
+        uniqueness.PrimerUniqueness._merge_primer_hits(primer_hits, job_primer_hits)
+        self.assertEqual(expected, primer_hits)
 
 
     def test_parse_sam(self):
         '''test _parse_sam'''
         sam_file = os.path.join(data_dir, 'uniqueness_test_parse_sam.sam')
-        got_dict = uniqueness.PrimerUniqueness._parse_sam(sam_file)
-        expected_dict = {
-            'primer2': {
-                'left': {'contig1': [(0, 13, False, 'AGTAATTAATAAC')]},
-                'right': {'contig2': [(31, 14, True, 'TCGCTCCAGGTACG')]}
-            }
-        }
-        self.assertEqual(got_dict, expected_dict)
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa'))
+        got = uniqueness.PrimerUniqueness._parse_sam(sam_file, catalog)
+        expected = hit_table.HitTable()
+        expected.add(0, 'contig1', 0, False)
+        expected.add(2, 'contig1', 0, False)
+        expected.add(3, 'contig2', 31, True)
+        self.assertEqual(expected, got)
+
+
+    def test_hit_tables_from_sam_reader(self):
+        '''test _hit_tables_from_sam_reader'''
+        sam_file = os.path.join(data_dir, 'uniqueness_test_parse_sam.sam')
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa'))
+        expected1 = hit_table.HitTable()
+        expected1.add(0, 'contig1', 0, False)
+        expected2 = hit_table.HitTable()
+        expected2.add(2, 'contig1', 0, False)
+        expected2.add(3, 'contig2', 31, True)
+        expected_all = hit_table.HitTable()
+        expected_all.add(0, 'contig1', 0, False)
+        expected_all.add(2, 'contig1', 0, False)
+        expected_all.add(3, 'contig2', 31, True)
+
+        for batch_size, expected in [(1, [expected1, expected2]), (2, [expected_all]), (1000, [expected_all])]:
+            sam_reader = pysam.Samfile(sam_file, "r")
+            got = list(uniqueness.PrimerUniqueness._hit_tables_from_sam_reader(sam_reader, catalog, batch_size))
+            self.assertEqual(expected, got)
+
+
+    def test_hit_tables_from_sam_reader_fails(self):
+        '''test _hit_tables_from_sam_reader fails when reads are not in order of primer catalog'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_parse_sam.reads.fa'))
+        tmp_sam = 'tmp.test_hit_tables_from_sam_reader_fails.sam'
+        with open(os.path.join(data_dir, 'uniqueness_test_parse_sam.sam')) as f:
+            lines = f.readlines()
+        with open(tmp_sam, 'w') as f:
+            print(*lines[:4], sep='', end='', file=f)
+            print(*lines[6:], sep='', end='', file=f)
+            print(*lines[4:6], sep='', end='', file=f)
+
+        sam_reader = pysam.Samfile(tmp_sam, "r")
+        with self.assertRaises(uniqueness.Error):
+            list(uniqueness.PrimerUniqueness._hit_tables_from_sam_reader(sam_reader, catalog, 1))
+        os.unlink(tmp_sam)
 
 
     def test_is_good_primer_pair(self):
@@ -129,63 +549,49 @@ class TestPrimer3(unittest.TestCase):
             self.assertEqual(expected, u._is_good_primer_pair(left_primer, right_primer))
 
 
-    def test_good_primer_pairs_from_lists(self):
-        '''test _good_primer_pairs_from_lists'''
-        p1 = (0, 10, False, 'ACGTACGTAC')
-        p2 = (30, 10, False, 'ACGTACGTAC')
-        p3 = (40, 10, True, 'ACGTACGTAC')
-        p4 = (35, 10, True, 'ACGTACGTAC')
-        p5 = (1000, 10, False, 'ACGTACGTAC')
-        p6 = (1040, 10, True, 'ACGTACGTAC')
-
-        list1 = [p1, p5]
-        list2 = [p2, p3, p4, p6]
-        expected = [(p1, p3), (p5, p6)]
-
+    def test_matches_from_hit_table(self):
+        '''test _matches_from_hit_table'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_matches_from_hit_table.primers.fa'))
+        hits = hit_table.HitTable()
         u = uniqueness.PrimerUniqueness('genomes_file', 'primer3_outdir', 'outprefix', min_product_length=50, max_product_length=200)
-        got = u._good_primer_pairs_from_lists(list1, list2)
-        self.assertEqual(expected, got)
-
-
-    def test_all_primer_matches(self):
-        '''test _all_primer_matches'''
-        test_dict = {
-            'left': {
-                'contig1': [(0, 10, False, 'ACGTACGTAC'), (40, 10, True, 'ACGTACGTAC')],
-                'contig2': [(0, 10, False, 'ACGTACGTAC'), (1000, 10, False, 'ACGTACGTAC')],
-            },
-            'right': {
-                'contig1': [(40, 10, True, 'ACGTACGTAC')],
-                'contig2': [(1040, 10, True, 'ACGTACGTAC')],
-            },
-        }
-
-        u = uniqueness.PrimerUniqueness('genomes_file', 'primer3_outdir', 'outprefix', min_product_length=50, max_product_length=200)
-        got = u._all_primer_matches(test_dict)
+        self.assertEqual({}, u._matches_from_hit_table(hits, catalog))
+
+        hits.add(0, 'contig1', 0, False)
+        hits.add(0, 'contig1', 40, True)
+        hits.add(0, 'contig2', 0, False)
+        hits.add(0, 'contig2', 1000, False)
+        hits.add(1, 'contig1', 40, True)
+        hits.add(1, 'contig2', 1040, True)
+        hits.add(1, 'contig2', 30, False)
+        hits.add(1, 'contig2', 35, True)
+        hits.add(2, 'contig1', 0, False)
+        hits.add(3, 'contig2', 100, True)
+        hits.add(5, 'contig2', 100, True)
+        got = u._matches_from_hit_table(hits, catalog)
         expected = {
-            'contig1': [((0, 10, False, 'ACGTACGTAC'), (40, 10, True, 'ACGTACGTAC'))],
-            'contig2': [((1000, 10, False, 'ACGTACGTAC'), (1040, 10, True, 'ACGTACGTAC'))]
+            'primer1': {
+                'contig1': [((0, 10, False, 'ACGTACGTAC'), (40, 10, True, 'CATGCATGCA'))],
+                'contig2': [((1000, 10, False, 'ACGTACGTAC'), (1040, 10, True, 'CATGCATGCA'))]
+            }
         }
         self.assertEqual(expected, got)
 
 
     def test_update_primer_hits(self):
         '''test _update_primer_hits'''
+        catalog = primer_catalog.PrimerCatalog(os.path.join(data_dir, 'uniqueness_test_matches_from_hit_table.primers.fa'))
         u = uniqueness.PrimerUniqueness('genomes_file', 'primer3_outdir', 'outprefix', min_product_length=50, max_product_length=200)
         primer_hits = {}
-        u._update_primer_hits(primer_hits, {}, 'genome1')
+        u._update_primer_hits(primer_hits, hit_table.HitTable(), catalog, 'genome1')
         self.assertEqual({}, primer_hits)
 
-        pairs_dict = {
-            'primer1': {
-                'left': {'contig1': [(0, 13, False, 'AGTAATTAATAAC')]},
-                'right': {'contig1': [(100, 14, True, 'TCGCTCCAGGTACG')]}
-            }
-        }
-        u._update_primer_hits(primer_hits, pairs_dict, 'genome2')
+        hits = hit_table.HitTable()
+        hits.add(2, 'contig1', 0, False)
+        hits.add(3, 'contig1', 100, True)
+        u._update_primer_hits(primer_hits, hits, catalog, 'genome2')
 
         expected = {
-            'primer1': {
+            'primer2': {
                 'genome2': {
                     'contig1': [((0, 13, False, 'AGTAATTAATAAC'), (100, 14, True, 'TCGCTCCAGGTACG'))]
                 }
@@ -230,6 +636,21 @@ class TestPrimer3(unittest.TestCase):
             expected = os.path.join(data_dir, 'uniqueness_test_write_all_output_files.expected.' + suffix)
             self.assertTrue(filecmp.cmp(got, expected, shallow=False))
             os.unlink(got)
+        self.assertFalse(os.path.exists('tmp.test_write_all_output_files.hits.sqlite'))
+
+        uniq.hits_db = True
+        uniq._write_all_output_files(primer_hits, genomes)
+        for suffix in ('all_primers.hits.tsv', 'genome_uniqueness.tsv', 'unique_primers.tsv'):
+            got = 'tmp.test_write_all_output_files.' + suffix
+            expected = os.path.join(data_dir, 'uniqueness_test_write_all_output_files.expected.' + suffix)
+            self.assertTrue(filecmp.cmp(got, expected, shallow=False))
+            os.unlink(got)
+        store = hit_store.HitStore('tmp.test_write_all_output_files.hits.sqlite')
+        self.assertEqual(['primer1', 'primer2'], store.primer_pairs_in_genome('genome2'))
+        self.assertEqual(['primer1'], store.primer_pairs_in_genome('genome2', unique_only=True))
+        self.assertEqual([('genome1', 'contig1', 1, '+', 101, '-'), ('genome2', 'contig2', 11, '+', 111, '-')], store.hits('primer2'))
+        store.close()
+        os.unlink('tmp.test_write_all_output_files.hits.sqlite')
         os.unlink(genomes_file)
 
 
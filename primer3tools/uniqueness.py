@@ -1,4 +1,8 @@
 import os
+import sys
+import multiprocessing
+import shutil
+import numpy
 import pyfastaq
 import pysam
 import primer3tools
@@ -7,13 +11,81 @@ import primer3tools
 class Error (Exception): pass
 
 
+_mapping_worker = None
+
+
+# the uniqueness object and primer catalog (and its unique primers, or None) are
+# given to each worker process once here, instead of with every mapping job.
+# Each worker takes the next number from worker_counter, and worker number i
+# runs its jobs with worker_threads[i] threads
+def _init_mapping_worker(uniqueness, primers_fasta, catalog, unique_primers=None, worker_threads=(1,), worker_counter=None):
+    global _mapping_worker
+    if worker_counter is None:
+        worker_number = 0
+    else:
+        with worker_counter.get_lock():
+            worker_number = worker_counter.value
+            worker_counter.value += 1
+    _mapping_worker = (uniqueness, primers_fasta, catalog, unique_primers, worker_threads[worker_number])
+
+
+# throws a pickle error without this wrapper...
+def _run_mapping_job_wrapper(y):
+    uniqueness, primers_fasta, catalog, unique_primers, threads = _mapping_worker
+    job, max_memory = y
+    return uniqueness._run_mapping_job(primers_fasta, catalog, job, threads, max_memory=max_memory, unique_primers=unique_primers)
+
+
 class PrimerUniqueness:
-    def __init__(self, genomes_file, primer3_outdir, outprefix, min_product_length=50, max_product_length=1000):
+    def __init__(self, genomes_file, primer3_outdir, outprefix, min_product_length=50, max_product_length=1000, threads=1, mapping_io='file', hit_batch_size=100000, checkpoint_dir=None, mapper='bowtie2', dedup_primers=True, hits_db=False, max_hits_per_primer=0, kmer_filter=False, max_memory=0):
         self.genomes_file = os.path.abspath(genomes_file)
         self.primer3_outdir = os.path.abspath(primer3_outdir)
         self.outprefix = outprefix
         self.min_product_length = min_product_length
         self.max_product_length = max_product_length
+        self.threads = threads
+        self.mapping_io = mapping_io
+        self.hit_batch_size = hit_batch_size
+        self.checkpoint_dir = None if checkpoint_dir is None else os.path.abspath(checkpoint_dir)
+        self.mapper = mapper
+        self.dedup_primers = dedup_primers
+        self.hits_db = hits_db
+        self.max_hits_per_primer = max_hits_per_primer
+        self.kmer_filter = kmer_filter
+        self.max_memory = max_memory
+
+        if self.mapper not in ['bowtie2', 'exact', 'scan']:
+            raise Error('mapper must be one of bowtie2, exact, scan. Got: ' + str(self.mapper))
+
+        if self.max_hits_per_primer < 0:
+            raise Error('Maximum hits per primer cannot be negative. Got: ' + str(self.max_hits_per_primer))
+        if self.max_memory < 0:
+            raise Error('Maximum memory cannot be negative. Got: ' + str(self.max_memory))
+
+        if self.mapping_io not in ['file', 'sam', 'bam']:
+            raise Error('mapping_io must be one of file, sam, bam. Got: ' + str(self.mapping_io))
+        if self.mapping_io == 'bam' and shutil.which('samtools') is None:
+            raise Error('samtools not found in path. It is needed to stream BAM output from bowtie2')
+
+
+    # Yields the sequences in an open FASTA filehandle, as pyfastaq.sequences.Fasta objects
+    @staticmethod
+    def _fasta_reader(filehandle):
+        name = None
+        seq_lines = []
+        for line in filehandle:
+            if line.startswith('>'):
+                if name is not None:
+                    yield pyfastaq.sequences.Fasta(name, ''.join(seq_lines))
+                name = line[1:].rstrip()
+                seq_lines = []
+            elif name is None:
+                raise Error('Error reading FASTA file. Expected a line starting with ">". Got: ' + line)
+            else:
+                seq_lines.append(line.strip())
+
+        if name is not None:
+            yield pyfastaq.sequences.Fasta(name, ''.join(seq_lines))
 
 
     def _cat_primer_fastas(self, genomes, outfile):
@@ -23,21 +95,33 @@ class PrimerUniqueness:
            for genome_name in sorted(genomes):
                if genomes[genome_name].make_primers:
                    primers_fasta = os.path.join(self.primer3_outdir, genome_name + '.primers.fasta.gz')
-                   file_reader = pyfastaq.sequences.file_reader(primers_fasta)
-                   for seq in file_reader:
-                       print(seq, file=f_out)
+                   # the file may not be gzipped, whatever its name (see primer3tools batch --compression)
+                   with primer3tools.compression.open_read(primers_fasta) as f_in:
+                       for seq in self._fasta_reader(f_in):
+                           print(seq, file=f_out)
 
         pyfastaq.sequences.Fasta.line_length = original_line_length
 
 
+    # Writes all the primers to outfile, and returns them as a PrimerCatalog. If primer3 made a
+    # binary primer catalog for every genome, those are used instead of parsing the FASTA
+    # files. Output of older versions of primer3tools batch does not have them
+    def _load_primer_catalog(self, genomes, outfile):
+        catalog_dirs = [os.path.join(self.primer3_outdir, x + '.primer_catalog') for x in sorted(genomes) if genomes[x].make_primers]
+        if not all(primer3tools.binary_catalog.is_binary_catalog(x) for x in catalog_dirs):
+            self._cat_primer_fastas(genomes, outfile)
+            return primer3tools.primer_catalog.PrimerCatalog(outfile)
+
+        binary_catalogs = [primer3tools.binary_catalog.BinaryCatalog(x) for x in catalog_dirs]
+        with open(outfile, 'w') as f:
+            for binary_catalog in binary_catalogs:
+                f.writelines(binary_catalog.fasta_lines())
+        return primer3tools.primer_catalog.from_binary_catalogs(binary_catalogs)
+
+
     @staticmethod
     def _cat_all_genomes(genomes, outfile):
-        with open(outfile, 'w') as f_out:
-            for genome_name in sorted(genomes):
-                file_reader = pyfastaq.sequences.file_reader(genomes[genome_name].fasta_file)
-                for seq in file_reader:
-                    seq.id = genome_name + '__' + seq.id
-                    print(seq, file=f_out)
+        primer3tools.genome_set.write_combined_fasta(genomes, genomes, outfile, separator=primer3tools.mapping.combined_index_separator)
 
 
     @staticmethod
@@ -57,48 +141,45 @@ class PrimerUniqueness:
 
 
     @staticmethod
-    def _sam_to_read_sequence(sam_record):
-        assert not sam_record.is_unmapped
-        if sam_record.is_reverse:
-            fa = pyfastaq.sequences.Fasta('x', sam_record.query_sequence)
-            fa.revcomp()
-            return fa.seq
-        else:
-            return sam_record.query_sequence
+    def _parse_sam(infile, catalog):
+        sam_reader = pysam.Samfile(infile, "r")
+        return PrimerUniqueness._parse_sam_reader(sam_reader, catalog)
 
 
     @staticmethod
-    def _filter_pairs_dict(pairs_dict):
-        keys_to_remove = set()
-        for name in pairs_dict:
-            if 0 in [len(pairs_dict[name]['left']), len(pairs_dict[name]['right'])]:
-                keys_to_remove.add(name)
-
-        for name in keys_to_remove:
-            del pairs_dict[name]
-
-
+    def _parse_sam_reader(sam_reader, catalog):
+        hits = primer3tools.hit_table.HitTable()
+        for hits in PrimerUniqueness._hit_tables_from_sam_reader(sam_reader, catalog, float('inf')):
+            pass
+        return hits
+
+
+    # Yields HitTables of perfect hits, each containing all the hits of one or more
+    # primer pairs and at least batch_size hits (apart from the last one). This
+    # needs bowtie2 to have been run with --reorder, so that all records of a primer
+    # pair are together, in the same order as the primer catalog. Then only one batch of
+    # hits is held in memory at a time
     @staticmethod
-    def _parse_sam(infile):
-        sam_reader = pysam.Samfile(infile, "r")
-        pairs_dict = {}
+    def _hit_tables_from_sam_reader(sam_reader, catalog, batch_size):
+        hits = primer3tools.hit_table.HitTable()
+        last_pair_id = -1
 
         for read in sam_reader.fetch(until_eof=True):
-            name_prefix, name_suffix = read.qname.rsplit('/', maxsplit=1)
-            assert name_suffix in ['1', '2']
-            left_or_right = 'left' if name_suffix == '1' else 'right'
-
-            if name_prefix not in pairs_dict:
-                pairs_dict[name_prefix] = {'left': {}, 'right': {}}
+            primer_id = catalog.primer_id(read.query_name)
+            pair_id = primer_id // 2
+            if pair_id != last_pair_id:
+                if pair_id < last_pair_id:
+                    raise Error('SAM records are not in the same order as the primers. Cannot continue. Got to this primer too late: ' + read.query_name)
+                if len(hits) >= batch_size:
+                    yield hits
+                    hits = primer3tools.hit_table.HitTable()
+                last_pair_id = pair_id
 
             if PrimerUniqueness._is_perfect_hit(read):
-                refname = sam_reader.getrname(read.reference_id)
-                if refname not in pairs_dict[name_prefix][left_or_right]:
-                    pairs_dict[name_prefix][left_or_right][refname] = []
-                pairs_dict[name_prefix][left_or_right][refname].append((read.reference_start, read.query_length, read.is_reverse, PrimerUniqueness._sam_to_read_sequence(read)))
+                hits.add(primer_id, read.reference_name, read.reference_start, read.is_reverse)
 
-        PrimerUniqueness._filter_pairs_dict(pairs_dict)
-        return pairs_dict
+        if len(hits):
+            yield hits
 
 
     def _is_good_primer_pair(self, left_primer, right_primer):
@@ -116,56 +197,79 @@ class PrimerUniqueness:
             return right_start < left_start and self.min_product_length <= (left_end - right_start + 1) <= self.max_product_length
 
 
-    def _good_primer_pairs_from_lists(self, list1, list2):
-        good_pairs = []
-
-        for left_primer in list1:
-            for right_primer in list2:
-                if self._is_good_primer_pair(left_primer, right_primer):
-                    good_pairs.append((left_primer, right_primer))
-
-        return good_pairs
-
-
-    def _all_primer_matches(self, hits_dict):
+    # Returns dictionary of primer name -> contig name -> list of (left hit, right hit),
+    # for all primer pairs in the hit table that would make a PCR product. Each hit is a
+    # tuple (start, length, is reverse, sequence). The hits for all primer pairs and
+    # contigs are paired at once by pairing.good_pair_indexes
+    def _matches_from_hit_table(self, hits, catalog):
+        if len(hits) == 0:
+            return {}
+
+        primer_ids, contig_ids, starts, is_reverse = hits.columns()
+        lengths = catalog.lengths[primer_ids]
+        left_indexes, right_indexes = primer3tools.pairing.good_pair_indexes(
+            (primer_ids // 2) * len(hits.contig_names) + contig_ids,
+            starts,
+            lengths,
+            is_reverse,
+            primer_ids % 2 == 1,
+            self.min_product_length,
+            self.max_product_length,
+        )
+
+        primer_ids = primer_ids.tolist()
+        contig_ids = contig_ids.tolist()
+        starts = starts.tolist()
+        is_reverse = is_reverse.tolist()
+        lengths = lengths.tolist()
         matches = {}
-        left_contig_names = set(hits_dict['left'].keys())
-        right_contig_names = set(hits_dict['right'].keys())
-        common_contig_names = left_contig_names.intersection(right_contig_names)
 
-        for contig_name in common_contig_names:
-            left_hits = hits_dict['left'][contig_name]
-            right_hits = hits_dict['right'][contig_name]
-            good_pairs = self._good_primer_pairs_from_lists(left_hits, right_hits)
-            if len(good_pairs):
-                matches[contig_name] = good_pairs
+        for left_index, right_index in zip(left_indexes.tolist(), right_indexes.tolist()):
+            name = catalog.names[primer_ids[left_index] // 2]
+            contig_name = hits.contig_names[contig_ids[left_index]]
+            if name not in matches:
+                matches[name] = {}
+            if contig_name not in matches[name]:
+                matches[name][contig_name] = []
+            matches[name][contig_name].append(tuple(
+                (starts[i], lengths[i], is_reverse[i], catalog.sequences[primer_ids[i]]) for i in (left_index, right_index)
+            ))
 
         return matches
 
 
-    def _update_primer_hits(self, primer_hits, pairs_dict, genome_name):
-        for primer_name_prefix in pairs_dict:
-            matches = self._all_primer_matches(pairs_dict[primer_name_prefix])
-            if len(matches):
-                if primer_name_prefix not in primer_hits:
-                    primer_hits[primer_name_prefix] = {}
-                assert genome_name not in primer_hits[primer_name_prefix]
-                primer_hits[primer_name_prefix][genome_name] = matches
+    def _update_primer_hits(self, primer_hits, hits, catalog, genome_name):
+        for primer_name_prefix, matches in self._matches_from_hit_table(hits, catalog).items():
+            if primer_name_prefix not in primer_hits:
+                primer_hits[primer_name_prefix] = {}
+            assert genome_name not in primer_hits[primer_name_prefix]
+            primer_hits[primer_name_prefix][genome_name] = matches
 
 
+    # primer_hits is a dictionary of primer name -> genome name -> contig name -> list of
+    # (left hit, right hit), or an iterator of (primer name, genome name -> ...) sorted
+    # by primer name (see match_runs.merge). Returns the number of primer pairs written
     def _write_all_output_files(self, primer_hits, genomes):
         all_tsv = self.outprefix + '.all_primers.hits.tsv'
         unique_tsv = self.outprefix + '.unique_primers.tsv'
         f_out_all = pyfastaq.utils.open_file_write(all_tsv)
         f_out_unique = pyfastaq.utils.open_file_write(unique_tsv)
+        hit_store = primer3tools.hit_store.HitStoreWriter(self.outprefix + '.hits.sqlite') if self.hits_db else None
         genomes_with_unique_primer_pair = set()
+        primer_pairs_written = 0
+        if isinstance(primer_hits, dict):
+            sorted_primer_hits = [(x, primer_hits[x]) for x in sorted(primer_hits)]
+        else:
+            sorted_primer_hits = primer_hits
 
-        for primer_pair_prefix in sorted(primer_hits):
+        for primer_pair_prefix, genome_hits in sorted_primer_hits:
             all_hits = []
+            store_hits = []
             unique_hit = None
-            for genome_name in sorted(primer_hits[primer_pair_prefix]):
-                for contig_name in sorted(primer_hits[primer_pair_prefix][genome_name]):
-                    for left, right in primer_hits[primer_pair_prefix][genome_name][contig_name]:
+            primer_pairs_written += 1
+            for genome_name in sorted(genome_hits):
+                for contig_name in sorted(genome_hits[genome_name]):
+                    for left, right in genome_hits[genome_name][contig_name]:
                         unique_hit = [
                             genome_name,
                             contig_name,
@@ -177,15 +281,21 @@ class PrimerUniqueness:
                         all_hits.append(';'.join(unique_hit))
                         left_seq = left[3]
                         right_seq = right[3]
+                        if hit_store is not None:
+                            store_hits.append((genome_name, contig_name, left[0] + 1, unique_hit[3], right[0] + 1, unique_hit[5]))
 
             if len(all_hits) == 1:
                 print(unique_hit[0], unique_hit[1], unique_hit[2], unique_hit[4], left_seq, right_seq, primer_pair_prefix, sep='\t', file=f_out_unique)
                 genomes_with_unique_primer_pair.add(genome_name)
 
             print(primer_pair_prefix, left_seq, right_seq, '\t'.join(all_hits), sep='\t', file=f_out_all)
+            if hit_store is not None:
+                hit_store.add_primer_pair(primer_pair_prefix, left_seq, right_seq, store_hits)
 
         pyfastaq.utils.close(f_out_all)
         pyfastaq.utils.close(f_out_unique)
+        if hit_store is not None:
+            hit_store.close()
 
         f_out = pyfastaq.utils.open_file_write(self.outprefix + '.genome_uniqueness.tsv')
         for genome_name in sorted(genomes):
@@ -193,6 +303,7 @@ class PrimerUniqueness:
                 unique = '1' if genome_name in genomes_with_unique_primer_pair else '0'
                 print(genome_name, unique, sep='\t', file=f_out)
         pyfastaq.utils.close(f_out)
+        return primer_pairs_written
 
 
     @staticmethod
@@ -200,20 +311,562 @@ class PrimerUniqueness:
         return '+' if not b else '-'
 
 
-    def run(self):
-        all_primers_fasta = self.outprefix + '.all_primers.fa'
-        all_genomes_fasta = self.outprefix + '.all_genomes.fa'
-        genomes = primer3tools.genome_set.GenomeSet(self.genomes_file)
-        self._cat_primer_fastas(genomes, all_primers_fasta)
-        primer_hits = {}
+    # returns the index made by primer3tools batch for the genome or combined index called name
+    def _index_path(self, name):
+        if self.mapper == 'bowtie2':
+            return os.path.join(self.primer3_outdir, name + '.bowtie2_index', 'index')
+        else:
+            return os.path.join(self.primer3_outdir, name + '.exact_index')
+
+
+    # returns list of tuples (job name, index, genome names, is combined index).
+    # When scanning genomes, the index is the genome FASTA file
+    def _mapping_jobs(self, genomes):
+        if self.mapper == 'scan':
+            return [(name, genomes[name].fasta_file, [name], False) for name in genomes]
+
+        manifest = os.path.join(self.primer3_outdir, primer3tools.mapping.combined_index_manifest)
+        if not os.path.exists(manifest):
+            return [(name, self._index_path(name), [name], False) for name in genomes]
+
+        chunks = primer3tools.mapping.load_combined_index_manifest(manifest)
+        jobs = []
+        genomes_found = set()
+
+        for chunk_name, genome_names in chunks.items():
+            genome_names = [x for x in genome_names if x in genomes.genomes]
+            if len(genome_names):
+                jobs.append((chunk_name, self._index_path(chunk_name), genome_names, True))
+                genomes_found.update(genome_names)
+
+        missing = [x for x in genomes if x not in genomes_found]
+        if len(missing):
+            raise Error('Genome(s) not found in combined indexes listed in ' + manifest + ':\n' + '\n'.join(missing))
+
+        return jobs
+
+
+    # returns the k-mer filter made by primer3tools batch --kmer_filter of a genome
+    def _kmer_filter_file(self, genome_name):
+        return primer3tools.primer3_batch.kmer_filter_file(os.path.join(self.primer3_outdir, genome_name))
+
+
+    # Returns the IDs of the primer pairs that could match in at least one of the genomes,
+    # because the k-mer filters of a genome say that both primers could be there. Other
+    # primer pairs cannot have a match, so do not need mapping. If unique_primers is not
+    # None, the IDs are of "pairs" of unique_primers.catalog that have a sequence of
+    # one of those primer pairs. Also returns the number of primer pairs in catalog that
+    # do not need mapping
+    def _kmer_filter_pair_ids(self, catalog, genome_names, unique_primers=None):
+        sequences = catalog.sequences if unique_primers is None else unique_primers.catalog.sequences
+        could_match = numpy.zeros(len(catalog), dtype=bool)
+
+        for genome_name in genome_names:
+            in_genome = primer3tools.kmer_filter.KmerFilter(self._kmer_filter_file(genome_name)).contains(sequences)
+            if unique_primers is not None:
+                in_genome = in_genome[unique_primers.query_ids]
+            could_match |= in_genome[0::2] & in_genome[1::2]
 
-        for genome_name in genomes:
-            genome = genomes[genome_name]
-            bowtie_index = os.path.join(self.primer3_outdir, genome_name + '.bowtie2_index', 'index')
-            sam_file = self.outprefix + '.tmp.' + genome_name + '.sam'
-            primer3tools.mapping.run_bowtie2(all_primers_fasta, bowtie_index, sam_file)
-            pairs_dict = self._parse_sam(sam_file)
-            self._update_primer_hits(primer_hits, pairs_dict, genome_name)
+        skipped = len(catalog) - int(could_match.sum())
+        if unique_primers is None:
+            return numpy.flatnonzero(could_match).tolist(), skipped
+
+        sequence_ids = unique_primers.query_ids[numpy.flatnonzero(numpy.repeat(could_match, 2))]
+        return numpy.unique(sequence_ids // 2).tolist(), skipped
+
+
+    @staticmethod
+    def _sort_mapping_jobs_by_size(jobs, genomes):
+        job_sizes = {}
+        for job in jobs:
+            job_sizes[job[0]] = sum([os.path.getsize(genomes[x].fasta_file) for x in job[2]])
+        return sorted(jobs, key=lambda x: (-job_sizes[x[0]], x[0]))
+
+
+    # Returns the number of processes to run the jobs in, and a list of the
+    # number of threads of each process. The threads that do not divide evenly
+    # between the processes are given to the first processes, one each
+    @staticmethod
+    def _split_threads(threads, number_of_jobs):
+        processes = max(1, min(threads, number_of_jobs))
+        per_process, remainder = divmod(threads, processes)
+        return processes, [max(1, per_process + (i < remainder)) for i in range(processes)]
+
+
+    # Returns an aho_corasick.PrimerScanner of the primer pairs in pair_ids, or all
+    # primer pairs if pair_ids is None. The scanner of all primer pairs is made once
+    # per catalog (in each process) and reused for all genomes. It is only reused
+    # for the same catalog object, because the same PrimerUniqueness also maps
+    # other catalogs, for example the primers of repetitive sequences
+    def _primer_scanner(self, catalog, pair_ids):
+        if pair_ids is not None:
+            return primer3tools.aho_corasick.PrimerScanner(catalog, [2 * x + y for x in pair_ids for y in (0, 1)])
+
+        scanner_catalog, scanner = getattr(self, '_all_primers_scanner', (None, None))
+        if scanner_catalog is not catalog:
+            scanner = primer3tools.aho_corasick.PrimerScanner(catalog, range(2 * len(catalog)))
+            self._all_primers_scanner = (catalog, scanner)
+        return scanner
+
+
+    # Yields HitTables of perfect hits of primers to the index, each with all the hits
+    # of one or more primer pairs (see _hit_tables_from_sam_reader).
+    # pair_ids is a list of primer pairs to map, or None to map all primer pairs.
+    # If max_hits > 0, bowtie2 reports at most that many hits per primer
+    def _map_primers(self, primers_fasta, catalog, pair_ids, index, job_name, threads, max_hits=0):
+        if pair_ids is not None and len(pair_ids) == 0:
+            return
+
+        if self.mapper == 'exact':
+            yield from primer3tools.exact_index.ExactIndex(index).hit_tables(catalog, pair_ids)
+        elif self.mapper == 'scan':
+            hits = self._primer_scanner(catalog, pair_ids).hit_table(index)
+            if len(hits):
+                yield hits
+        elif self.mapping_io == 'file':
+            if pair_ids is None:
+                reads_file = primers_fasta
+            else:
+                reads_file = self.outprefix + '.tmp.' + job_name + '.primers.fa'
+                with open(reads_file, 'w') as f:
+                    f.writelines(catalog.fasta_lines(pair_ids))
+
+            sam_file = self.outprefix + '.tmp.' + job_name + '.sam'
+            primer3tools.mapping.run_bowtie2(reads_file, index, sam_file, threads=threads, max_hits=max_hits)
+            sam_reader = pysam.Samfile(sam_file, "r")
+            yield from self._hit_tables_from_sam_reader(sam_reader, catalog, self.hit_batch_size)
+            sam_reader.close()
             os.unlink(sam_file)
+            if pair_ids is not None:
+                os.unlink(reads_file)
+        else:
+            with open(primers_fasta) as f:
+                reads = f if pair_ids is None else catalog.fasta_lines(pair_ids)
+                with primer3tools.mapping.stream_bowtie2(reads, index, threads=threads, output_format=self.mapping_io, max_hits=max_hits) as sam_reader:
+                    yield from self._hit_tables_from_sam_reader(sam_reader, catalog, self.hit_batch_size)
+
+
+    def _index_files(self, index):
+        if self.mapper == 'bowtie2':
+            return [index + '.' + x for x in primer3tools.mapping.bowtie2_index_extensions]
+        elif self.mapper == 'exact':
+            return [os.path.join(index, x) for x in primer3tools.exact_index.index_files]
+        else:
+            return [index]
+
+
+    # Returns the checksum of the files of the index of a mapping job, for checking that
+    # a checkpoint was made with the same index. Indexes can be many GB, so the checksum
+    # is saved in the checkpoint directory, and only made again if the files change
+    def _index_hash(self, index, job_name):
+        cache_file = os.path.join(self.checkpoint_dir, job_name + '.' + self.mapper + '.index_sha256.json')
+        return primer3tools.common.cached_sha256_of_files(self._index_files(index), cache_file)
+
+
+    # Yields HitTables of all perfect hits of all primers to the index, each with all
+    # the hits of one or more primer pairs, in the same way as _map_primers. Only the
+    # primer pairs that are not already in the job's checkpoint file from a previous
+    # run are mapped. The checkpoint is only used if the index has not changed. Its
+    # hits are yielded a part at a time, and a new checkpoint is written with each
+    # table of hits as it is yielded (see checkpoint.Writer), which replaces the old one
+    # when all the hits have been yielded. With a maximum number of hits per primer,
+    # not all hits are found, so a different checkpoint file is used. If pair_ids is
+    # not None, only those primer pairs are mapped (see _kmer_filter_pair_ids), and the
+    # checkpoint only has the primer pairs that have been mapped
+    def _map_primers_with_checkpoint(self, primers_fasta, catalog, index, job_name, threads, pair_ids=None):
+        cap = '' if self.max_hits_per_primer == 0 else '.max_hits_' + str(self.max_hits_per_primer)
+        checkpoint_file = os.path.join(self.checkpoint_dir, job_name + '.' + self.mapper + cap + '.npz')
+        index_hash = self._index_hash(index, job_name)
+        to_map = numpy.ones(len(catalog), dtype=bool)
+        if pair_ids is not None:
+            to_map[:] = False
+            to_map[pair_ids] = True
+        found = numpy.zeros(len(catalog), dtype=bool)
+        checkpoint = None
+
+        if os.path.exists(checkpoint_file):
+            checkpoint = primer3tools.checkpoint.load(checkpoint_file)
+            if checkpoint.index_hash != index_hash:
+                checkpoint = None
+            elif checkpoint.primers_hash == catalog.content_hash():
+                yield from checkpoint.hit_tables()
+                return
+            else:
+                found = checkpoint.found_pair_keys(catalog.pair_keys())
+                to_map &= ~found
+
+        writer = primer3tools.checkpoint.Writer(checkpoint_file, index_hash, catalog.pair_keys(), found | to_map)
+        if checkpoint is not None:
+            for hits in checkpoint.hit_tables_for_pair_keys(catalog.pair_keys()):
+                writer.add(hits)
+                yield hits
+
+        pair_ids = None if to_map.all() else numpy.flatnonzero(to_map).tolist()
+        for hits in self._map_primers(primers_fasta, catalog, pair_ids, index, job_name, threads, max_hits=self._bowtie2_max_hits()):
+            writer.add(hits)
+            yield hits
+        writer.close()
+
+
+    # The same as _map_primers_with_checkpoint, but for the distinct sequences of
+    # unique_primers (see primer_catalog.UniquePrimers), and pair_ids are of
+    # unique_primers.catalog. The checkpoint has the hits of each sequence, keyed by
+    # the sequence (see UniquePrimers.sequence_keys), so that a sequence that was mapped
+    # before is never mapped again, even when adding or removing genomes changes how the
+    # sequences are paired. Only the sequences that are not in the checkpoint are
+    # mapped, paired up among themselves. Yields HitTables of hits of sequences of
+    # unique_primers.catalog, each with all the hits of one or more sequences
+    def _map_sequences_with_checkpoint(self, primers_fasta, unique_primers, index, job_name, threads, pair_ids=None):
+        cap = '' if self.max_hits_per_primer == 0 else '.max_hits_' + str(self.max_hits_per_primer)
+        checkpoint_file = os.path.join(self.checkpoint_dir, job_name + '.' + self.mapper + cap + '.sequences.npz')
+        index_hash = self._index_hash(index, job_name)
+        keys = unique_primers.sequence_keys()
+        to_map = numpy.ones(len(keys), dtype=bool)
+        if pair_ids is not None:
+            to_map[:] = False
+            primer_ids = numpy.array([2 * x + y for x in pair_ids for y in (0, 1)], dtype=numpy.int64)
+            to_map[primer_ids[primer_ids < len(keys)]] = True
+        found = numpy.zeros(len(keys), dtype=bool)
+        checkpoint = None
+
+        # each sequence is stored in the checkpoint as a "pair" whose left primer is the sequence
+        if os.path.exists(checkpoint_file):
+            checkpoint = primer3tools.checkpoint.load(checkpoint_file)
+            if checkpoint.index_hash == index_hash:
+                found = checkpoint.found_pair_keys(keys)
+                to_map &= ~found
+            else:
+                checkpoint = None
+
+        writer = primer3tools.checkpoint.Writer(checkpoint_file, index_hash, keys, found | to_map)
+        if checkpoint is not None:
+            for pair_hits in checkpoint.hit_tables_for_pair_keys(keys):
+                writer.add(pair_hits)
+                primer_ids, contig_ids, starts, is_reverse = pair_hits.columns()
+                hits = primer3tools.hit_table.HitTable()
+                hits.add_columns(primer_ids // 2, contig_ids, starts, is_reverse, pair_hits.contig_names)
+                yield hits
+
+        if to_map.all():
+            # nothing to reuse, so all the sequences are mapped, the same as without a checkpoint
+            sequence_ids = numpy.arange(len(keys), dtype=numpy.int64)
+            to_map_catalog, to_map_pair_ids = unique_primers.catalog, None
+        else:
+            sequence_ids = numpy.flatnonzero(to_map)
+            to_map_catalog = primer3tools.primer_catalog.sequence_pairs_catalog([unique_primers.catalog.sequences[x] for x in sequence_ids])
+            to_map_pair_ids = list(range(len(to_map_catalog)))
+
+        if len(sequence_ids):
+            for new_hits in self._map_primers(primers_fasta, to_map_catalog, to_map_pair_ids, index, job_name, threads, max_hits=self._bowtie2_max_hits()):
+                primer_ids, contig_ids, starts, is_reverse = new_hits.columns()
+                # the extra primer, when there is an odd number of sequences to map, is not used
+                rows = primer_ids < len(sequence_ids)
+                hits = primer3tools.hit_table.HitTable()
+                hits.add_columns(sequence_ids[primer_ids[rows]], contig_ids[rows], starts[rows], is_reverse[rows], new_hits.contig_names)
+                pair_hits = primer3tools.hit_table.HitTable()
+                pair_hits.add_columns(2 * sequence_ids[primer_ids[rows]], contig_ids[rows], starts[rows], is_reverse[rows], new_hits.contig_names)
+                writer.add(pair_hits)
+                yield hits
+        writer.close()
+
+
+    def _update_primer_hits_from_job_hits(self, primer_hits, hits, catalog, genome_names, is_combined):
+        if is_combined:
+            genome_hits = hits.split_by_genome()
+        else:
+            genome_hits = {genome_names[0]: hits}
+
+        for genome_name in genome_names:
+            if genome_name in genome_hits:
+                self._update_primer_hits(primer_hits, genome_hits[genome_name], catalog, genome_name)
+
+
+    # bowtie2 reports one more hit than the maximum per primer, so that
+    # primers with too many hits can be found (see _cap_hits)
+    def _bowtie2_max_hits(self):
+        return 0 if self.max_hits_per_primer == 0 else self.max_hits_per_primer + 1
+
+
+    # Returns hits with at most max_hits_per_primer hits of each primer, and an array
+    # of the IDs of the primers that had more hits (these are "repetitive")
+    def _cap_hits(self, hits):
+        if self.max_hits_per_primer == 0:
+            return hits, numpy.zeros(0, dtype=numpy.int64)
+        return hits.capped(self.max_hits_per_primer)
+
+
+    # Returns an array of the number of matches of each primer pair of catalog in primer_hits
+    @staticmethod
+    def _matches_per_pair(primer_hits, catalog):
+        counts = numpy.zeros(len(catalog), dtype=numpy.int32)
+        for name, genome_hits in primer_hits.items():
+            counts[catalog.name_to_id[name]] = sum([len(x) for contig_hits in genome_hits.values() for x in contig_hits.values()])
+        return counts
+
+
+    # If unique_primers is not None, then primers_fasta must be the FASTA file of
+    # unique_primers.catalog. Its sequences are mapped, and the hits are given to
+    # every primer in catalog with that sequence.
+    # If max_memory > 0 and the matches of the job would use more memory (bytes) than
+    # that, they are written to a run file (see match_runs.write_run) instead of being returned.
+    # Returns the job name, the primer hits of the job (empty if they are in a run file),
+    # the name of the run file (or None), a list of the IDs of primer pairs that have a
+    # repetitive primer (see _cap_hits), the number of matches of each primer pair (see
+    # _matches_per_pair, only when there is a maximum number of hits per primer, otherwise
+    # None), and the metrics record of the job
+    def _run_mapping_job(self, primers_fasta, catalog, job, threads, max_memory=0, unique_primers=None):
+        job_name, index, genome_names, is_combined = job
+        job_primer_hits = {}
+        repetitive_primer_ids = []
+
+        with primer3tools.metrics.Stage('get_unique', 'mapping', job_name) as stage:
+            # there may be no tables of hits, but every job has a count of hits
+            stage.count('hits', 0)
+            if self.kmer_filter:
+                pair_ids, skipped = self._kmer_filter_pair_ids(catalog, genome_names, unique_primers)
+                stage.count('primer_pairs_skipped', skipped)
+            else:
+                pair_ids = None
+
+            if unique_primers is not None:
+                # the two primers of a pair can be in different batches of hits of unique
+                # sequences, so each batch is capped and written to a file. The hits are
+                # then given to the primers that have each sequence a batch of primer pairs
+                # at a time, so that only one batch of hits is in memory at once
+                if self.checkpoint_dir is None:
+                    hit_tables = self._map_primers(primers_fasta, unique_primers.catalog, pair_ids, index, job_name, threads, max_hits=self._bowtie2_max_hits())
+                else:
+                    hit_tables = self._map_sequences_with_checkpoint(primers_fasta, unique_primers, index, job_name, threads, pair_ids=pair_ids)
+                hit_file = primer3tools.hit_table.HitFile(self.outprefix + '.tmp.' + job_name + '.sequence_hits', len(unique_primers.catalog.sequences), batch_size=self.hit_batch_size)
+                repetitive_sequence_ids = []
+                for hits in hit_tables:
+                    stage.count('hits', len(hits))
+                    hits, repetitive_ids = self._cap_hits(hits)
+                    repetitive_sequence_ids.append(repetitive_ids)
+                    hit_file.add(hits)
+                    del hits
+                hit_file.close()
+                if len(repetitive_sequence_ids):
+                    repetitive_primer_ids.append(numpy.flatnonzero(numpy.isin(unique_primers.query_ids, numpy.concatenate(repetitive_sequence_ids))))
+                for expanded_hits in unique_primers.expand_hit_file_in_batches(hit_file, self.hit_batch_size):
+                    self._update_primer_hits_from_job_hits(job_primer_hits, expanded_hits, catalog, genome_names, is_combined)
+                hit_file.remove()
+            else:
+                if self.checkpoint_dir is None:
+                    hit_tables = self._map_primers(primers_fasta, catalog, pair_ids, index, job_name, threads, max_hits=self._bowtie2_max_hits())
+                else:
+                    hit_tables = self._map_primers_with_checkpoint(primers_fasta, catalog, index, job_name, threads, pair_ids=pair_ids)
+                for hits in hit_tables:
+                    stage.count('hits', len(hits))
+                    hits, repetitive_ids = self._cap_hits(hits)
+                    repetitive_primer_ids.append(repetitive_ids)
+                    self._update_primer_hits_from_job_hits(job_primer_hits, hits, catalog, genome_names, is_combined)
+
+            repetitive_pair_ids = sorted(set((numpy.concatenate(repetitive_primer_ids) // 2).tolist())) if len(repetitive_primer_ids) else []
+            stage.count('genomes', len(genome_names))
+            stage.count('primer_pairs', len(catalog))
+            stage.count('repetitive_primer_pairs', len(repetitive_pair_ids))
+            stage.count('primer_pairs_with_matches', len(job_primer_hits))
+            stage.count('matches', primer3tools.match_runs.number_of_matches(job_primer_hits))
+            matches_per_pair = None if self.max_hits_per_primer == 0 else self._matches_per_pair(job_primer_hits, catalog)
+
+            if max_memory > 0 and stage.counts['matches'] * primer3tools.match_runs.bytes_per_match > max_memory:
+                run_file = self.outprefix + '.tmp.' + job_name + '.matches.tsv'
+                primer3tools.match_runs.write_run(job_primer_hits, run_file)
+                job_primer_hits = {}
+            else:
+                run_file = None
+
+        return job_name, job_primer_hits, run_file, repetitive_pair_ids, matches_per_pair, stage.record
+
+
+    # Primer pairs with a repetitive primer (see _cap_hits) only have some of their
+    # matches in the jobs where their hits were capped. If they still have at least
+    # two matches, then they are not unique, so the rest of their matches are not
+    # needed. Otherwise, their primers are mapped again to those jobs without a cap,
+    # so that the unique primer pairs are the same as without a cap.
+    # repetitive_pairs is a dictionary of job name -> list of IDs of primer pairs with a
+    # repetitive primer, and matches_per_pair is the total number of matches of each primer
+    # pair in all jobs. Returns the sorted names of the primer pairs whose matches are
+    # incomplete, the number of primer pairs that were mapped again, a set of
+    # (primer name, genome name) whose matches from the jobs must be replaced, and
+    # the primer hits from mapping again that replace them
+    def _resolve_repetitive_pairs(self, matches_per_pair, repetitive_pairs, primers_fasta, catalog, jobs):
+        all_pair_ids = set()
+        for pair_ids in repetitive_pairs.values():
+            all_pair_ids.update(pair_ids)
+
+        to_map = {x for x in all_pair_ids if matches_per_pair[x] < 2}
+        replaced = set()
+        primer_hits = {}
+
+        for job_name, index, genome_names, is_combined in jobs:
+            pair_ids = sorted(to_map.intersection(repetitive_pairs.get(job_name, [])))
+            if len(pair_ids) == 0:
+                continue
+
+            replaced.update((catalog.names[x], y) for x in pair_ids for y in genome_names)
+            job_primer_hits = {}
+            for hits in self._map_primers(primers_fasta, catalog, pair_ids, index, job_name + '.repetitive', self.threads):
+                self._update_primer_hits_from_job_hits(job_primer_hits, hits, catalog, genome_names, is_combined)
+            self._merge_primer_hits(primer_hits, job_primer_hits)
 
-        self._write_all_output_files(primer_hits, genomes)
+        return sorted([catalog.names[x] for x in all_pair_ids.difference(to_map)]), len(to_map), replaced, primer_hits
+
+
+    # Removes the matches of each (primer name, genome name) in replaced from primer_hits
+    @staticmethod
+    def _remove_primer_hits(primer_hits, replaced):
+        for name, genome_name in replaced:
+            if name in primer_hits:
+                primer_hits[name].pop(genome_name, None)
+                if len(primer_hits[name]) == 0:
+                    del primer_hits[name]
+
+
+    @staticmethod
+    def _merge_primer_hits(primer_hits, job_primer_hits):
+        for primer_name_prefix, genome_hits in job_primer_hits.items():
+            if primer_name_prefix not in primer_hits:
+                primer_hits[primer_name_prefix] = {}
+            for genome_name, matches in genome_hits.items():
+                assert genome_name not in primer_hits[primer_name_prefix]
+                primer_hits[primer_name_prefix][genome_name] = matches
+
+
+    # Merges the results of mapping jobs (see _run_mapping_job), as they finish. The
+    # matches are kept in memory until they would use more than max_memory, when they are
+    # written to a run file (see match_runs.write_run). Returns the primer hits in memory,
+    # the names of the run files, a dictionary of job name -> IDs of primer pairs with a
+    # repetitive primer, the total number of matches of each primer pair (or None if there
+    # is no maximum number of hits per primer), and the metrics records of the jobs,
+    # sorted by job name
+    def _merge_mapping_results(self, results, catalog):
+        primer_hits = {}
+        matches_in_memory = 0
+        run_files = []
+        repetitive_pairs = {}
+        matches_per_pair = None if self.max_hits_per_primer == 0 else numpy.zeros(len(catalog), dtype=numpy.int64)
+        records = []
+
+        for job_name, job_primer_hits, run_file, repetitive_pair_ids, job_matches_per_pair, record in results:
+            repetitive_pairs[job_name] = repetitive_pair_ids
+            records.append(record)
+            if matches_per_pair is not None:
+                matches_per_pair += job_matches_per_pair
+            if run_file is not None:
+                run_files.append(run_file)
+                continue
+
+            self._merge_primer_hits(primer_hits, job_primer_hits)
+            matches_in_memory += record['counts']['matches']
+            if self.max_memory > 0 and matches_in_memory * primer3tools.match_runs.bytes_per_match > self.max_memory:
+                run_file = self.outprefix + '.tmp.merged_matches.' + str(len(run_files)) + '.tsv'
+                primer3tools.match_runs.write_run(primer_hits, run_file)
+                run_files.append(run_file)
+                primer_hits = {}
+                matches_in_memory = 0
+
+        records.sort(key=lambda x: x['name'])
+        return primer_hits, run_files, repetitive_pairs, matches_per_pair, records
+
+
+    def run(self):
+        metrics_file = self.outprefix + '.metrics.jsonl'
+        if os.path.exists(metrics_file):
+            os.unlink(metrics_file)
+
+        with primer3tools.metrics.Stage('get_unique', 'total') as stage:
+            records = self._run(metrics_file)
+            stage.count('jobs', len(records))
+            for key in ['hits', 'matches']:
+                stage.count(key, sum([x['counts'][key] for x in records]))
+            if self.kmer_filter:
+                stage.count('primer_pairs_skipped', sum([x['counts']['primer_pairs_skipped'] for x in records]))
+
+        # jobs can run in other processes, so the peak memory of the whole run is the largest of any of them
+        stage.record['peak_rss_bytes'] = max([stage.record['peak_rss_bytes']] + [x['peak_rss_bytes'] for x in records])
+        primer3tools.metrics.write_records(metrics_file, [stage.record])
+
+
+    # Writes the output files, and metrics records of each stage to metrics_file.
+    # Returns the metrics records of the mapping jobs
+    def _run(self, metrics_file):
+        all_primers_fasta = self.outprefix + '.all_primers.fa'
+        genomes = primer3tools.genome_set.GenomeSet(self.genomes_file)
+        if self.checkpoint_dir is not None and not os.path.exists(self.checkpoint_dir):
+            os.mkdir(self.checkpoint_dir)
+
+        with primer3tools.metrics.Stage('get_unique', 'load_primers') as stage:
+            catalog = self._load_primer_catalog(genomes, all_primers_fasta)
+            stage.count('primer_pairs', len(catalog))
+        primer3tools.metrics.write_records(metrics_file, [stage.record])
+
+        jobs = self._sort_mapping_jobs_by_size(self._mapping_jobs(genomes), genomes)
+        if self.kmer_filter:
+            missing = [x for x in genomes if not os.path.exists(self._kmer_filter_file(x))]
+            if len(missing):
+                raise Error('k-mer filter not found for genome(s) below. Please run primer3tools batch with --kmer_filter\n' + '\n'.join(missing))
+        processes, worker_threads = self._split_threads(self.threads, len(jobs))
+        # the jobs that run at once share the memory for their matches
+        x = [(job, self.max_memory // processes) for job in jobs]
+
+        if self.dedup_primers:
+            with primer3tools.metrics.Stage('get_unique', 'dedup_primers') as stage:
+                unique_primers = primer3tools.primer_catalog.UniquePrimers(catalog)
+                primers_fasta = self.outprefix + '.tmp.unique_primers.fa'
+                unique_primers.catalog.write_fasta(primers_fasta)
+                stage.count('primers', unique_primers.number_of_primers)
+                stage.count('distinct_sequences', unique_primers.number_of_sequences)
+            primer3tools.metrics.write_records(metrics_file, [stage.record])
+            print('Deduplicated primers:', unique_primers.number_of_primers, 'primers have', unique_primers.number_of_sequences, 'distinct sequences. Dedup ratio:', round(unique_primers.dedup_ratio(), 2), file=sys.stderr, flush=True)
+        else:
+            unique_primers = None
+            primers_fasta = all_primers_fasta
+
+        # the results are merged as each job finishes, so that they are not all in memory at once
+        if processes > 1:
+            worker_counter = multiprocessing.Value('i', 0)
+            pool = multiprocessing.Pool(processes, initializer=_init_mapping_worker, initargs=(self, primers_fasta, catalog, unique_primers, worker_threads, worker_counter))
+            results = self._merge_mapping_results(pool.imap_unordered(_run_mapping_job_wrapper, x, chunksize=1), catalog)
+            pool.close()
+            pool.join()
+        else:
+            _init_mapping_worker(self, primers_fasta, catalog, unique_primers, worker_threads)
+            results = self._merge_mapping_results((_run_mapping_job_wrapper(y) for y in x), catalog)
+
+        primer_hits, run_files, repetitive_pairs, matches_per_pair, records = results
+        if self.dedup_primers:
+            os.unlink(primers_fasta)
+
+        if self.kmer_filter:
+            skipped = sum([x['counts']['primer_pairs_skipped'] for x in records])
+            total = sum([x['counts']['primer_pairs'] for x in records])
+            print('k-mer filter: skipped', skipped, 'of', total, 'primer pair / index comparisons. Fraction skipped:', round(skipped / max(1, total), 2), file=sys.stderr, flush=True)
+
+        primer3tools.metrics.write_records(metrics_file, records)
+        replaced = set()
+
+        if self.max_hits_per_primer > 0:
+            with primer3tools.metrics.Stage('get_unique', 'resolve_repetitive') as stage:
+                incomplete, mapped_again, replaced, new_primer_hits = self._resolve_repetitive_pairs(matches_per_pair, repetitive_pairs, all_primers_fasta, catalog, jobs)
+                self._remove_primer_hits(primer_hits, replaced)
+                self._merge_primer_hits(primer_hits, new_primer_hits)
+                with open(self.outprefix + '.repetitive_primer_pairs.txt', 'w') as f:
+                    for name in incomplete:
+                        print(name, file=f)
+                stage.count('repetitive_primer_pairs', len(incomplete))
+                stage.count('primer_pairs_mapped_again', mapped_again)
+            primer3tools.metrics.write_records(metrics_file, [stage.record])
+
+        with primer3tools.metrics.Stage('get_unique', 'write_output') as stage:
+            # matches in run files that were replaced are removed while merging. The
+            # matches that replace them are in primer_hits
+            if len(run_files):
+                primer_hits = primer3tools.match_runs.merge(run_files, primer_hits, exclude=replaced)
+            stage.count('primer_pairs_with_matches', self._write_all_output_files(primer_hits, genomes))
+            stage.count('match_runs', len(run_files))
+            primer3tools.match_runs.delete_runs(run_files)
+        primer3tools.metrics.write_records(metrics_file, [stage.record])
+
+        return records
@@ -16,9 +16,13 @@ setup(
     test_suite='nose.collector',
     tests_require=['nose >= 1.3'],
     install_requires=[
+        'numpy >= 1.9.0',
         'pyfastaq >= 3.7.0',
         'pysam >= 0.8.3',
     ],
+    extras_require={
+        'bindings': ['primer3-py >= 2.0.0'],
+    },
     license='GPLv3',
     classifiers=[
         'Development Status :: 4 - Beta',